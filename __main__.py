@@ -1,6 +1,9 @@
+import sys
 import argparse
 from typing import List, Dict
-from src import variant_filtering, variant_picking, vcf2csv, remove_umi
+from src import variant_filtering, variant_filtering_batch, variant_picking, cohort_merge, vcf2csv, vcf2sqlite, query, \
+    remove_umi
+from src.template import INSTRUMENTATION
 
 
 __VERSION__ = '1.2.1-beta'
@@ -11,8 +14,12 @@ DESCRIPTION = f'CLI tools for variant calling pipeline (version {__VERSION__}) b
 
 
 VARIANT_FILTERING = 'variant-filtering'
+VARIANT_FILTERING_BATCH = 'variant-filtering-batch'
 VARIANT_PICKING = 'variant-picking'
+COHORT_MERGE = 'cohort-merge'
 VCF2CSV = 'vcf2csv'
+VCF2SQLITE = 'vcf2sqlite'
+QUERY = 'query'
 REMOVE_UMI = 'remove-umi'
 
 
@@ -32,6 +39,22 @@ OUTPUT_VCF_ARG = {
         'help': 'path to the output vcf(.gz) file',
     }
 }
+INPUT_VCFS_ARG = {
+    'keys': ['-i', '--input-vcfs'],
+    'properties': {
+        'type': str,
+        'required': True,
+        'help': 'glob pattern of the input vcf(.gz) files, e.g. "vcfs/*.vcf.gz", or a manifest file listing one vcf path per line',
+    }
+}
+REF_FA_ARG = {
+    'keys': ['-r', '--ref-fa'],
+    'properties': {
+        'type': str,
+        'required': True,
+        'help': 'path to the reference genome fasta file',
+    }
+}
 WORKDIR_ARG = {
     'keys': ['-w', '--workdir'],
     'properties': {
@@ -41,6 +64,123 @@ WORKDIR_ARG = {
         'help': 'path to the temporary working directory (default: %(default)s)',
     }
 }
+VARIANT_FLAGGING_CRITERIA_ARG = {
+    'keys': ['--variant-flagging-criteria'],
+    'properties': {
+        'type': str,
+        'required': False,
+        'default': 'None',
+        'help': 'comma-separated flagging criteria, e.g. "low_depth: DP<20, mid_qual: 20<=MQ<=40, high_af: AF>0.02", or known sites in a sorted vcf(.gz) with an optional INFO criterion, e.g. "gnomad_common: sites=gnomad.vcf.gz, AF>0.01, pon: sites=pon.vcf.gz" (default: %(default)s)',
+    }
+}
+VARIANT_REMOVAL_FLAGS_ARG = {
+    'keys': ['--variant-removal-flags'],
+    'properties': {
+        'type': str,
+        'required': False,
+        'default': 'None',
+        'help': 'comma-separated flags for variant removal, e.g. "panel_of_normals,map_qual" (default: %(default)s)',
+    }
+}
+ONLY_PASS_ARG = {
+    'keys': ['--only-pass'],
+    'properties': {
+        'action': 'store_true',
+        'help': 'only keep the variants with PASS in FILTER column',
+    }
+}
+CACHE_ARG = {
+    'keys': ['--cache'],
+    'properties': {
+        'action': 'store_true',
+        'help': 'keep numeric INFO/QUAL/FILTER columns in a sidecar cache next to the input vcf (written on the first run) for fast re-filtering',
+    }
+}
+THREADS_ARG = {
+    'keys': ['-t', '--threads'],
+    'properties': {
+        'type': int,
+        'required': False,
+        'default': 4,
+        'help': 'number of parallel processes (default: %(default)s)',
+    }
+}
+EXPLODE_ANNOTATIONS_ARG = {
+    'keys': ['--explode-annotations'],
+    'properties': {
+        'action': 'store_true',
+        'help': 'one row per transcript of the ANN/CSQ annotations',
+    }
+}
+PICK_ARG = {
+    'keys': ['--pick'],
+    'properties': {
+        'type': str,
+        'required': False,
+        'default': 'first',
+        'choices': ['first', 'canonical', 'most-severe'],
+        'help': 'transcript of the ANN/CSQ annotations for the single row of a variant (default: %(default)s)',
+    }
+}
+COLUMNS_ARG = {
+    'keys': ['--columns'],
+    'properties': {
+        'type': str,
+        'required': False,
+        'default': 'None',
+        'help': 'comma-separated output columns in the output order, glob patterns allowed, e.g. "Chromosome,Position,SYMBOL,gnomAD*", other fields are not parsed (default: %(default)s)',
+    }
+}
+COLUMNS_FILE_ARG = {
+    'keys': ['--columns-file'],
+    'properties': {
+        'type': str,
+        'required': False,
+        'default': 'None',
+        'help': 'file of output columns (or glob patterns), one per line, appended to --columns (default: %(default)s)',
+    }
+}
+FORMAT_FIELDS_ARG = {
+    'keys': ['--format-fields'],
+    'properties': {
+        'action': 'store_true',
+        'help': 'unroll the FORMAT fields of each sample into columns "{sample}.{key}", e.g. TUMOR.AF, NORMAL.DP',
+    }
+}
+CHUNK_SIZE_ARG = {
+    'keys': ['--chunk-size'],
+    'properties': {
+        'type': int,
+        'required': False,
+        'default': 10000,
+        'help': 'number of variants parsed and written at a time (default: %(default)s)',
+    }
+}
+PARSE_THREADS_ARG = {
+    'keys': ['-t', '--threads'],
+    'properties': {
+        'type': int,
+        'required': False,
+        'default': 1,
+        'help': 'number of parallel processes parsing chunks of variants, the output order is preserved (default: %(default)s)',
+    }
+}
+METRICS_JSON_ARG = {
+    'keys': ['--metrics-json'],
+    'properties': {
+        'type': str,
+        'required': False,
+        'default': 'None',
+        'help': 'write wall/CPU time, peak RSS, bytes read/written and records of each processing stage to a json file (default: %(default)s)',
+    }
+}
+PROFILE_ARG = {
+    'keys': ['--profile'],
+    'properties': {
+        'action': 'store_true',
+        'help': 'dump cProfile stats of each processing stage to {workdir}/profile/{stage}.prof',
+    }
+}
 HELP_ARG = {
     'keys': ['-h', '--help'],
     'properties': {
@@ -68,48 +208,50 @@ MODE_TO_GROUP_TO_ARGS = {
                 ],
             'Optional':
                 [
-                    {
-                        'keys': ['--variant-flagging-criteria'],
-                        'properties': {
-                            'type': str,
-                            'required': False,
-                            'default': 'None',
-                            'help': 'comma-separated flagging criteria, e.g. "low_depth: DP<20, mid_qual: 20<=MQ<=40, high_af: AF>0.02" (default: %(default)s)',
-                        }
-                    },
-                    {
-                        'keys': ['--variant-removal-flags'],
-                        'properties': {
-                            'type': str,
-                            'required': False,
-                            'default': 'None',
-                            'help': 'comma-separated flags for variant removal, e.g. "panel_of_normals,map_qual" (default: %(default)s)',
-                        }
-                    },
-                    {
-                        'keys': ['--only-pass'],
-                        'properties': {
-                            'action': 'store_true',
-                            'help': 'only keep the variants with PASS in FILTER column',
-                        }
-                    },
+                    VARIANT_FLAGGING_CRITERIA_ARG,
+                    VARIANT_REMOVAL_FLAGS_ARG,
+                    ONLY_PASS_ARG,
+                    CACHE_ARG,
                     WORKDIR_ARG,
+                    METRICS_JSON_ARG,
+                    PROFILE_ARG,
                     HELP_ARG,
                     VERSION_ARG,
                 ],
         },
-    VARIANT_PICKING:
+    VARIANT_FILTERING_BATCH:
         {
             'Required':
                 [
+                    INPUT_VCFS_ARG,
                     {
-                        'keys': ['-r', '--ref-fa'],
+                        'keys': ['-o', '--outdir'],
                         'properties': {
                             'type': str,
                             'required': True,
-                            'help': 'path to the reference genome fasta file',
+                            'help': 'path to the output directory of filtered vcfs and the summary table',
                         }
                     },
+                ],
+            'Optional':
+                [
+                    VARIANT_FLAGGING_CRITERIA_ARG,
+                    VARIANT_REMOVAL_FLAGS_ARG,
+                    ONLY_PASS_ARG,
+                    CACHE_ARG,
+                    THREADS_ARG,
+                    WORKDIR_ARG,
+                    METRICS_JSON_ARG,
+                    PROFILE_ARG,
+                    HELP_ARG,
+                    VERSION_ARG,
+                ],
+        },
+    VARIANT_PICKING:
+        {
+            'Required':
+                [
+                    REF_FA_ARG,
                     OUTPUT_VCF_ARG,
                 ],
             'Optional':
@@ -195,7 +337,86 @@ MODE_TO_GROUP_TO_ARGS = {
                             'help': 'min number of variant callers for an indel to be picked (default: %(default)s)',
                         }
                     },
+                    {
+                        'keys': ['--streaming'],
+                        'properties': {
+                            'action': 'store_true',
+                            'help': 'merge input vcfs sorted in the contig order of the reference in a single streaming pass with constant memory',
+                        }
+                    },
+                    {
+                        'keys': ['--match-window'],
+                        'properties': {
+                            'type': int,
+                            'required': False,
+                            'default': 0,
+                            'help': 'group calls from different callers within this many bp into one variant, 0 for exact matching only (default: %(default)s)',
+                        }
+                    },
+                    {
+                        'keys': ['--carry-fields'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'None',
+                            'help': 'comma-separated INFO or FORMAT keys of the caller vcfs carried into the output as INFO {caller}_{key}, e.g. "AF,DP" (default: %(default)s)',
+                        }
+                    },
+                    {
+                        'keys': ['--targets'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'None',
+                            'help': 'path to the bed file of target regions, variants with POS outside the targets are discarded (default: %(default)s)',
+                        }
+                    },
+                    {
+                        'keys': ['--concordance-prefix'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'None',
+                            'help': 'write caller concordance to {prefix}.upset.tsv and {prefix}.jaccard.tsv (default: %(default)s)',
+                        }
+                    },
+                    {
+                        'keys': ['--symlink-vcfs'],
+                        'properties': {
+                            'action': 'store_true',
+                            'help': 'symlink input vcfs into the workdir as a snapshot (input vcfs are read in place by default)',
+                        }
+                    },
+                    THREADS_ARG,
                     WORKDIR_ARG,
+                    METRICS_JSON_ARG,
+                    PROFILE_ARG,
+                    HELP_ARG,
+                    VERSION_ARG,
+                ],
+        },
+    COHORT_MERGE:
+        {
+            'Required':
+                [
+                    REF_FA_ARG,
+                    INPUT_VCFS_ARG,
+                    OUTPUT_VCF_ARG,
+                ],
+            'Optional':
+                [
+                    {
+                        'keys': ['--presence-matrix'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'None',
+                            'help': 'path to the output sparse sites x samples presence matrix, .npz or .parquet (requires pyarrow) (default: %(default)s)',
+                        }
+                    },
+                    WORKDIR_ARG,
+                    METRICS_JSON_ARG,
+                    PROFILE_ARG,
                     HELP_ARG,
                     VERSION_ARG,
                 ],
@@ -210,13 +431,117 @@ MODE_TO_GROUP_TO_ARGS = {
                         'properties': {
                             'type': str,
                             'required': True,
-                            'help': 'path to the output csv file',
+                            'help': 'path to the output csv (or parquet, arrow) file',
                         }
                     },
                 ],
             'Optional':
                 [
+                    {
+                        'keys': ['--format'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'csv',
+                            'choices': ['csv', 'parquet', 'arrow'],
+                            'help': 'output format, parquet and arrow (IPC file) have typed columns and require pyarrow (default: %(default)s)',
+                        }
+                    },
+                    EXPLODE_ANNOTATIONS_ARG,
+                    PICK_ARG,
+                    COLUMNS_ARG,
+                    COLUMNS_FILE_ARG,
+                    FORMAT_FIELDS_ARG,
+                    CHUNK_SIZE_ARG,
+                    PARSE_THREADS_ARG,
                     WORKDIR_ARG,
+                    METRICS_JSON_ARG,
+                    PROFILE_ARG,
+                    HELP_ARG,
+                    VERSION_ARG,
+                ],
+        },
+    VCF2SQLITE:
+        {
+            'Required':
+                [
+                    INPUT_VCF_ARG,
+                    {
+                        'keys': ['-o', '--output-db'],
+                        'properties': {
+                            'type': str,
+                            'required': True,
+                            'help': 'path to the output SQLite database, overwritten if it exists',
+                        }
+                    },
+                ],
+            'Optional':
+                [
+                    EXPLODE_ANNOTATIONS_ARG,
+                    PICK_ARG,
+                    COLUMNS_ARG,
+                    COLUMNS_FILE_ARG,
+                    FORMAT_FIELDS_ARG,
+                    CHUNK_SIZE_ARG,
+                    PARSE_THREADS_ARG,
+                    WORKDIR_ARG,
+                    METRICS_JSON_ARG,
+                    PROFILE_ARG,
+                    HELP_ARG,
+                    VERSION_ARG,
+                ],
+        },
+    QUERY:
+        {
+            'Required':
+                [
+                    {
+                        'keys': ['-d', '--db'],
+                        'properties': {
+                            'type': str,
+                            'required': True,
+                            'help': 'path to the SQLite database written by vcf2sqlite',
+                        }
+                    },
+                ],
+            'Optional':
+                [
+                    {
+                        'keys': ['--region'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'None',
+                            'help': 'region "chr1:100-200" (1-based, inclusive), "chr1:100" or "chr1" (default: %(default)s)',
+                        }
+                    },
+                    {
+                        'keys': ['--gene'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'None',
+                            'help': 'gene symbol (VEP SYMBOL or SnpEff Gene_Name) (default: %(default)s)',
+                        }
+                    },
+                    {
+                        'keys': ['--consequence'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'None',
+                            'help': 'exact consequence (VEP Consequence or SnpEff Annotation), e.g. missense_variant (default: %(default)s)',
+                        }
+                    },
+                    {
+                        'keys': ['-o', '--output-csv'],
+                        'properties': {
+                            'type': str,
+                            'required': False,
+                            'default': 'None',
+                            'help': 'path to the output csv file, printed to stdout by default (default: %(default)s)',
+                        }
+                    },
                     HELP_ARG,
                     VERSION_ARG,
                 ],
@@ -277,6 +602,8 @@ MODE_TO_GROUP_TO_ARGS = {
                         }
                     },
                     WORKDIR_ARG,
+                    METRICS_JSON_ARG,
+                    PROFILE_ARG,
                     HELP_ARG,
                     VERSION_ARG,
                 ],
@@ -288,8 +615,12 @@ class EntryPoint:
 
     root_parser: argparse.ArgumentParser
     variant_filtering_parser: argparse.ArgumentParser
+    variant_filtering_batch_parser: argparse.ArgumentParser
     variant_picking_parser: argparse.ArgumentParser
+    cohort_merge_parser: argparse.ArgumentParser
     vcf2csv_parser: argparse.ArgumentParser
+    vcf2sqlite_parser: argparse.ArgumentParser
+    query_parser: argparse.ArgumentParser
     remove_umi_parser: argparse.ArgumentParser
 
     def main(self):
@@ -315,18 +646,42 @@ class EntryPoint:
             description=f'{DESCRIPTION} - {VARIANT_FILTERING} mode',
             add_help=False)
 
+        self.variant_filtering_batch_parser = subparsers.add_parser(
+            prog=f'{PROG} {VARIANT_FILTERING_BATCH}',
+            name=VARIANT_FILTERING_BATCH,
+            description=f'{DESCRIPTION} - {VARIANT_FILTERING_BATCH} mode',
+            add_help=False)
+
         self.variant_picking_parser = subparsers.add_parser(
             prog=f'{PROG} {VARIANT_PICKING}',
             name=VARIANT_PICKING,
             description=f'{DESCRIPTION} - {VARIANT_PICKING} mode',
             add_help=False)
 
+        self.cohort_merge_parser = subparsers.add_parser(
+            prog=f'{PROG} {COHORT_MERGE}',
+            name=COHORT_MERGE,
+            description=f'{DESCRIPTION} - {COHORT_MERGE} mode',
+            add_help=False)
+
         self.vcf2csv_parser = subparsers.add_parser(
             prog=f'{PROG} {VCF2CSV}',
             name=VCF2CSV,
             description=f'{DESCRIPTION} - {VCF2CSV} mode',
             add_help=False)
 
+        self.vcf2sqlite_parser = subparsers.add_parser(
+            prog=f'{PROG} {VCF2SQLITE}',
+            name=VCF2SQLITE,
+            description=f'{DESCRIPTION} - {VCF2SQLITE} mode',
+            add_help=False)
+
+        self.query_parser = subparsers.add_parser(
+            prog=f'{PROG} {QUERY}',
+            name=QUERY,
+            description=f'{DESCRIPTION} - {QUERY} mode',
+            add_help=False)
+
         self.remove_umi_parser = subparsers.add_parser(
             prog=f'{PROG} {REMOVE_UMI}',
             name=REMOVE_UMI,
@@ -343,18 +698,42 @@ class EntryPoint:
             optional_args=MODE_TO_GROUP_TO_ARGS[VARIANT_FILTERING]['Optional']
         )
 
+        self.__add(
+            parser=self.variant_filtering_batch_parser,
+            required_args=MODE_TO_GROUP_TO_ARGS[VARIANT_FILTERING_BATCH]['Required'],
+            optional_args=MODE_TO_GROUP_TO_ARGS[VARIANT_FILTERING_BATCH]['Optional']
+        )
+
         self.__add(
             parser=self.variant_picking_parser,
             required_args=MODE_TO_GROUP_TO_ARGS[VARIANT_PICKING]['Required'],
             optional_args=MODE_TO_GROUP_TO_ARGS[VARIANT_PICKING]['Optional']
         )
 
+        self.__add(
+            parser=self.cohort_merge_parser,
+            required_args=MODE_TO_GROUP_TO_ARGS[COHORT_MERGE]['Required'],
+            optional_args=MODE_TO_GROUP_TO_ARGS[COHORT_MERGE]['Optional']
+        )
+
         self.__add(
             parser=self.vcf2csv_parser,
             required_args=MODE_TO_GROUP_TO_ARGS[VCF2CSV]['Required'],
             optional_args=MODE_TO_GROUP_TO_ARGS[VCF2CSV]['Optional']
         )
 
+        self.__add(
+            parser=self.vcf2sqlite_parser,
+            required_args=MODE_TO_GROUP_TO_ARGS[VCF2SQLITE]['Required'],
+            optional_args=MODE_TO_GROUP_TO_ARGS[VCF2SQLITE]['Optional']
+        )
+
+        self.__add(
+            parser=self.query_parser,
+            required_args=MODE_TO_GROUP_TO_ARGS[QUERY]['Required'],
+            optional_args=MODE_TO_GROUP_TO_ARGS[QUERY]['Optional']
+        )
+
         self.__add(
             parser=self.remove_umi_parser,
             required_args=MODE_TO_GROUP_TO_ARGS[REMOVE_UMI]['Required'],
@@ -380,8 +759,27 @@ class EntryPoint:
 
         if args.mode is None:
             self.root_parser.print_help()
-
-        elif args.mode == VARIANT_FILTERING:
+            return
+
+        metrics_json = getattr(args, 'metrics_json', 'None')
+        profile = getattr(args, 'profile', False)
+
+        INSTRUMENTATION.start(
+            command=args.mode,
+            profile_dir=f'{args.workdir}/profile' if profile else None)
+        try:
+            self.run_mode(args)
+        finally:  # the spans and profiles of a failed run show where it failed
+            INSTRUMENTATION.stop()
+            if metrics_json.lower() != 'none':
+                INSTRUMENTATION.write_json(
+                    path=metrics_json,
+                    command=args.mode,
+                    version=__VERSION__,
+                    argv=sys.argv)
+
+    def run_mode(self, args: argparse.Namespace):
+        if args.mode == VARIANT_FILTERING:
             print(f'Start running omic {VARIANT_FILTERING} {__VERSION__}\n', flush=True)
             variant_filtering(
                 input_vcf=args.input_vcf,
@@ -389,6 +787,19 @@ class EntryPoint:
                 variant_flagging_criteria=args.variant_flagging_criteria,
                 variant_removal_flags=args.variant_removal_flags,
                 only_pass=args.only_pass,
+                cache=args.cache,
+                workdir=args.workdir)
+
+        elif args.mode == VARIANT_FILTERING_BATCH:
+            print(f'Start running omic {VARIANT_FILTERING_BATCH} {__VERSION__}\n', flush=True)
+            variant_filtering_batch(
+                input_vcfs=args.input_vcfs,
+                outdir=args.outdir,
+                variant_flagging_criteria=args.variant_flagging_criteria,
+                variant_removal_flags=args.variant_removal_flags,
+                only_pass=args.only_pass,
+                cache=args.cache,
+                threads=args.threads,
                 workdir=args.workdir)
 
         elif args.mode == VARIANT_PICKING:
@@ -405,6 +816,22 @@ class EntryPoint:
                 somatic_sniper=args.somatic_sniper,
                 min_snv_callers=args.min_snv_callers,
                 min_indel_callers=args.min_indel_callers,
+                streaming=args.streaming,
+                match_window=args.match_window,
+                carry_fields=args.carry_fields,
+                targets=args.targets,
+                concordance_prefix=args.concordance_prefix,
+                symlink_vcfs=args.symlink_vcfs,
+                threads=args.threads,
+                workdir=args.workdir)
+
+        elif args.mode == COHORT_MERGE:
+            print(f'Start running omic {COHORT_MERGE} {__VERSION__}\n', flush=True)
+            cohort_merge(
+                ref_fa=args.ref_fa,
+                input_vcfs=args.input_vcfs,
+                output_vcf=args.output_vcf,
+                presence_matrix=args.presence_matrix,
                 workdir=args.workdir)
 
         elif args.mode == VCF2CSV:
@@ -412,8 +839,38 @@ class EntryPoint:
             vcf2csv(
                 input_vcf=args.input_vcf,
                 output_csv=args.output_csv,
+                output_format=args.format,
+                explode_annotations=args.explode_annotations,
+                pick=args.pick,
+                columns=args.columns,
+                columns_file=args.columns_file,
+                chunk_size=args.chunk_size,
+                format_fields=args.format_fields,
+                threads=args.threads,
                 workdir=args.workdir)
 
+        elif args.mode == VCF2SQLITE:
+            print(f'Start running omic {VCF2SQLITE} {__VERSION__}\n', flush=True)
+            vcf2sqlite(
+                input_vcf=args.input_vcf,
+                output_db=args.output_db,
+                explode_annotations=args.explode_annotations,
+                pick=args.pick,
+                columns=args.columns,
+                columns_file=args.columns_file,
+                chunk_size=args.chunk_size,
+                format_fields=args.format_fields,
+                threads=args.threads,
+                workdir=args.workdir)
+
+        elif args.mode == QUERY:
+            query(
+                db=args.db,
+                region=args.region,
+                gene=args.gene,
+                consequence=args.consequence,
+                output_csv=args.output_csv)
+
         elif args.mode == REMOVE_UMI:
             print(f'Start running omic {REMOVE_UMI} {__VERSION__}\n', flush=True)
             remove_umi(
@@ -1,11 +1,17 @@
-from os import makedirs
-from os.path import basename, join
-from typing import List, Optional
-from .parse_vcf import ParseVcf
+import sys
+import csv
+from glob import glob
+from os import makedirs, symlink, remove
+from shutil import move
+from os.path import basename, isfile, abspath, lexists
+from typing import List, Optional, Dict, Union, Tuple, Iterator, TYPE_CHECKING
 from .template import Settings, Processor
-from .remove_umi import RemoveUmiAndAdapter
-from .variant_picking import VariantPicking
-from .variant_filtering import FlagVariants, RemoveVariants
+
+# Modules of the commands are imported where they are used, so that each command (or --help) only imports its own,
+# and pandas or numpy are not imported by commands that do not need them
+if TYPE_CHECKING:
+    import pandas
+    from .variant_filtering import Criterion, KnownSitesCriterion
 
 
 def variant_filtering(
@@ -14,6 +20,7 @@ def variant_filtering(
         variant_flagging_criteria: str,
         variant_removal_flags: str,
         only_pass: bool,
+        cache: bool,
         workdir: str):
 
     makedirs(workdir, exist_ok=True)
@@ -30,7 +37,8 @@ def variant_filtering(
         output_vcf=output_vcf,
         variant_flagging_criteria=variant_flagging_criteria,
         variant_removal_flags=variant_removal_flags,
-        only_pass=only_pass)
+        only_pass=only_pass,
+        cache=cache)
 
 
 class VariantFiltering(Processor):
@@ -40,6 +48,7 @@ class VariantFiltering(Processor):
     variant_flagging_criteria: str
     variant_removal_flags: List[str]
     only_pass: bool
+    cache: bool
 
     vcf: str
 
@@ -49,13 +58,15 @@ class VariantFiltering(Processor):
             output_vcf: str,
             variant_flagging_criteria: str,
             variant_removal_flags: str,
-            only_pass: bool):
+            only_pass: bool,
+            cache: bool):
 
         self.input_vcf = input_vcf
         self.output_vcf = output_vcf
         self.variant_flagging_criteria = variant_flagging_criteria
         self.variant_removal_flags = [] if variant_removal_flags.lower() == 'none' else variant_removal_flags.split(',')
         self.only_pass = only_pass
+        self.cache = cache
 
         self.vcf = self.input_vcf
         self.flag_variants()
@@ -63,15 +74,180 @@ class VariantFiltering(Processor):
         self.call(f'mv {self.vcf} {output_vcf}')
 
     def flag_variants(self):
+        from .variant_filtering import FlagVariants, parse_flagging_criteria
         self.vcf = FlagVariants(self.settings).main(
             vcf=self.input_vcf,
-            variant_flagging_criteria=self.variant_flagging_criteria)
+            flag_to_criterion=parse_flagging_criteria(s=self.variant_flagging_criteria),
+            use_cache=self.cache)
 
     def remove_variants(self):
+        from .variant_filtering import RemoveVariants
         self.vcf = RemoveVariants(self.settings).main(
             vcf=self.vcf,
             flags=self.variant_removal_flags,
-            only_pass=self.only_pass)
+            only_pass=self.only_pass,
+            use_cache=self.cache)
+
+
+def variant_filtering_batch(
+        input_vcfs: str,
+        outdir: str,
+        variant_flagging_criteria: str,
+        variant_removal_flags: str,
+        only_pass: bool,
+        cache: bool,
+        threads: int,
+        workdir: str):
+
+    makedirs(workdir, exist_ok=True)
+    makedirs(outdir, exist_ok=True)
+
+    settings = Settings(
+        workdir=workdir,
+        outdir=outdir,
+        threads=threads,
+        debug=False,
+        mock=False)
+
+    VariantFilteringBatch(settings).main(
+        input_vcfs=input_vcfs,
+        variant_flagging_criteria=variant_flagging_criteria,
+        variant_removal_flags=variant_removal_flags,
+        only_pass=only_pass,
+        cache=cache)
+
+
+class VariantFilteringBatch(Processor):
+
+    SUMMARY_TSV = 'variant-filtering-summary.tsv'
+
+    input_vcfs: str
+    flag_to_criterion: Dict[str, Union['Criterion', 'KnownSitesCriterion']]
+    variant_removal_flags: List[str]
+    only_pass: bool
+    cache: bool
+
+    vcfs: List[str]
+    results: List[Tuple[str, int, int]]  # vcf, total, remaining
+
+    def main(
+            self,
+            input_vcfs: str,
+            variant_flagging_criteria: str,
+            variant_removal_flags: str,
+            only_pass: bool,
+            cache: bool):
+
+        from .variant_filtering import parse_flagging_criteria
+
+        self.input_vcfs = input_vcfs
+        self.flag_to_criterion = parse_flagging_criteria(s=variant_flagging_criteria)  # parsed once for all vcfs
+        self.variant_removal_flags = [] if variant_removal_flags.lower() == 'none' else variant_removal_flags.split(',')
+        self.only_pass = only_pass
+        self.cache = cache
+
+        self.set_vcfs()
+        self.filter_vcfs()
+        self.write_summary()
+
+    def set_vcfs(self):
+        self.vcfs = list_vcfs(self.input_vcfs)
+        self.logger.info(f'Filter {len(self.vcfs)} vcfs with {self.threads} processes')
+
+    def filter_vcfs(self):
+        from concurrent.futures import ProcessPoolExecutor
+        args = [
+            (
+                Settings(
+                    workdir=f'{self.workdir}/{get_vcf_name(vcf)}',  # separate workdir for intermediate files of each vcf
+                    outdir=self.outdir,
+                    threads=1,
+                    debug=self.debug,
+                    mock=self.mock),
+                vcf,
+                f'{self.outdir}/{get_vcf_name(vcf)}.vcf',
+                self.flag_to_criterion,
+                self.variant_removal_flags,
+                self.only_pass,
+                self.cache,
+            )
+            for vcf in self.vcfs
+        ]
+        with ProcessPoolExecutor(max_workers=self.threads) as executor:
+            self.results = list(executor.map(filter_one_vcf, *zip(*args)))
+
+    def write_summary(self):
+        lines = ['VCF\tTotal\tRemaining\tPercentage']
+        for vcf, total, passed in self.results:
+            percentage = passed / total * 100 if total > 0 else 0.
+            lines.append(f'{vcf}\t{total}\t{passed}\t{percentage:.2f}%')
+        table = '\n'.join(lines)
+
+        with open(f'{self.outdir}/{self.SUMMARY_TSV}', 'w') as fh:
+            fh.write(table + '\n')
+
+        self.logger.info(f'Summary of variant filtering:\n{table}')
+
+
+def filter_one_vcf(
+        settings: Settings,
+        vcf: str,
+        output_vcf: str,
+        flag_to_criterion: Dict[str, Union['Criterion', 'KnownSitesCriterion']],
+        variant_removal_flags: List[str],
+        only_pass: bool,
+        cache: bool) -> Tuple[str, int, int]:
+    """
+    Runs in a worker process of VariantFilteringBatch
+    """
+    from .variant_filtering import FlagVariants, RemoveVariants
+
+    makedirs(settings.workdir, exist_ok=True)
+
+    flagged_vcf = FlagVariants(settings).main(
+        vcf=vcf,
+        flag_to_criterion=flag_to_criterion,
+        use_cache=cache)
+
+    remove_variants = RemoveVariants(settings)
+    filtered_vcf = remove_variants.main(
+        vcf=flagged_vcf,
+        flags=variant_removal_flags,
+        only_pass=only_pass,
+        use_cache=cache)
+
+    move(filtered_vcf, output_vcf)
+
+    return vcf, remove_variants.total, remove_variants.passed
+
+
+def list_vcfs(input_vcfs: str) -> List[str]:
+    """
+    input_vcfs is either a manifest file listing one vcf path per line, or a glob pattern, e.g. "vcfs/*.vcf.gz"
+    """
+    if isfile(input_vcfs) and not input_vcfs.endswith(('.vcf', '.vcf.gz')):
+        with open(input_vcfs) as fh:
+            vcfs = [line.strip() for line in fh if line.strip() != '' and not line.startswith('#')]
+    else:
+        vcfs = sorted(f for f in glob(input_vcfs) if f.endswith(('.vcf', '.vcf.gz')))  # skip e.g. .tbi
+
+    assert len(vcfs) > 0, f'No input vcf found by "{input_vcfs}"'
+
+    names = [get_vcf_name(vcf) for vcf in vcfs]
+    assert len(set(names)) == len(names), 'Input vcfs must have unique file names'
+
+    return vcfs
+
+
+def get_vcf_name(vcf: str) -> str:
+    """
+    'path/to/sample.vcf.gz' -> 'sample'
+    """
+    name = basename(vcf)
+    for suffix in ['.gz', '.vcf']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
 
 
 def variant_picking(
@@ -86,6 +262,13 @@ def variant_picking(
         somatic_sniper: str,
         min_snv_callers: int,
         min_indel_callers: int,
+        streaming: bool,
+        match_window: int,
+        carry_fields: str,
+        targets: str,
+        concordance_prefix: str,
+        symlink_vcfs: bool,
+        threads: int,
         workdir: str):
 
     makedirs(workdir, exist_ok=True)
@@ -93,7 +276,7 @@ def variant_picking(
     settings = Settings(
         workdir=workdir,
         outdir='.',
-        threads=1,
+        threads=threads,
         debug=False,
         mock=False)
 
@@ -108,7 +291,13 @@ def variant_picking(
         vardict=None if vardict.lower() == 'none' else vardict,
         somatic_sniper=None if somatic_sniper.lower() == 'none' else somatic_sniper,
         min_snv_callers=min_snv_callers,
-        min_indel_callers=min_indel_callers
+        min_indel_callers=min_indel_callers,
+        streaming=streaming,
+        match_window=match_window,
+        carried_keys=[] if carry_fields.lower() == 'none' else carry_fields.replace(' ', '').split(','),
+        targets=None if targets.lower() == 'none' else targets,
+        concordance_prefix=None if concordance_prefix.lower() == 'none' else concordance_prefix,
+        symlink_vcfs=symlink_vcfs
     )
 
 
@@ -125,8 +314,14 @@ class Picking(Processor):
     somatic_sniper: Optional[str]
     min_snv_callers: int
     min_indel_callers: int
+    streaming: bool
+    match_window: int
+    carried_keys: List[str]
+    targets: Optional[str]
+    concordance_prefix: Optional[str]
+    symlink_vcfs: bool
 
-    vcfs: List[str]
+    caller_to_vcf: Dict[str, str]
 
     def main(
             self,
@@ -140,7 +335,13 @@ class Picking(Processor):
             vardict: Optional[str],
             somatic_sniper: Optional[str],
             min_snv_callers: int,
-            min_indel_callers: int):
+            min_indel_callers: int,
+            streaming: bool,
+            match_window: int,
+            carried_keys: List[str],
+            targets: Optional[str],
+            concordance_prefix: Optional[str],
+            symlink_vcfs: bool):
 
         self.ref_fa = ref_fa
         self.output_vcf = output_vcf
@@ -153,75 +354,248 @@ class Picking(Processor):
         self.somatic_sniper = somatic_sniper
         self.min_snv_callers = min_snv_callers
         self.min_indel_callers = min_indel_callers
-
-        self.copy_vcfs()
+        self.streaming = streaming
+        self.match_window = match_window
+        self.carried_keys = carried_keys
+        self.targets = targets
+        self.concordance_prefix = concordance_prefix
+        self.symlink_vcfs = symlink_vcfs
+
+        self.set_caller_to_vcf()
+        if self.symlink_vcfs:
+            self.link_vcfs()
         self.pick_variants()
 
-    def copy_vcfs(self):
-        self.vcfs = []
-        for src, dst in [
-            (self.mutect2, f'{self.workdir}/mutect2.vcf'),
-            (self.haplotype_caller, f'{self.workdir}/haplotype-caller.vcf'),
-            (self.muse, f'{self.workdir}/muse.vcf'),
-            (self.lofreq, f'{self.workdir}/lofreq.vcf'),
-            (self.varscan, f'{self.workdir}/varscan.vcf'),
-            (self.vardict, f'{self.workdir}/vardict.vcf'),
-            (self.somatic_sniper, f'{self.workdir}/somatic-sniper.vcf'),
+    def set_caller_to_vcf(self):
+        """
+        Caller vcfs are parsed from their original paths, the caller label is explicit
+        """
+        self.caller_to_vcf = {}
+        for caller, vcf in [
+            ('mutect2', self.mutect2),
+            ('haplotype-caller', self.haplotype_caller),
+            ('muse', self.muse),
+            ('lofreq', self.lofreq),
+            ('varscan', self.varscan),
+            ('vardict', self.vardict),
+            ('somatic-sniper', self.somatic_sniper),
         ]:
-            if src is not None:
-                if src.endswith('.gz'):
-                    dst += '.gz'
-                self.call(f'cp {src} {dst}')
-                self.vcfs.append(dst)
+            if vcf is not None:
+                self.caller_to_vcf[caller] = vcf
+
+    def link_vcfs(self):
+        """
+        Snapshot of the inputs in the workdir as symlinks, e.g. workdir/mutect2.vcf.gz -> /path/to/sample.vcf.gz
+        """
+        for caller, vcf in self.caller_to_vcf.items():
+            dst = f'{self.workdir}/{caller}.vcf'
+            if vcf.endswith('.gz'):
+                dst += '.gz'
+            if lexists(dst):
+                remove(dst)
+            symlink(abspath(vcf), dst)
+            self.caller_to_vcf[caller] = dst
 
     def pick_variants(self):
+        from .variant_picking import VariantPicking
         vcf = VariantPicking(self.settings).main(
             ref_fa=self.ref_fa,
-            vcfs=self.vcfs,
+            caller_to_vcf=self.caller_to_vcf,
             min_snv_callers=self.min_snv_callers,
-            min_indel_callers=self.min_indel_callers)
+            min_indel_callers=self.min_indel_callers,
+            streaming=self.streaming,
+            match_window=self.match_window,
+            carried_keys=self.carried_keys,
+            targets=self.targets,
+            concordance_prefix=self.concordance_prefix)
 
         self.call(f'mv {vcf} {self.output_vcf}')
 
 
+def cohort_merge(
+        ref_fa: str,
+        input_vcfs: str,
+        output_vcf: str,
+        presence_matrix: str,
+        workdir: str):
+
+    makedirs(workdir, exist_ok=True)
+
+    settings = Settings(
+        workdir=workdir,
+        outdir='.',
+        threads=1,
+        debug=False,
+        mock=False)
+
+    vcfs = list_vcfs(input_vcfs)
+
+    from .cohort_merge import CohortMerge
+    CohortMerge(settings).main(
+        ref_fa=ref_fa,
+        vcfs=vcfs,
+        samples=[get_vcf_name(vcf) for vcf in vcfs],
+        output_vcf=output_vcf,
+        presence_matrix=None if presence_matrix.lower() == 'none' else presence_matrix)
+
+
 def vcf2csv(
         input_vcf: str,
         output_csv: str,
+        output_format: str,
+        explode_annotations: bool,
+        pick: str,
+        columns: str,
+        columns_file: str,
+        chunk_size: int,
+        format_fields: bool,
+        threads: int,
         workdir: str):
 
+    assert not (explode_annotations and pick != 'first'), '--explode-annotations cannot be combined with --pick'
+
+    patterns = [] if columns.lower() == 'none' else [c.strip() for c in columns.split(',')]
+    if columns_file.lower() != 'none':
+        with open(columns_file) as fh:
+            patterns += [line.strip() for line in fh if line.strip() != '']
+
     makedirs(workdir, exist_ok=True)
 
     settings = Settings(
         workdir=workdir,
         outdir='.',
-        threads=1,
+        threads=threads,
         debug=False,
         mock=False)
 
     Vcf2Csv(settings).main(
         input_vcf=input_vcf,
-        output_csv=output_csv)
+        output_csv=output_csv,
+        output_format=output_format,
+        annotation_mode='explode' if explode_annotations else pick,
+        columns=patterns if len(patterns) > 0 else None,
+        chunk_size=chunk_size,
+        format_fields=format_fields)
 
 
 class Vcf2Csv(Processor):
 
     input_vcf: str
     output_csv: str
+    output_format: str
+    annotation_mode: str
+    columns: Optional[List[str]]
+    chunk_size: int
+    format_fields: bool
 
     def main(
             self,
             input_vcf: str,
-            output_csv: str):
+            output_csv: str,
+            output_format: str,
+            annotation_mode: str,
+            columns: Optional[List[str]],
+            chunk_size: int,
+            format_fields: bool):
 
         self.input_vcf = input_vcf
         self.output_csv = output_csv
-
-        ParseVcf(self.settings).main(
+        self.output_format = output_format
+        self.annotation_mode = annotation_mode
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.format_fields = format_fields
+
+        from .parse_vcf import ParseVcf
+        output = ParseVcf(self.settings).main(
             vcf=self.input_vcf,
-            dstdir=self.workdir)
+            dstdir=self.workdir,
+            output_format=self.output_format,
+            annotation_mode=self.annotation_mode,
+            columns=self.columns,
+            chunk_size=self.chunk_size,
+            format_fields=self.format_fields)
+
+        self.call(f'mv {output} {self.output_csv}')
+
+
+def vcf2sqlite(
+        input_vcf: str,
+        output_db: str,
+        explode_annotations: bool,
+        pick: str,
+        columns: str,
+        columns_file: str,
+        chunk_size: int,
+        format_fields: bool,
+        threads: int,
+        workdir: str):
+
+    vcf2csv(
+        input_vcf=input_vcf,
+        output_csv=output_db,
+        output_format='sqlite',
+        explode_annotations=explode_annotations,
+        pick=pick,
+        columns=columns,
+        columns_file=columns_file,
+        chunk_size=chunk_size,
+        format_fields=format_fields,
+        threads=threads,
+        workdir=workdir)
+
+
+def query(
+        db: str,
+        region: str,
+        gene: str,
+        consequence: str,
+        output_csv: str):
+
+    from .variant_query import QueryVariants
+    q = QueryVariants(db=db)
+    rows = q.query(
+        region=None if region.lower() == 'none' else region,
+        gene=None if gene.lower() == 'none' else gene,
+        consequence=None if consequence.lower() == 'none' else consequence)
+
+    fh = sys.stdout if output_csv.lower() == 'none' else open(output_csv, 'w', newline='')
+    writer = csv.writer(fh, lineterminator='\n')
+    writer.writerow(q.columns)
+    writer.writerows(rows)
+    if fh is not sys.stdout:
+        fh.close()
+    q.close()
+
+
+def read_vcf(
+        path: str,
+        columns: Optional[List[str]] = None,
+        region: Optional[str] = None,
+        chunksize: Optional[int] = None,
+        format_fields: bool = False) -> Union['pandas.DataFrame', Iterator['pandas.DataFrame']]:
+    """
+    Library API, e.g. in a notebook: reads a (gzipped) vcf, with annotations unrolled as vcf2csv does, into a DataFrame of compact dtypes
+
+    columns: output columns or glob patterns, e.g. ['Chromosome', 'Position', 'SYMBOL', 'gnomAD*'], None for all columns
+    region: 'chr1:100-200' (1-based, inclusive), 'chr1:100' or 'chr1', read by tabix seeks if the vcf.gz has a .tbi
+    chunksize: returns an iterator of DataFrames of chunksize variants instead
+    format_fields: FORMAT fields of each sample as '{sample}.{key}' columns, e.g. 'TUMOR.AF'
+    """
+    settings = Settings(
+        workdir='.',
+        outdir='.',
+        threads=1,
+        debug=False,
+        mock=False)
 
-        csv = join(self.workdir, basename(self.input_vcf)[:-len('.vcf')] + '.csv')
-        self.call(f'mv {csv} {self.output_csv}')
+    from .vcf_dataframe import ReadVcf
+    return ReadVcf(settings).main(
+        vcf=path,
+        columns=columns,
+        region=region,
+        chunksize=chunksize,
+        format_fields=format_fields)
 
 
 def remove_umi(
@@ -262,6 +636,7 @@ class RemoveUmi(Processor):
             umi_length: int,
             gzip: bool):
 
+        from .remove_umi import RemoveUmiAndAdapter
         fq1, fq2 = RemoveUmiAndAdapter(self.settings).main(
             fq1=input_fq1,
             fq2=input_fq2,
@@ -0,0 +1,263 @@
+import os
+import gzip
+import heapq
+import numpy as np
+from array import array
+from itertools import groupby
+from typing import List, Dict, Tuple, Iterator, Optional
+from .template import Processor
+from .variant_picking import BuildHeaderContigLines, GetChromToOrder
+
+
+class CohortMerge(Processor):
+    """
+    Streams per-sample vcfs sorted in the contig order of the reference with a heap-based k-way merge
+    into one multi-sample vcf, one site per distinct (CHROM, POS, REF, ALT),
+    so memory is bounded by the number of inputs, not the number of variants
+    """
+
+    VCF_COLUMNS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+    FORMAT_ID = 'PR'
+    FORMAT_DESCRIPTION = 'Presence of the variant in the vcf of the sample, 1 or 0'
+
+    ref_fa: str
+    vcfs: List[str]
+    samples: List[str]
+    output_vcf: str
+    presence_matrix: Optional[str]
+
+    chrom_to_order: Dict[str, int]
+    vcf_header: str
+    n_sites: int
+
+    def main(
+            self,
+            ref_fa: str,
+            vcfs: List[str],
+            samples: List[str],
+            output_vcf: str,
+            presence_matrix: Optional[str]):
+
+        self.ref_fa = ref_fa
+        self.vcfs = vcfs
+        self.samples = samples
+        self.output_vcf = output_vcf
+        self.presence_matrix = presence_matrix
+
+        self.chrom_to_order = GetChromToOrder(self.settings).main(ref_fa=self.ref_fa)
+        self.build_vcf_header()
+        self.merge_vcfs()
+
+    def build_vcf_header(self):
+        contig_lines = BuildHeaderContigLines(self.settings).main(self.ref_fa)
+        columns = '\t'.join(self.VCF_COLUMNS + self.samples)
+        self.vcf_header = f'''\
+##fileformat=VCFv4.2
+{contig_lines}
+##FORMAT=<ID={self.FORMAT_ID},Number=1,Type=Integer,Description="{self.FORMAT_DESCRIPTION}">
+#{columns}'''
+
+        self.logger.info(f'Merge {len(self.vcfs)} vcfs')
+
+    def merge_vcfs(self):
+        order_to_chrom = {o: c for c, o in self.chrom_to_order.items()}
+        streams = [
+            iter_sorted_records(vcf=vcf, sample_index=i, chrom_to_order=self.chrom_to_order)
+            for i, vcf in enumerate(self.vcfs)
+        ]
+        merged = heapq.merge(*streams, key=lambda r: r[:2])  # (order, pos, ref, alt, sample_index), sorted by (order, pos)
+
+        matrix_writer = None
+        if self.presence_matrix is not None:
+            matrix_writer = get_presence_matrix_writer(
+                path=self.presence_matrix, samples=self.samples, workdir=self.workdir)
+
+        self.n_sites = 0
+        with open(self.output_vcf, 'w') as writer:
+            writer.write(self.vcf_header + '\n')
+            for (order, pos, ref, alt), sample_indexes in iter_merged_sites(merged):
+                presence = ['0'] * len(self.samples)
+                for i in sample_indexes:
+                    presence[i] = '1'
+                chrom = order_to_chrom[order]
+                writer.write(f'{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\t.\t.\t{self.FORMAT_ID}\t' + '\t'.join(presence) + '\n')
+
+                if matrix_writer is not None:
+                    matrix_writer.add(
+                        site_index=self.n_sites, sample_indexes=sample_indexes, chrom=chrom, pos=pos, ref=ref, alt=alt)
+                self.n_sites += 1
+
+        self.count_records(self.n_sites)
+
+        if matrix_writer is not None:
+            matrix_writer.close()
+            self.logger.info(f'Presence matrix of {self.n_sites} sites x {len(self.samples)} samples written to "{self.presence_matrix}"')
+
+
+def iter_merged_sites(
+        merged: Iterator[Tuple[int, int, str, str, int]]
+) -> Iterator[Tuple[Tuple[int, int, str, str], List[int]]]:
+    """
+    (order, pos, ref, alt, sample_index) sorted by (order, pos) only, as vcfs do not sort alleles within a position
+        -> ((order, pos, ref, alt), sorted sample indexes), each distinct site once, at the same position sorted by (REF, ALT)
+    """
+    for (order, pos), records in groupby(merged, key=lambda r: r[:2]):
+        variant_to_sample_indexes = {}
+        for _, _, ref, alt, i in records:
+            variant_to_sample_indexes.setdefault((ref, alt), set()).add(i)
+        for (ref, alt), sample_indexes in sorted(variant_to_sample_indexes.items()):
+            yield (order, pos, ref, alt), sorted(sample_indexes)
+
+
+def iter_sorted_records(
+        vcf: str,
+        sample_index: int,
+        chrom_to_order: Dict[str, int]) -> Iterator[Tuple[int, int, str, str, int]]:
+
+    fh = gzip.open(vcf, 'rt') if vcf.endswith('.gz') else open(vcf)
+    with fh:
+        last_key = (-1, -1)
+        for line in fh:
+            if line.startswith('#'):
+                continue
+
+            chrom, pos, _, ref, alt = line.split('\t', 5)[:5]
+            assert chrom in chrom_to_order, f'Contig "{chrom}" of "{vcf}" is not in the reference'
+
+            key = (chrom_to_order[chrom], int(pos))
+            assert key >= last_key, f'"{vcf}" is not sorted in the contig order of the reference at {chrom}:{pos}'
+            last_key = key
+
+            yield key[0], key[1], ref, alt, sample_index
+
+
+class NpzPresenceMatrixWriter:
+    """
+    Sparse (COO) sites x samples matrix in a .npz file:
+        row      int64, index of the site in the merged vcf
+        col      int32, index of the sample
+        shape    (n sites, n samples)
+        samples  sample names
+
+    Coordinates are spilled to the workdir while streaming and copied into the .npz in chunks
+    """
+
+    BUFFER_SIZE = 1 << 16
+
+    path: str
+    samples: List[str]
+    row_bin: str
+    col_bin: str
+
+    n_sites: int
+    rows: array
+    cols: array
+
+    def __init__(self, path: str, samples: List[str], workdir: str):
+        self.path = path
+        self.samples = samples
+        self.row_bin = f'{workdir}/presence-row.bin'
+        self.col_bin = f'{workdir}/presence-col.bin'
+
+        self.n_sites = 0
+        self.rows, self.cols = array('q'), array('i')
+        self.__row_fh = open(self.row_bin, 'wb')
+        self.__col_fh = open(self.col_bin, 'wb')
+
+    def add(self, site_index: int, sample_indexes: List[int], chrom: str, pos: int, ref: str, alt: str):
+        self.n_sites = site_index + 1
+        for i in sample_indexes:
+            self.rows.append(site_index)
+            self.cols.append(i)
+        if len(self.rows) >= self.BUFFER_SIZE:
+            self.__flush()
+
+    def __flush(self):
+        self.rows.tofile(self.__row_fh)
+        self.cols.tofile(self.__col_fh)
+        self.rows, self.cols = array('q'), array('i')
+
+    def close(self):
+        self.__flush()
+        self.__row_fh.close()
+        self.__col_fh.close()
+
+        np.savez(
+            self.path,
+            row=load_bin(self.row_bin, dtype=np.int64),
+            col=load_bin(self.col_bin, dtype=np.int32),
+            shape=np.array([self.n_sites, len(self.samples)], dtype=np.int64),
+            samples=np.array(self.samples))
+
+        os.remove(self.row_bin)
+        os.remove(self.col_bin)
+
+
+def load_bin(path: str, dtype: type) -> np.ndarray:
+    if os.path.getsize(path) == 0:  # cannot memory-map an empty file
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class ParquetPresenceMatrixWriter:
+    """
+    Long-format table in a .parquet file, one row per (site, sample) where the variant is present:
+        site (int64, index of the site in the merged vcf), CHROM, POS, REF, ALT, sample
+
+    Rows are written in row groups while streaming, requires pyarrow
+    """
+
+    BUFFER_SIZE = 1 << 16
+
+    path: str
+    samples: List[str]
+
+    columns: Dict[str, list]
+
+    def __init__(self, path: str, samples: List[str]):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError('pyarrow is required to write a .parquet presence matrix, e.g. pip install pyarrow') from e
+
+        self.path = path
+        self.samples = samples
+
+        self.__pa = pyarrow
+        self.__schema = pyarrow.schema([
+            ('site', pyarrow.int64()),
+            ('CHROM', pyarrow.string()),
+            ('POS', pyarrow.int64()),
+            ('REF', pyarrow.string()),
+            ('ALT', pyarrow.string()),
+            ('sample', pyarrow.string()),
+        ])
+        self.__writer = pyarrow.parquet.ParquetWriter(path, self.__schema)
+        self.columns = {name: [] for name in self.__schema.names}
+
+    def add(self, site_index: int, sample_indexes: List[int], chrom: str, pos: int, ref: str, alt: str):
+        for i in sample_indexes:
+            for name, value in zip(self.__schema.names, [site_index, chrom, pos, ref, alt, self.samples[i]]):
+                self.columns[name].append(value)
+        if len(self.columns['site']) >= self.BUFFER_SIZE:
+            self.__flush()
+
+    def __flush(self):
+        if len(self.columns['site']) == 0:
+            return
+        table = self.__pa.Table.from_pydict(self.columns, schema=self.__schema)
+        self.__writer.write_table(table)
+        self.columns = {name: [] for name in self.__schema.names}
+
+    def close(self):
+        self.__flush()
+        self.__writer.close()
+
+
+def get_presence_matrix_writer(path: str, samples: List[str], workdir: str):
+    if path.endswith('.npz'):
+        return NpzPresenceMatrixWriter(path=path, samples=samples, workdir=workdir)
+    if path.endswith('.parquet'):
+        return ParquetPresenceMatrixWriter(path=path, samples=samples)
+    raise ValueError(f'Presence matrix "{path}" should end with .npz or .parquet')
@@ -1,45 +1,77 @@
-import pandas as pd
-from os.path import exists, dirname
-from typing import Dict, Any, List, Tuple, Optional
+import io
+import csv
+import gzip
+import sqlite3
+from fnmatch import fnmatchcase
+from os import remove
+from os.path import dirname, exists
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Tuple, Optional, IO, Iterator, Union, Set
 from .tools import edit_fpath
-from .template import Processor, Settings
+from .template import Processor, Logger
 
 
 class ParseVcf(Processor):
 
-    LOG_INTERVAL = 10000  # variants
+    DEFAULT_CHUNK_SIZE = 10000  # variants
+    OUTPUT_FORMAT_TO_SUFFIX = {
+        'csv': '.csv',
+        'parquet': '.parquet',
+        'arrow': '.arrow',
+        'sqlite': '.db',
+    }
 
     vcf: str
     dstdir: Optional[str]
+    output_format: str
+    annotation_mode: str
+    columns: Optional[List[str]]
+    chunk_size: int
+    format_fields: bool
 
     vcf_header: str
     info_id_to_description: Dict[str, str]
     all_columns: List[str]
+    row_plan: 'RowPlan'
     output_csv: str
+    table_writer: Union['CsvWriter', 'ArrowTableWriter', 'SqliteWriter']
 
-    def __init__(self, settings: Settings):
-        super().__init__(settings)
-        self.vcf_line_to_row = VcfLineToRow(self.settings).main
-        self.save_data_to_csv = SaveDataToCsv(self.settings).main
-
-    def main(self, vcf: str, dstdir: Optional[str]):
+    def main(
+            self,
+            vcf: str,
+            dstdir: Optional[str],
+            output_format: str = 'csv',
+            annotation_mode: str = 'first',
+            columns: Optional[List[str]] = None,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            format_fields: bool = False) -> str:
+        """
+        columns: glob patterns of the output columns (e.g. 'gnomAD*'), in the output order, None for all columns
+        chunk_size: number of variants parsed and written at a time
+        format_fields: unroll the FORMAT fields of each sample into '{sample}.{key}' columns, e.g. 'TUMOR.AF'
+        """
         self.vcf = vcf
         self.dstdir = dstdir
+        self.output_format = output_format
+        self.annotation_mode = annotation_mode
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.format_fields = format_fields
 
         self.logger.info(msg='Start parsing annotated VCF')
         self.set_vcf_header()
         self.set_info_id_to_description()
         self.set_all_columns()
+        self.set_row_plan()
         self.set_output_csv()
+        self.set_table_writer()
         self.process_vcf_data()
 
+        return self.output_csv
+
     def set_vcf_header(self):
-        self.vcf_header = ''
-        with open(self.vcf) as fh:
-            for line in fh:
-                if not line.startswith('#'):
-                    break
-                self.vcf_header += line
+        self.vcf_header = read_vcf_header(self.vcf)
 
     def set_info_id_to_description(self):
         self.info_id_to_description = GetInfoIDToDescription(self.settings).main(
@@ -48,45 +80,161 @@ class ParseVcf(Processor):
     def set_all_columns(self):
         self.all_columns = GetAllColumns(self.settings).main(
             info_id_to_description=self.info_id_to_description)
+        if self.format_fields:
+            self.all_columns += get_sample_format_columns(self.vcf_header)
+        if self.columns is not None:
+            self.all_columns = select_columns(all_columns=self.all_columns, patterns=self.columns)
+
+    def set_row_plan(self):
+        self.row_plan = BuildRowPlan(self.settings).main(
+            info_id_to_description=self.info_id_to_description,
+            all_columns=self.all_columns,
+            annotation_mode=self.annotation_mode,
+            samples=get_samples(self.vcf_header) if self.format_fields else [],
+            format_ids=get_format_ids(self.vcf_header))
 
     def set_output_csv(self):
         self.output_csv = edit_fpath(
             fpath=self.vcf,
-            old_suffix='.vcf',
-            new_suffix='.csv',
+            old_suffix='.vcf.gz' if self.vcf.endswith('.vcf.gz') else '.vcf',
+            new_suffix=self.OUTPUT_FORMAT_TO_SUFFIX[self.output_format],
             dstdir=dirname(self.vcf) if self.dstdir is None else self.dstdir
         )
 
+    def set_table_writer(self):
+        if self.output_format == 'csv':
+            self.table_writer = CsvWriter(path=self.output_csv, columns=self.all_columns)
+            return
+
+        column_types = GetColumnTypes(self.settings).main(
+            vcf_header=self.vcf_header,
+            all_columns=self.all_columns)
+
+        if self.output_format == 'sqlite':
+            self.table_writer = SqliteWriter(
+                path=self.output_csv,
+                columns=self.all_columns,
+                column_types=column_types,
+                logger=self.logger)
+            return
+
+        self.table_writer = ArrowTableWriter(
+            path=self.output_csv,
+            columns=self.all_columns,
+            column_types=column_types,
+            logger=self.logger,
+            output_format=self.output_format)
+
     def process_vcf_data(self):
+        if self.threads > 1:
+            self.process_vcf_data_in_parallel()
+            return
+
+        n = 0
+        with open_vcf(self.vcf) as fh:
+            for lines in iter_chunks(fh=fh, size=self.chunk_size):
+                data: List[List[Any]]  # each list is a row (i.e. variant, or transcript if exploded) in the order of all_columns
+                data = parse_chunk(row_plan=self.row_plan, lines=lines, as_csv=False)
+                self.table_writer.write(data)
+
+                n += len(lines)
+                self.count_records(len(lines))
+                self.logger.debug(msg=f'{n} variants parsed')
+
+        self.table_writer.close()
+
+    def process_vcf_data_in_parallel(self):
+        """
+        Chunks of lines are parsed (and formatted as csv text) by a process pool,
+        at most 2 chunks per process are pending, and results are written in the original order.
+        The row plan is sent once to each process by the initializer rather than with every chunk
+        """
+        as_csv = self.output_format == 'csv'
+
         n = 0
-        data: List[Dict[str, Any]]  # each dict is a row (i.e. variant)
-        data = []
-        with open(self.vcf) as fh:
-            for line in fh:
-                if line.startswith('#'):
-                    continue
-
-                row = self.__line_to_row(line)
-                data.append(row)
-
-                n += 1
-                if n % self.LOG_INTERVAL == 0:
+        executor = ProcessPoolExecutor(
+            max_workers=self.threads,
+            initializer=set_worker_row_plan,
+            initargs=(self.row_plan,))
+        with open_vcf(self.vcf) as fh, executor:
+            pending = deque()
+            for lines in iter_chunks(fh=fh, size=self.chunk_size):
+                pending.append(executor.submit(parse_chunk_in_worker, lines, as_csv))
+                n += len(lines)
+                self.count_records(len(lines))
+                if len(pending) >= 2 * self.threads:
+                    self.__write_result(pending.popleft().result())
                     self.logger.debug(msg=f'{n} variants parsed')
-                    self.__to_csv(data=data)
-                    data = []  # clear up data
-            self.__to_csv(data=data)  # last partial chunk of data
+            while len(pending) > 0:
+                self.__write_result(pending.popleft().result())
 
-    def __line_to_row(self, line: str) -> Dict[str, Any]:
-        return self.vcf_line_to_row(
-            vcf_line=line,
-            info_id_to_description=self.info_id_to_description)
+        self.table_writer.close()
 
-    def __to_csv(self, data: List[Dict[str, Any]]):
-        self.save_data_to_csv(
-            data=data,
-            all_columns=self.all_columns,
-            csv=self.output_csv
-        )
+    def __write_result(self, result: Union[str, List[List[Any]]]):
+        if isinstance(result, str):
+            self.table_writer.write_text(result)
+        else:
+            self.table_writer.write(result)
+
+
+def open_vcf(vcf: str) -> IO:
+    return gzip.open(vcf, 'rt') if vcf.endswith('.gz') else open(vcf)
+
+
+def read_vcf_header(vcf: str) -> str:
+    ret = ''
+    with open_vcf(vcf) as fh:
+        for line in fh:
+            if not line.startswith('#'):
+                break
+            ret += line
+    return ret
+
+
+def iter_chunks(fh: IO, size: int) -> Iterator[List[str]]:
+    chunk = []
+    for line in fh:
+        if line.startswith('#'):
+            continue
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+_worker_row_plan: Optional['RowPlan'] = None
+
+
+def set_worker_row_plan(row_plan: 'RowPlan'):
+    global _worker_row_plan
+    _worker_row_plan = row_plan
+
+
+def parse_chunk_in_worker(lines: List[str], as_csv: bool) -> Union[str, List[List[Any]]]:
+    return parse_chunk(row_plan=_worker_row_plan, lines=lines, as_csv=as_csv)
+
+
+def parse_chunk(
+        row_plan: 'RowPlan',
+        lines: List[str],
+        as_csv: bool) -> Union[str, List[List[Any]]]:
+    """
+    Returns the rows, or their csv text if as_csv
+    """
+    rows = []
+    for line in lines:
+        rows.extend(row_plan.to_rows(line))
+    if not as_csv:
+        return rows
+    return rows_to_csv(rows)
+
+
+def rows_to_csv(rows: List[List[Any]]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue()
 
 
 class GetInfoIDToDescription(Processor):
@@ -195,146 +343,731 @@ class GetAllColumns(Processor):
                 break
 
 
-class VcfLineToRow(Processor):
+def get_samples(vcf_header: str) -> List[str]:
+    for line in vcf_header.splitlines():
+        if line.startswith('#CHROM'):
+            return line.split('\t')[9:]
+    return []
 
-    vcf_line: str
-    info_id_to_description: Dict[str, str]
 
-    vcf_info: str
-    row: Dict[str, Any]
-
-    def main(
-            self,
-            vcf_line: str,
-            info_id_to_description: Dict[str, str]) -> Dict[str, Any]:
-
-        self.vcf_line = vcf_line
-        self.info_id_to_description = info_id_to_description
-
-        self.unpack_line_and_set_vcf_info()
-        self.parse_vcf_info()
-        self.unroll_annotation()
-
-        return self.row
-
-    def unpack_line_and_set_vcf_info(self):
-        chromosome, position, id_, ref_allele, alt_allele, quality, filter_, info = \
-            self.vcf_line.strip().split('\t')[:8]
-
-        self.row = {
-            'Chromosome': chromosome,
-            'Position': position,
-            'ID': id_,
-            'Ref Allele': ref_allele,
-            'Alt Allele': alt_allele,
-            'Quality': quality,
-            'Filter': filter_,
-        }
-        self.vcf_info = info
-
-    def parse_vcf_info(self):
-        items = self.vcf_info.split(';')
-        for item in items:
-            if '=' in item:
-                key, val = self.__split(item)
-                description = self.info_id_to_description.get(key, None)
+def get_format_ids(vcf_header: str) -> List[str]:
+    return [
+        line.split('FORMAT=<ID=')[1].split(',')[0]
+        for line in vcf_header.splitlines() if line.startswith('##FORMAT')
+    ]
 
-            else:  # there is no '=', this is a flag, without value
-                key, val = item, True
-                description = self.info_id_to_description.get(item, None)
 
-            if description is not None:
-                self.row[description] = val
+def get_sample_format_columns(vcf_header: str) -> List[str]:
+    """
+    '{sample}.{key}' for each sample and each FORMAT key of the header, e.g. 'TUMOR.AD', 'TUMOR.AF', ..., 'NORMAL.DP'
+    """
+    format_ids = get_format_ids(vcf_header)
+    return [f'{sample}.{id_}' for sample in get_samples(vcf_header) for id_ in format_ids]
 
-    def __split(self, item: str) -> Tuple[str, str]:
-        p = item.index('=')
-        id_ = item[0:p]
-        val = item[p+1:]
-        return id_, val
 
-    def unroll_annotation(self):
-        for unroller in [
-            UnrollSnpEffAnnotation(self.settings),
-            UnrollVEPAnnotation(self.settings)
-        ]:
-            self.row = unroller.main(self.row)
+def select_columns(all_columns: List[str], patterns: List[str]) -> List[str]:
+    """
+    Columns matching each glob pattern in turn, duplicate names (e.g. 'Allele' of both ANN and CSQ) are all kept
+    """
+    ret = []
+    for pattern in patterns:
+        matched = [c for c in all_columns if fnmatchcase(c, pattern)]
+        assert len(matched) > 0, f'Column pattern "{pattern}" does not match any column of the vcf'
+        for c in matched:
+            if c not in ret:
+                ret += [c] * all_columns.count(c)
+    return ret
 
 
-class UnrollAnnotation(Processor):
+class AnnotationFormat:
+    """
+    An INFO field whose description lists '|'-separated subfields, each unrolled into its own column
+    """
 
     LEFT_STRIP: str
     RIGHT_STRIP: str
     KEY_SEP: str
     VALUE_SEP: str
+    TRANSCRIPT_SEP = ','
+    CONSEQUENCE_COLUMN: str
+    CANONICAL_COLUMN: Optional[str]
 
-    d: Dict[str, str]
-
-    def main(self, d: Dict[str, str]) -> Dict[str, str]:
-        self.d = d.copy()
+    @classmethod
+    def matches(cls, description: str) -> bool:
+        return description.startswith(cls.LEFT_STRIP)
 
-        keys = list(self.d.keys())
-        for key in keys:
-            if key.startswith(self.LEFT_STRIP):
-                val = self.d.pop(key)
-                self.unroll(key, val)
-
-        return self.d
-
-    def unroll(self, key: str, val: str):
-        keys = key.lstrip(self.LEFT_STRIP).rstrip(self.RIGHT_STRIP).split(self.KEY_SEP)
-        vals = val.split(self.VALUE_SEP)
-        new_dict = {
-            k: v for k, v in zip(keys, vals)
-        }
-        self.d.update(new_dict)
+    @classmethod
+    def get_sub_columns(cls, description: str) -> List[str]:
+        return description.lstrip(cls.LEFT_STRIP).rstrip(cls.RIGHT_STRIP).split(cls.KEY_SEP)
 
 
-class UnrollSnpEffAnnotation(UnrollAnnotation):
+class SnpEffAnnotation(AnnotationFormat):
 
     LEFT_STRIP = "Functional annotations: '"
     RIGHT_STRIP = "' "
     KEY_SEP = ' | '
     VALUE_SEP = '|'
+    CONSEQUENCE_COLUMN = 'Annotation'
+    CANONICAL_COLUMN = None
 
 
-class UnrollVEPAnnotation(UnrollAnnotation):
+class VEPAnnotation(AnnotationFormat):
 
     LEFT_STRIP = 'Consequence annotations from Ensembl VEP. Format: '
     RIGHT_STRIP = ''
     KEY_SEP = '|'
     VALUE_SEP = '|'
+    CONSEQUENCE_COLUMN = 'Consequence'
+    CANONICAL_COLUMN = 'CANONICAL'
+
+
+# Sequence Ontology consequence terms from the most to the least severe (Ensembl VEP order, with SnpEff terms inserted)
+CONSEQUENCE_SEVERITY = [
+    'chromosome_number_variation',
+    'exon_loss_variant',
+    'transcript_ablation',
+    'splice_acceptor_variant',
+    'splice_donor_variant',
+    'stop_gained',
+    'frameshift_variant',
+    'stop_lost',
+    'start_lost',
+    'transcript_amplification',
+    'feature_elongation',
+    'feature_truncation',
+    'inframe_insertion',
+    'disruptive_inframe_insertion',
+    'conservative_inframe_insertion',
+    'inframe_deletion',
+    'disruptive_inframe_deletion',
+    'conservative_inframe_deletion',
+    'missense_variant',
+    'protein_altering_variant',
+    'splice_donor_5th_base_variant',
+    'splice_region_variant',
+    'splice_donor_region_variant',
+    'splice_polypyrimidine_tract_variant',
+    'incomplete_terminal_codon_variant',
+    'initiator_codon_variant',
+    'start_retained_variant',
+    'stop_retained_variant',
+    'synonymous_variant',
+    'coding_sequence_variant',
+    'mature_miRNA_variant',
+    '5_prime_UTR_premature_start_codon_gain_variant',
+    '5_prime_UTR_variant',
+    '3_prime_UTR_variant',
+    'non_coding_transcript_exon_variant',
+    'intron_variant',
+    'NMD_transcript_variant',
+    'non_coding_transcript_variant',
+    'coding_transcript_variant',
+    'upstream_gene_variant',
+    'downstream_gene_variant',
+    'TFBS_ablation',
+    'TFBS_amplification',
+    'TF_binding_site_variant',
+    'regulatory_region_ablation',
+    'regulatory_region_amplification',
+    'regulatory_region_variant',
+    'intragenic_variant',
+    'intergenic_region',
+    'intergenic_variant',
+    'sequence_variant',
+]
+CONSEQUENCE_TO_RANK = {c: i for i, c in enumerate(CONSEQUENCE_SEVERITY)}
+
+
+class RowPlan:
+    """
+    Compiled once from the vcf header: the output column indexes of each base column, INFO ID and ANN/CSQ subfield,
+    so that each vcf line becomes a row of all_columns by one split and direct list assignment.
+    INFO fields and ANN/CSQ subfields without an output column are not in the plan, so they are never assigned,
+    and an annotation field without any output column is not even split into transcripts
+
+    Columns sharing a name (e.g. 'Allele' of both ANN and CSQ) all get the value, and annotation subfields are assigned
+    after plain INFO fields, SnpEff before VEP
+
+    FORMAT fields of sample columns are assigned by a layout of output indexes computed once per distinct FORMAT string
+    (e.g. 'GT:AD:AF:DP'), so the FORMAT keys are not matched again on every line
+
+    Annotation modes for the comma-separated transcripts of ANN/CSQ:
+        'first'        one row per variant, the first transcript
+        'canonical'    one row per variant, the first canonical (CANONICAL=YES) transcript, otherwise the first
+        'most-severe'  one row per variant, the transcript with the most severe consequence, the first if tied
+        'explode'      one row per transcript, transcripts of different annotation fields are paired by order
+    """
+
+    ANNOTATION_MODES = ['first', 'canonical', 'most-severe', 'explode']
+
+    n_columns: int
+    base_indexes: List[List[int]]
+    info_id_to_indexes: Dict[str, List[int]]
+    annotation_id_to_rank: Dict[str, int]  # order of unrolling
+    annotation_id_to_format: Dict[str, type]
+    annotation_id_to_sub_indexes: Dict[str, List[Tuple[int, List[int]]]]  # (subfield position, indexes) of output subfields
+    annotation_id_to_canonical_index: Dict[str, Optional[int]]  # index of the CANONICAL subfield
+    annotation_id_to_consequence_index: Dict[str, Optional[int]]  # index of the Consequence/Annotation subfield
+    annotation_mode: str
+    sample_key_to_indexes: List[Dict[str, List[int]]]  # of each sample column, empty if FORMAT fields are not unrolled
+    format_to_layout: Dict[str, List[List[Tuple[int, List[int]]]]]  # FORMAT string -> (key position, indexes) of each sample
+
+    def __init__(
+            self,
+            n_columns: int,
+            base_indexes: List[List[int]],
+            info_id_to_indexes: Dict[str, List[int]],
+            annotation_id_to_rank: Dict[str, int],
+            annotation_id_to_format: Dict[str, type],
+            annotation_id_to_sub_indexes: Dict[str, List[Tuple[int, List[int]]]],
+            annotation_id_to_canonical_index: Dict[str, Optional[int]],
+            annotation_id_to_consequence_index: Dict[str, Optional[int]],
+            annotation_mode: str,
+            sample_key_to_indexes: List[Dict[str, List[int]]]):
+
+        assert annotation_mode in self.ANNOTATION_MODES, f'Annotation mode "{annotation_mode}" is not one of {self.ANNOTATION_MODES}'
+
+        self.n_columns = n_columns
+        self.base_indexes = base_indexes
+        self.info_id_to_indexes = info_id_to_indexes
+        self.annotation_id_to_rank = annotation_id_to_rank
+        self.annotation_id_to_format = annotation_id_to_format
+        self.annotation_id_to_sub_indexes = annotation_id_to_sub_indexes
+        self.annotation_id_to_canonical_index = annotation_id_to_canonical_index
+        self.annotation_id_to_consequence_index = annotation_id_to_consequence_index
+        self.annotation_mode = annotation_mode
+        self.sample_key_to_indexes = sample_key_to_indexes
+        self.format_to_layout = {}
+
+    def to_rows(self, vcf_line: str) -> List[List[Any]]:
+        """
+        A single row unless annotation transcripts are exploded
+        """
+        row = [None] * self.n_columns
+
+        fields = vcf_line.strip().split('\t', 8)
+        for indexes, value in zip(self.base_indexes, fields[:7]):
+            for i in indexes:
+                row[i] = value
+
+        info_id_to_indexes = self.info_id_to_indexes
+        annotations = []
+        for item in fields[7].split(';'):
+            key, sep, val = item.partition('=')
+            if sep == '':  # there is no '=', this is a flag, without value
+                val = True
+
+            indexes = info_id_to_indexes.get(key)
+            if indexes is not None:
+                for i in indexes:
+                    row[i] = val
+            elif sep != '' and key in self.annotation_id_to_rank:
+                annotations.append((self.annotation_id_to_rank[key], key, val))
+
+        if len(self.sample_key_to_indexes) > 0 and len(fields) > 8:
+            self.__assign_format_fields(row=row, columns=fields[8].split('\t'))
+
+        if len(annotations) == 0:
+            return [row]
+        if len(annotations) > 1:
+            annotations.sort(key=lambda a: a[0])
+
+        key_to_transcripts = [
+            (key, val.split(self.annotation_id_to_format[key].TRANSCRIPT_SEP)) for _, key, val in annotations
+        ]
+
+        if self.annotation_mode == 'explode':
+            rows = []
+            for t in range(max(len(transcripts) for _, transcripts in key_to_transcripts)):
+                r = row.copy()
+                for key, transcripts in key_to_transcripts:
+                    if t < len(transcripts):
+                        self.__assign_annotation(row=r, key=key, vals=self.__split(key, transcripts[t]))
+                rows.append(r)
+            return rows
+
+        for key, transcripts in key_to_transcripts:
+            self.__assign_annotation(row=row, key=key, vals=self.__pick_transcript(key=key, transcripts=transcripts))
+        return [row]
+
+    def __assign_format_fields(self, row: List[Any], columns: List[str]):
+        """
+        columns: FORMAT and the sample columns
+        """
+        layout = self.format_to_layout.get(columns[0])
+        if layout is None:
+            keys = columns[0].split(':')
+            layout = [
+                [(j, key_to_indexes[key]) for j, key in enumerate(keys) if key in key_to_indexes]
+                for key_to_indexes in self.sample_key_to_indexes
+            ]
+            self.format_to_layout[columns[0]] = layout
+
+        for sample_layout, sample in zip(layout, columns[1:]):
+            vals = sample.split(':')
+            n = len(vals)  # trailing fields may be dropped
+            for j, indexes in sample_layout:
+                if j < n:
+                    for i in indexes:
+                        row[i] = vals[j]
+
+    def __split(self, key: str, transcript: str) -> List[str]:
+        return transcript.split(self.annotation_id_to_format[key].VALUE_SEP)
+
+    def __pick_transcript(self, key: str, transcripts: List[str]) -> List[str]:
+        first = self.__split(key, transcripts[0])
+        if self.annotation_mode == 'first' or len(transcripts) == 1:
+            return first
+
+        if self.annotation_mode == 'canonical':
+            i = self.annotation_id_to_canonical_index[key]
+            if i is not None:
+                for transcript in transcripts:
+                    vals = self.__split(key, transcript)
+                    if i < len(vals) and vals[i] == 'YES':
+                        return vals
+            return first
+
+        # most-severe
+        i = self.annotation_id_to_consequence_index[key]
+        if i is None:
+            return first
+        picked, picked_rank = first, None
+        for transcript in transcripts:
+            vals = self.__split(key, transcript)
+            rank = get_severity_rank(vals[i]) if i < len(vals) else len(CONSEQUENCE_SEVERITY)
+            if picked_rank is None or rank < picked_rank:
+                picked, picked_rank = vals, rank
+        return picked
+
+    def __assign_annotation(self, row: List[Any], key: str, vals: List[str]):
+        n = len(vals)
+        for j, indexes in self.annotation_id_to_sub_indexes[key]:
+            if j < n:
+                for i in indexes:
+                    row[i] = vals[j]
+
+
+def get_severity_rank(consequence: str) -> int:
+    """
+    'frameshift_variant&splice_region_variant' -> rank of the most severe term, unknown terms rank last
+    """
+    default = len(CONSEQUENCE_SEVERITY)
+    return min(CONSEQUENCE_TO_RANK.get(term, default) for term in consequence.split('&'))
+
+
+class BuildRowPlan(Processor):
+
+    ANNOTATION_FORMATS = [SnpEffAnnotation, VEPAnnotation]  # unrolled in this order
 
-
-class SaveDataToCsv(Processor):
-
-    data: List[Dict[str, Any]]  # each dict is a row (i.e. variant)
+    info_id_to_description: Dict[str, str]
     all_columns: List[str]
-    csv: str
+    annotation_mode: str
+    samples: List[str]
+    format_ids: List[str]
+
+    column_to_indexes: Dict[str, List[int]]
+    row_plan: RowPlan
 
     def main(
             self,
-            data: List[Dict[str, Any]],
+            info_id_to_description: Dict[str, str],
             all_columns: List[str],
-            csv: str):
+            annotation_mode: str = 'first',
+            samples: Optional[List[str]] = None,
+            format_ids: Optional[List[str]] = None) -> RowPlan:
+        """
+        samples, format_ids: sample columns whose FORMAT fields have '{sample}.{key}' output columns
+        """
+        self.info_id_to_description = info_id_to_description
+        self.all_columns = all_columns
+        self.annotation_mode = annotation_mode
+        self.samples = [] if samples is None else samples
+        self.format_ids = [] if format_ids is None else format_ids
+
+        self.set_column_to_indexes()
+        self.build_row_plan()
+
+        return self.row_plan
+
+    def set_column_to_indexes(self):
+        self.column_to_indexes = {}
+        for i, column in enumerate(self.all_columns):
+            self.column_to_indexes.setdefault(column, []).append(i)
+
+    def build_row_plan(self):
+        info_id_to_indexes = {}
+        annotation_id_to_rank, annotation_id_to_format, annotation_id_to_sub_indexes = {}, {}, {}
+        annotation_id_to_canonical_index, annotation_id_to_consequence_index = {}, {}
+
+        for id_, description in self.info_id_to_description.items():
+            for rank, format_ in enumerate(self.ANNOTATION_FORMATS):
+                if format_.matches(description):
+                    sub_columns = format_.get_sub_columns(description)
+                    sub_indexes = [
+                        (j, self.column_to_indexes[c]) for j, c in enumerate(sub_columns) if c in self.column_to_indexes
+                    ]
+                    if len(sub_indexes) == 0:
+                        break
+                    annotation_id_to_rank[id_] = rank
+                    annotation_id_to_format[id_] = format_
+                    annotation_id_to_sub_indexes[id_] = sub_indexes
+                    annotation_id_to_canonical_index[id_] = get_index(sub_columns, format_.CANONICAL_COLUMN)
+                    annotation_id_to_consequence_index[id_] = get_index(sub_columns, format_.CONSEQUENCE_COLUMN)
+                    break
+            else:
+                if description in self.column_to_indexes:
+                    info_id_to_indexes[id_] = self.column_to_indexes[description]
+
+        self.row_plan = RowPlan(
+            n_columns=len(self.all_columns),
+            base_indexes=[self.column_to_indexes.get(c, []) for c in GetAllColumns.BASE_COLUMNS],
+            info_id_to_indexes=info_id_to_indexes,
+            annotation_id_to_rank=annotation_id_to_rank,
+            annotation_id_to_format=annotation_id_to_format,
+            annotation_id_to_sub_indexes=annotation_id_to_sub_indexes,
+            annotation_id_to_canonical_index=annotation_id_to_canonical_index,
+            annotation_id_to_consequence_index=annotation_id_to_consequence_index,
+            annotation_mode=self.annotation_mode,
+            sample_key_to_indexes=self.get_sample_key_to_indexes())
+
+    def get_sample_key_to_indexes(self) -> List[Dict[str, List[int]]]:
+        ret = []
+        for sample in self.samples:
+            columns = [(key, f'{sample}.{key}') for key in self.format_ids]
+            ret.append({key: self.column_to_indexes[c] for key, c in columns if c in self.column_to_indexes})
+        if all(len(d) == 0 for d in ret):  # no sample column is needed
+            return []
+        return ret
+
+
+def get_index(columns: List[str], column: Optional[str]) -> Optional[int]:
+    return columns.index(column) if column in columns else None
+
+
+class CsvWriter:
+    """
+    Writes rows of all_columns to a new csv file (an existing file is overwritten) with the header once,
+    formatted as pandas.DataFrame.to_csv(index=False) would: minimal quoting, None as empty and flags as True
+    """
+
+    BUFFER_SIZE = 1 << 20  # bytes
+
+    path: str
+    columns: List[str]
+
+    def __init__(self, path: str, columns: List[str]):
+        self.path = path
+        self.columns = columns
+
+        self.__fh = open(path, 'w', buffering=self.BUFFER_SIZE, newline='')
+        self.__writer = csv.writer(self.__fh, lineterminator='\n')
+        self.__writer.writerow(columns)
+
+    def write(self, data: List[List[Any]]):
+        self.__writer.writerows(data)
+
+    def write_text(self, text: str):
+        """
+        Rows already formatted by rows_to_csv
+        """
+        self.__fh.write(text)
 
-        self.data = data
+    def close(self):
+        self.__fh.close()
+
+
+class GetColumnTypes(Processor):
+    """
+    Type of each column of all_columns for columnar output:
+        'int64', 'float64', 'bool', 'dictionary' (dictionary-encoded string) or 'string'
+
+    INFO fields, and '{sample}.{key}' FORMAT fields, are typed by the Type of the header
+    if they have a single value (Number=1, or 0 for flags), multi-valued fields (e.g. Number=A) are kept as strings
+    """
+
+    BASE_COLUMN_TYPES = {
+        'Chromosome': 'dictionary',
+        'Position': 'int64',
+        'Quality': 'float64',
+        'Filter': 'dictionary',
+    }
+    DICTIONARY_COLUMNS = ['Consequence', 'Annotation']  # VEP and SnpEff consequences
+
+    vcf_header: str
+    all_columns: List[str]
+
+    description_to_type: Dict[str, str]
+    column_types: List[str]
+
+    def main(self, vcf_header: str, all_columns: List[str]) -> List[str]:
+        self.vcf_header = vcf_header
         self.all_columns = all_columns
-        self.csv = csv
 
-        self.write_to_csv()
+        self.set_description_to_type()
+        self.set_column_types()
+
+        return self.column_types
+
+    def set_description_to_type(self):
+        self.description_to_type = {}
+        samples = get_samples(self.vcf_header)
+        for line in self.vcf_header.splitlines():
+            if not (line.startswith('##INFO') or line.startswith('##FORMAT')):
+                continue
+            number = line.split('Number=')[1].split(',')[0]
+            type_ = line.split('Type=')[1].split(',')[0]
+
+            if type_ == 'Flag':
+                t = 'bool'
+            elif number == '1' and type_ == 'Integer':
+                t = 'int64'
+            elif number == '1' and type_ == 'Float':
+                t = 'float64'
+            else:
+                t = 'string'
+
+            if line.startswith('##INFO'):
+                description = line.split(',Description="')[1].split('">')[0]
+                self.description_to_type.setdefault(description, t)
+            else:
+                id_ = line.split('FORMAT=<ID=')[1].split(',')[0]
+                for sample in samples:
+                    self.description_to_type.setdefault(f'{sample}.{id_}', t)
+
+    def set_column_types(self):
+        self.column_types = []
+        for column in self.all_columns:
+            if column in self.BASE_COLUMN_TYPES:
+                t = self.BASE_COLUMN_TYPES[column]
+            elif column in self.DICTIONARY_COLUMNS:
+                t = 'dictionary'
+            else:
+                t = self.description_to_type.get(column, 'string')
+            self.column_types.append(t)
+
+
+class ArrowTableWriter:
+    """
+    Writes rows of all_columns as typed columns, one row group (or record batch) per chunk,
+    to .parquet or Arrow IPC (.arrow) files, requires pyarrow
+
+    Duplicate column names get suffixes as in pandas.read_csv, e.g. 'Allele', 'Allele.1'
+    Dictionary-encoded columns keep one growing vocabulary, so each batch only adds new values
+    """
+
+    path: str
+    columns: List[str]
+    column_types: List[str]
+    output_format: str
 
-    def write_to_csv(self):
-        if not exists(self.csv):
-            header = True
+    vocabularies: List[Dict[str, int]]
+
+    def __init__(
+            self,
+            path: str,
+            columns: List[str],
+            column_types: List[str],
+            output_format: str,
+            logger: Logger):
+
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError(f'pyarrow is required for the {output_format} output format, e.g. pip install pyarrow') from e
+
+        self.path = path
+        self.columns = get_unique_column_names(columns)
+        self.column_types = column_types
+        self.output_format = output_format
+
+        self.__pa = pyarrow
+        type_to_arrow_type = {
+            'int64': pyarrow.int64(),
+            'float64': pyarrow.float64(),
+            'bool': pyarrow.bool_(),
+            'dictionary': pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+            'string': pyarrow.string(),
+        }
+        self.__schema = pyarrow.schema([
+            (c, type_to_arrow_type[t]) for c, t in zip(self.columns, self.column_types)
+        ])
+        self.vocabularies = [{} for _ in self.columns]
+        self.__number_parser = NumberParser(columns=self.columns, logger=logger)
+
+        if output_format == 'parquet':
+            self.__writer = pyarrow.parquet.ParquetWriter(path, self.__schema)
         else:
-            header = False
-
-        pd.DataFrame(
-            data=self.data,
-            columns=self.all_columns
-        ).to_csv(
-            self.csv,
-            mode='a',
-            header=header,
-            index=False
-        )
+            self.__writer = pyarrow.ipc.new_file(
+                path, self.__schema, options=pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def write(self, data: List[List[Any]]):
+        if len(data) == 0:
+            return
+        arrays = [
+            self.__to_array(values=[row[i] for row in data], i=i)
+            for i in range(len(self.columns))
+        ]
+        batch = self.__pa.record_batch(arrays, schema=self.__schema)
+        if self.output_format == 'parquet':
+            self.__writer.write_table(self.__pa.Table.from_batches([batch]))
+        else:
+            self.__writer.write_batch(batch)
+
+    def __to_array(self, values: List[Any], i: int):
+        pa = self.__pa
+        t = self.column_types[i]
+        if t == 'int64':
+            return pa.array(self.__number_parser.parse(values=values, i=i, convert=int), type=pa.int64())
+        if t == 'float64':
+            return pa.array(self.__number_parser.parse(values=values, i=i, convert=float), type=pa.float64())
+        if t == 'bool':
+            return pa.array([v is True for v in values], type=pa.bool_())
+        if t == 'dictionary':
+            vocabulary = self.vocabularies[i]
+            indices = [None if v is None else vocabulary.setdefault(v, len(vocabulary)) for v in values]
+            return pa.DictionaryArray.from_arrays(
+                pa.array(indices, type=pa.int32()), pa.array(list(vocabulary.keys()), type=pa.string()))
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+    def close(self):
+        self.__writer.close()
+
+
+class SqliteWriter:
+    """
+    Writes rows of all_columns into the table 'variants' of a new SQLite database,
+    one executemany transaction per chunk with the rollback journal and fsync turned off (a failed run leaves a broken file)
+
+    Columns are typed as GetColumnTypes (INTEGER, REAL or TEXT, flags as 0/1), and named as ArrowTableWriter does.
+    Indexes on (Chromosome, Position), the gene symbol and the consequence are built after loading
+    """
+
+    TABLE = 'variants'
+    COLUMN_TYPE_TO_SQL_TYPE = {
+        'int64': 'INTEGER',
+        'float64': 'REAL',
+        'bool': 'INTEGER',
+        'dictionary': 'TEXT',
+        'string': 'TEXT',
+    }
+    REGION_COLUMNS = ['Chromosome', 'Position']
+    GENE_COLUMNS = ['SYMBOL', 'Gene_Name']  # VEP, SnpEff
+    CONSEQUENCE_COLUMNS = ['Consequence', 'Annotation']  # VEP, SnpEff
+
+    path: str
+    columns: List[str]
+    column_types: List[str]
+
+    def __init__(
+            self,
+            path: str,
+            columns: List[str],
+            column_types: List[str],
+            logger: Logger):
+
+        self.path = path
+        self.columns = get_unique_column_names(columns)
+        self.column_types = column_types
+
+        if exists(path):
+            remove(path)
+
+        self.__con = sqlite3.connect(path, isolation_level=None)  # transactions are explicit
+        self.__con.execute('PRAGMA journal_mode = OFF')
+        self.__con.execute('PRAGMA synchronous = OFF')
+
+        definitions = ', '.join(
+            f'{quote(c)} {self.COLUMN_TYPE_TO_SQL_TYPE[t]}' for c, t in zip(self.columns, self.column_types))
+        self.__con.execute(f'CREATE TABLE {self.TABLE} ({definitions})')
+
+        placeholders = ', '.join('?' for _ in self.columns)
+        self.__insert = f'INSERT INTO {self.TABLE} VALUES ({placeholders})'
+
+        converters = {
+            'int64': int,
+            'float64': float,
+        }
+        self.__number_parser = NumberParser(columns=self.columns, logger=logger)
+        self.__number_converters = [(i, converters[t]) for i, t in enumerate(self.column_types) if t in converters]
+        self.__flag_indexes = [i for i, t in enumerate(self.column_types) if t == 'bool']
+
+    def write(self, data: List[List[Any]]):
+        for i, convert in self.__number_converters:
+            numbers = self.__number_parser.parse(values=[row[i] for row in data], i=i, convert=convert)
+            for row, number in zip(data, numbers):
+                row[i] = number
+        if len(self.__flag_indexes) > 0:
+            for row in data:
+                for i in self.__flag_indexes:
+                    row[i] = to_flag(row[i])
+        self.__con.execute('BEGIN')
+        self.__con.executemany(self.__insert, data)
+        self.__con.execute('COMMIT')
+
+    def close(self):
+        for columns in [self.REGION_COLUMNS] + [[c] for c in self.GENE_COLUMNS + self.CONSEQUENCE_COLUMNS]:
+            if all(c in self.columns for c in columns):
+                index = 'idx_' + '_'.join(c.lower() for c in columns)
+                self.__con.execute(f'CREATE INDEX {index} ON {self.TABLE} ({", ".join(quote(c) for c in columns)})')
+        self.__con.close()
+
+
+def quote(column: str) -> str:
+    return '"' + column.replace('"', '""') + '"'
+
+
+class NumberParser:
+    """
+    Integer/Float values of typed outputs, missing values ('', '.') and values that cannot be parsed
+    (e.g. 'NA' written by some annotators) are None, the latter logged once per column
+    """
+
+    columns: List[str]
+    logger: Logger
+
+    warned: Set[int]
+
+    def __init__(self, columns: List[str], logger: Logger):
+        self.columns = columns
+        self.logger = logger
+        self.warned = set()
+
+    def parse(self, values: List[Any], i: int, convert: type) -> List[Optional[Union[int, float]]]:
+        ret = []
+        for v in values:
+            if v is None or v in ('', '.'):
+                ret.append(None)
+                continue
+            try:
+                ret.append(convert(v))
+            except ValueError:
+                ret.append(None)
+                self.__warn(i=i, v=v, convert=convert)
+        return ret
+
+    def __warn(self, i: int, v: Any, convert: type):
+        if i in self.warned:
+            return
+        self.warned.add(i)
+        self.logger.info(
+            f'Column "{self.columns[i]}" has a value "{v}" that is not {convert.__name__}, written as null '
+            f'(other such values of the column are not reported)')
+
+
+def to_flag(v: Any) -> int:
+    return int(v is True)
+
+
+def get_unique_column_names(columns: List[str]) -> List[str]:
+    ret, seen = [], {}
+    for c in columns:
+        if c in seen:
+            seen[c] += 1
+            ret.append(f'{c}.{seen[c]}')
+        else:
+            seen[c] = 0
+            ret.append(c)
+    return ret
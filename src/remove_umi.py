@@ -30,7 +30,7 @@ class RemoveUmiAndAdapter(Processor):
 
         self.logger.info(f'Start removing UMI ({self.umi_length} bp) and universal adapters of "{self.fq1}" and "{self.fq2}"...')
 
-        total_1, total_2, remain_1, remain_2 = 0, 0, 0, 0
+        n_pairs, total_1, total_2, remain_1, remain_2 = 0, 0, 0, 0, 0
         while True:
             header1 = self.fq1_reader.readline().strip()
             header2 = self.fq2_reader.readline().strip()
@@ -39,6 +39,7 @@ class RemoveUmiAndAdapter(Processor):
                 break
 
             assert header1.split()[0] == header2.split()[0]
+            n_pairs += 1
 
             seq1 = self.fq1_reader.readline().strip()
             seq2 = self.fq2_reader.readline().strip()
@@ -74,6 +75,7 @@ class RemoveUmiAndAdapter(Processor):
             self.fq2_writer.write(qual2 + '\n')
 
         self.close_files()
+        self.count_records(n_pairs)
 
         self.logger.info(f'''\
 {self.fq1} ({total_1:,} bp) -> ({remain_1:,} bp = {remain_1/total_1*100:.2f}%) {self.out_fq1}
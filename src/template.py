@@ -1,6 +1,15 @@
+import os
+import sys
+import time
 import subprocess
 from abc import ABC
+from functools import wraps
 from datetime import datetime
+from typing import Dict, List, Optional, Any
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
 
 
 class Settings:
@@ -50,6 +59,169 @@ class Logger:
         print(msg + '\n', flush=True)
 
 
+class Span:
+    """
+    Resources used by all calls of one Processor class under the same parent span:
+        calls, wall and CPU time (seconds), CPU time of terminated child processes (e.g. process pools),
+        peak RSS of the process at the end of the calls (bytes), bytes read and written (/proc/self/io, Linux only),
+        and the number of records processed as counted by the processor
+    """
+
+    name: str
+    calls: int
+    wall_time: float
+    cpu_time: float
+    children_cpu_time: float
+    peak_rss: int
+    bytes_read: int
+    bytes_written: int
+    records: int
+    children: Dict[str, 'Span']
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.children_cpu_time = 0.
+        self.peak_rss = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.records = 0
+        self.children = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'calls': self.calls,
+            'wall_time': round(self.wall_time, 6),
+            'cpu_time': round(self.cpu_time, 6),
+            'children_cpu_time': round(self.children_cpu_time, 6),
+            'peak_rss': self.peak_rss,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'records': self.records,
+            'children': [c.to_dict() for c in self.children.values()],
+        }
+
+
+class Instrumentation:
+    """
+    Process-wide tree of spans, one span per Processor class under its calling processor (see Processor.__init_subclass__)
+
+    With a profile directory, each stage (a processor called directly by the processor of the command)
+    is profiled with cProfile, and the stats of all its calls are dumped to '{profile_dir}/{stage}.prof'
+    """
+
+    root: Span
+    stack: List[Span]
+    profile_dir: Optional[str]
+    profilers: Dict[str, Any]
+
+    start_time: str
+    __start: Dict[str, float]
+
+    def __init__(self):
+        self.start(command='run', profile_dir=None)
+
+    def start(self, command: str, profile_dir: Optional[str]):
+        self.root = Span(name=command)
+        self.stack = [self.root]
+        self.profile_dir = profile_dir
+        self.profilers = {}
+        self.start_time = datetime.now().isoformat()
+        self.__start = measure()
+
+    def stop(self):
+        self.__add(span=self.root, start=self.__start, end=measure())
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for name, profiler in self.profilers.items():
+                profiler.dump_stats(f'{self.profile_dir}/{name}.prof')
+
+    def enter(self, name: str) -> Dict[str, float]:
+        parent = self.stack[-1]
+        span = parent.children.get(name)
+        if span is None:
+            span = parent.children[name] = Span(name=name)
+        self.stack.append(span)
+
+        if self.profile_dir is not None and len(self.stack) == 3:  # root, command, stage
+            if name not in self.profilers:
+                import cProfile
+                self.profilers[name] = cProfile.Profile()
+            self.profilers[name].enable()
+
+        return measure()
+
+    def exit(self, start: Dict[str, float]):
+        end = measure()
+        if self.profile_dir is not None and len(self.stack) == 3:
+            self.profilers[self.stack[-1].name].disable()
+        self.__add(span=self.stack.pop(), start=start, end=end)
+
+    def __add(self, span: Span, start: Dict[str, float], end: Dict[str, float]):
+        span.calls += 1
+        span.wall_time += end['wall_time'] - start['wall_time']
+        span.cpu_time += end['cpu_time'] - start['cpu_time']
+        span.children_cpu_time += end['children_cpu_time'] - start['children_cpu_time']
+        span.peak_rss = max(span.peak_rss, int(end['peak_rss']))
+        span.bytes_read += int(end['bytes_read'] - start['bytes_read'])
+        span.bytes_written += int(end['bytes_written'] - start['bytes_written'])
+
+    def count_records(self, n: int):
+        self.stack[-1].records += n
+
+    def write_json(self, path: str, **kwargs):
+        import json
+        manifest = {
+            'start_time': self.start_time,
+            **kwargs,
+            'profile_dir': self.profile_dir,
+            'spans': self.root.to_dict(),
+        }
+        with open(path, 'w') as fh:
+            json.dump(manifest, fh, indent=2)
+
+
+def measure() -> Dict[str, float]:
+    ret = {
+        'wall_time': time.perf_counter(),
+        'cpu_time': time.process_time(),
+        'children_cpu_time': 0.,
+        'peak_rss': 0,
+        'bytes_read': 0,
+        'bytes_written': 0,
+    }
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        ret['children_cpu_time'] = children.ru_utime + children.ru_stime
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ret['peak_rss'] = maxrss if sys.platform == 'darwin' else maxrss * 1024  # bytes on macOS, kilobytes on Linux
+    try:
+        with open('/proc/self/io') as fh:
+            key_to_value = dict(line.split(': ') for line in fh.read().splitlines())
+        ret['bytes_read'] = int(key_to_value['rchar'])
+        ret['bytes_written'] = int(key_to_value['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return ret
+
+
+INSTRUMENTATION = Instrumentation()
+
+
+def instrument(main):
+    @wraps(main)
+    def wrapper(self: 'Processor', *args, **kwargs):
+        start = INSTRUMENTATION.enter(name=self.__class__.__name__)
+        try:
+            return main(self, *args, **kwargs)
+        finally:
+            INSTRUMENTATION.exit(start)
+    return wrapper
+
+
 class Processor(ABC):
 
     CMD_LINEBREAK = ' \\\n  '
@@ -77,6 +249,20 @@ class Processor(ABC):
             level=Logger.DEBUG if self.debug else Logger.INFO
         )
 
+    def __init_subclass__(cls, **kwargs):
+        """
+        Each main() is a span of INSTRUMENTATION
+        """
+        super().__init_subclass__(**kwargs)
+        if 'main' in cls.__dict__:
+            cls.main = instrument(cls.main)
+
+    def count_records(self, n: int):
+        """
+        Adds n records (e.g. variants) processed to the current span
+        """
+        INSTRUMENTATION.count_records(n)
+
     def call(self, cmd: str):
         self.logger.info(cmd)
         if not self.mock:
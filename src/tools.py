@@ -1,6 +1,10 @@
 import os
 import gzip
-from typing import Optional, List, IO, Dict, Any
+import zlib
+import mmap
+import struct
+from bisect import bisect_right
+from typing import Optional, List, IO, Dict, Any, Iterator, Tuple
 
 
 def edit_fpath(
@@ -130,6 +134,360 @@ class VcfWriter:
         self.__fh.close()
 
 
+class BgzfReader:
+    """
+    Random access reader of a BGZF-compressed text file, e.g. vcf.gz, by virtual offsets
+    """
+
+    __fh: IO
+    __buffer: bytes
+    __pos: int
+
+    def __init__(self, path: str):
+        self.__fh = open(path, 'rb')
+        self.__buffer = b''
+        self.__pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def seek(self, virtual_offset: int):
+        """
+        virtual_offset = compressed block offset << 16 | offset within the uncompressed block
+        """
+        self.__fh.seek(virtual_offset >> 16)
+        self.__buffer = self.__read_block()
+        self.__pos = virtual_offset & 0xFFFF
+
+    def __read_block(self) -> bytes:
+        header = self.__fh.read(18)
+        if len(header) < 18:  # end of file
+            return b''
+        block_size = struct.unpack('<H', header[16:18])[0] + 1  # BSIZE of the 'BC' extra subfield
+        data = header + self.__fh.read(block_size - 18)
+        return zlib.decompress(data, 31)  # 31: gzip wrapper
+
+    def readline(self) -> str:
+        chunks = []
+        while True:
+            end = self.__buffer.find(b'\n', self.__pos)
+            if end != -1:
+                chunks.append(self.__buffer[self.__pos:end + 1])
+                self.__pos = end + 1
+                break
+
+            chunks.append(self.__buffer[self.__pos:])
+            self.__buffer = self.__read_block()
+            self.__pos = 0
+            if self.__buffer == b'':  # end of file
+                break
+
+        return b''.join(chunks).decode()
+
+    def close(self):
+        self.__fh.close()
+
+
+class TabixReader:
+    """
+    Region queries on a bgzipped, tabix-indexed vcf.gz without loading the file into memory
+    """
+
+    MIN_SHIFT = 14
+    BIN_LEVELS = [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]  # (shift, first bin of the level)
+
+    vcf: str
+
+    names: List[str]
+    name_to_bins: Dict[str, Dict[int, List[Tuple[int, int]]]]
+    name_to_linear_index: Dict[str, List[int]]
+
+    __reader: BgzfReader
+
+    def __init__(self, vcf: str):
+        self.vcf = vcf
+        self.__read_index()
+        self.__reader = BgzfReader(vcf)
+
+    def __read_index(self):
+        with open(f'{self.vcf}.tbi', 'rb') as fh:
+            data = gzip.decompress(fh.read())
+
+        assert data[:4] == b'TBI\1', f'"{self.vcf}.tbi" is not a tabix index'
+        n_ref = struct.unpack_from('<i', data, 4)[0]
+        l_nm = struct.unpack_from('<i', data, 32)[0]
+        self.names = data[36:36 + l_nm].decode().rstrip('\0').split('\0')
+
+        self.name_to_bins, self.name_to_linear_index = {}, {}
+        p = 36 + l_nm
+        for name in self.names[:n_ref]:
+            bins = {}
+            n_bin = struct.unpack_from('<i', data, p)[0]
+            p += 4
+            for _ in range(n_bin):
+                bin_, n_chunk = struct.unpack_from('<Ii', data, p)
+                p += 8
+                bins[bin_] = [struct.unpack_from('<QQ', data, p + 16 * i) for i in range(n_chunk)]
+                p += 16 * n_chunk
+
+            n_intv = struct.unpack_from('<i', data, p)[0]
+            p += 4
+            linear_index = list(struct.unpack_from(f'<{n_intv}Q', data, p))
+            p += 8 * n_intv
+
+            self.name_to_bins[name] = bins
+            self.name_to_linear_index[name] = linear_index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def fetch(self, chrom: str, start: int, end: int) -> Iterator[str]:
+        """
+        Yields vcf lines of chrom with start <= POS <= end (1-based, inclusive)
+        """
+        offset = self.__get_start_offset(chrom=chrom, beg=start - 1, end=end)
+        if offset is None:
+            return
+
+        self.__reader.seek(offset)
+        while True:
+            line = self.__reader.readline()
+            if line == '':
+                break
+            if line.startswith('#'):
+                continue
+
+            c, pos = line.split('\t', 2)[:2]
+            pos = int(pos)
+            if c != chrom or pos > end:  # sorted file, nothing more of the region
+                break
+            if pos >= start:
+                yield line
+
+    def __get_start_offset(self, chrom: str, beg: int, end: int) -> Optional[int]:
+        bins = self.name_to_bins.get(chrom)
+        if bins is None:
+            return None
+
+        linear_index = self.name_to_linear_index[chrom]
+        i = beg >> self.MIN_SHIFT
+        min_offset = linear_index[min(i, len(linear_index) - 1)] if len(linear_index) > 0 else 0
+
+        offsets = []
+        for bin_ in self.__reg2bins(beg=beg, end=end):
+            for chunk_beg, chunk_end in bins.get(bin_, []):
+                if chunk_end > min_offset:
+                    offsets.append(max(chunk_beg, min_offset))
+
+        return min(offsets) if len(offsets) > 0 else None
+
+    def __reg2bins(self, beg: int, end: int) -> List[int]:
+        """
+        0-based, half-open [beg, end)
+        """
+        end -= 1
+        bins = [0]
+        for shift, first_bin in self.BIN_LEVELS:
+            bins += range(first_bin + (beg >> shift), first_bin + (end >> shift) + 1)
+        return bins
+
+    def close(self):
+        self.__reader.close()
+
+
+class FaiRecord:
+    """
+    One line of a samtools .fai index
+    """
+
+    def __init__(
+            self,
+            name: str,
+            length: int,
+            offset: int,
+            line_bases: int,
+            line_width: int):
+
+        self.name = name
+        self.length = length
+        self.offset = offset
+        self.line_bases = line_bases
+        self.line_width = line_width
+
+    def __repr__(self):
+        return f"FaiRecord(name='{self.name}', length={self.length}, offset={self.offset}, line_bases={self.line_bases}, line_width={self.line_width})"
+
+
+def read_fai(fai: str) -> List[FaiRecord]:
+    records = []
+    with open(fai) as fh:
+        for line in fh:
+            name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+            records.append(FaiRecord(
+                name=name,
+                length=int(length),
+                offset=int(offset),
+                line_bases=int(line_bases),
+                line_width=int(line_width)))
+    return records
+
+
+def build_fai(fa: str) -> List[FaiRecord]:
+    """
+    Indexes the fasta in a single pass, same as `samtools faidx`
+    """
+    records = []
+    offset = 0
+    with open(fa, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                name = line[1:].split()[0].decode()
+                records.append(FaiRecord(name=name, length=0, offset=offset + len(line), line_bases=0, line_width=0))
+            else:
+                record = records[-1]
+                if record.line_width == 0:  # first sequence line of the contig
+                    record.line_bases = len(line.rstrip(b'\r\n'))
+                    record.line_width = len(line)
+                record.length += len(line.rstrip(b'\r\n'))
+            offset += len(line)
+    return records
+
+
+def write_fai(records: List[FaiRecord], fai: str):
+    """
+    Written to a temp file and then renamed, so that a failed write never leaves a truncated .fai,
+    which would be newer than the fasta and thus taken as valid
+    """
+    tmp = f'{fai}.tmp'
+    try:
+        with open(tmp, 'w') as fh:
+            for r in records:
+                fh.write(f'{r.name}\t{r.length}\t{r.offset}\t{r.line_bases}\t{r.line_width}\n')
+        os.replace(tmp, fai)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class IndexedFasta:
+    """
+    Random access to an uncompressed fasta through its .fai index and a read-only memory map,
+    sequences are never loaded into memory
+    """
+
+    name_to_record: Dict[str, FaiRecord]
+
+    __fh: IO
+    __mm: mmap.mmap
+
+    def __init__(self, fa: str, records: List[FaiRecord]):
+        self.name_to_record = {r.name: r for r in records}
+        self.__fh = open(fa, 'rb')
+        self.__mm = mmap.mmap(self.__fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __contains__(self, chrom: str) -> bool:
+        return chrom in self.name_to_record
+
+    def fetch(self, chrom: str, start: int, end: int) -> str:
+        """
+        Upper-case sequence of chrom[start:end], 0-based, half-open, clipped to the contig
+        """
+        r = self.name_to_record[chrom]
+        start, end = max(0, start), min(end, r.length)
+        if start >= end:
+            return ''
+
+        s = r.offset + start // r.line_bases * r.line_width + start % r.line_bases
+        e = r.offset + (end - 1) // r.line_bases * r.line_width + (end - 1) % r.line_bases + 1
+        return self.__mm[s:e].replace(b'\n', b'').replace(b'\r', b'').decode().upper()
+
+    def close(self):
+        self.__mm.close()
+        self.__fh.close()
+
+
+def get_contig_to_order(vcf_header: str) -> Dict[str, int]:
+    """
+    ##contig=<ID=chr1,length=248956422>  ->  {'chr1': 0, ...}
+    """
+    contig_to_order = {}
+    for line in vcf_header.splitlines():
+        if line.startswith('##contig=<ID='):
+            contig = line[len('##contig=<ID='):].split(',')[0].rstrip('>')
+            contig_to_order[contig] = len(contig_to_order)
+    return contig_to_order
+
+
+class IntervalIndex:
+    """
+    Intervals of a BED file, sorted and merged per contig, for point queries by binary search
+    """
+
+    bed: str
+
+    chrom_to_starts: Dict[str, List[int]]  # 0-based
+    chrom_to_ends: Dict[str, List[int]]  # exclusive
+
+    def __init__(self, bed: str):
+        self.bed = bed
+
+        chrom_to_intervals = {}
+        fh = gzip.open(bed, 'rt') if bed.endswith('.gz') else open(bed)
+        with fh:
+            for line in fh:
+                if line.strip() == '' or line.startswith(('#', 'track', 'browser')):
+                    continue
+                chrom, start, end = line.split()[:3]
+                chrom_to_intervals.setdefault(chrom, []).append((int(start), int(end)))
+
+        self.chrom_to_starts, self.chrom_to_ends = {}, {}
+        for chrom, intervals in chrom_to_intervals.items():
+            starts, ends = [], []
+            for start, end in sorted(intervals):
+                if len(ends) > 0 and start <= ends[-1]:  # overlapping or adjacent
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.chrom_to_starts[chrom] = starts
+            self.chrom_to_ends[chrom] = ends
+
+    def contains(self, chrom: str, pos: int) -> bool:
+        """
+        pos is 1-based
+        """
+        starts = self.chrom_to_starts.get(chrom)
+        if starts is None:
+            return False
+        i = bisect_right(starts, pos - 1) - 1
+        return i >= 0 and pos - 1 < self.chrom_to_ends[chrom][i]
+
+    def iter_regions(self, chroms: List[str]) -> Iterator[Tuple[str, int, int]]:
+        """
+        Yields (chrom, start, end), 1-based and inclusive as for TabixReader.fetch,
+        in the order of chroms, then the other contigs of the bed
+        """
+        chrom_set = set(chroms)
+        ordered = [c for c in chroms if c in self.chrom_to_starts]
+        ordered += [c for c in self.chrom_to_starts if c not in chrom_set]
+        for chrom in ordered:
+            for start, end in zip(self.chrom_to_starts[chrom], self.chrom_to_ends[chrom]):
+                yield chrom, start + 1, end
+
+
 def rev_comp(seq: str) -> str:
     """
     Returns reverse complementary sequence of the input DNA string
@@ -168,3 +526,20 @@ def rev_comp(seq: str) -> str:
         'h': 'd'
     }
     return ''.join([comp[base] for base in seq[::-1]])
+
+
+def parse_region(region: str) -> Tuple[str, Optional[int], Optional[int]]:
+    """
+    'chr1:100-200' -> ('chr1', 100, 200), 1-based inclusive
+    'chr1:100'     -> ('chr1', 100, 100)
+    'chr1'         -> ('chr1', None, None)
+    """
+    if ':' not in region:
+        return region, None, None
+    chrom, interval = region.rsplit(':', 1)
+    interval = interval.replace(',', '')
+    if '-' in interval:
+        start, end = interval.split('-', 1)
+    else:
+        start = end = interval
+    return chrom, int(start), int(end)
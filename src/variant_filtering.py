@@ -1,6 +1,10 @@
+import gzip
+import numpy as np
+from os.path import exists, getsize
 from .template import Processor
-from .tools import edit_fpath, VcfWriter, VcfParser
-from typing import Dict, Any, Optional, Tuple, List, IO
+from .vcf_cache import VcfColumnCache, GetVcfColumnCache, open_binary
+from .tools import edit_fpath, VcfWriter, VcfParser, TabixReader, get_contig_to_order
+from typing import Dict, Any, Optional, Tuple, List, IO, Union
 
 
 class Criterion:
@@ -10,40 +14,67 @@ class Criterion:
             key: str,
             range: Tuple[float, float],
             equal_max: bool,
-            equal_min: bool):
+            equal_min: bool,
+            description: str):
 
         self.key = key
         self.range = range
         self.equal_max = equal_max
         self.equal_min = equal_min
+        self.description = description
 
     def __repr__(self):
         return f"Criterion(key='{self.key}', range={self.range}, equal_max={self.equal_max}, equal_min={self.equal_min})"
 
 
+class KnownSitesCriterion:
+
+    def __init__(
+            self,
+            sites: str,
+            criterion: Optional[Criterion],
+            description: str):
+
+        self.sites = sites
+        self.criterion = criterion
+        self.description = description
+
+    def __repr__(self):
+        return f"KnownSitesCriterion(sites='{self.sites}', criterion={self.criterion})"
+
+
 class FlagVariants(Processor):
 
     vcf: str
-    variant_flagging_criteria: str
+    flag_to_criterion: Dict[str, Union[Criterion, KnownSitesCriterion]]
+    use_cache: bool
 
     parser: VcfParser
     writer: VcfWriter
     new_header_lines: List[str]
-    flag_to_criterion: Dict[str, Criterion]
+    cache: Optional[VcfColumnCache]
+    flag_to_lookup: Dict[str, 'KnownSitesLookup']
     output_vcf: str
 
     def main(
             self,
             vcf: str,
-            variant_flagging_criteria: str) -> str:
+            flag_to_criterion: Dict[str, Union[Criterion, KnownSitesCriterion]],
+            use_cache: bool) -> str:
 
         self.vcf = vcf
-        self.variant_flagging_criteria = variant_flagging_criteria.replace(' ', '')
+        self.flag_to_criterion = flag_to_criterion
+        self.use_cache = use_cache
 
         self.open_files()
-        self.unpack_variant_flagging_criteria()
+        self.set_new_header_lines()
+        self.set_cache()
+        self.open_known_sites()
         self.write_header()
-        self.flag_variants()
+        if self.cache is None:
+            self.flag_variants()
+        else:
+            self.flag_variants_by_cache()
         self.close_files()
 
         return self.output_vcf
@@ -57,17 +88,11 @@ class FlagVariants(Processor):
             dstdir=self.workdir)
         self.writer = VcfWriter(self.output_vcf)
 
-    def unpack_variant_flagging_criteria(self):
-        self.new_header_lines = []
-        self.flag_to_criterion = {}
-
-        for item in self.variant_flagging_criteria.split(','):
-            flag, criterion = item.split(':')
-
-            self.new_header_lines.append(f'##FILTER=<ID={flag},Description="{criterion}">')
-
-            self.flag_to_criterion[flag] = parse_criterion(s=criterion)
-
+    def set_new_header_lines(self):
+        self.new_header_lines = [
+            f'##FILTER=<ID={flag},Description="{criterion.description}">'
+            for flag, criterion in self.flag_to_criterion.items()
+        ]
         self.__log()
 
     def __log(self):
@@ -75,23 +100,116 @@ class FlagVariants(Processor):
         msg = f'Flag variants in "{self.vcf}" with criteria:\n{t}'
         self.logger.info(msg)
 
+    def set_cache(self):
+        self.cache = None
+        if not self.use_cache:
+            return
+
+        for criterion in self.flag_to_criterion.values():
+            if isinstance(criterion, KnownSitesCriterion):
+                self.logger.info('Known sites criteria cannot be evaluated from the column cache')
+                return
+
+        cache = GetVcfColumnCache(self.settings).main(vcf=self.vcf)
+        if cache is None:
+            return
+
+        for criterion in self.flag_to_criterion.values():
+            if cache.get_values(key=criterion.key) is None:
+                self.logger.info(f'"{criterion.key}" is not a numeric column in the column cache')
+                return
+
+        self.cache = cache
+
+    def open_known_sites(self):
+        self.flag_to_lookup = {}
+        for flag, criterion in self.flag_to_criterion.items():
+            if isinstance(criterion, KnownSitesCriterion):
+                self.flag_to_lookup[flag] = KnownSitesLookup(self.settings).main(
+                    sites=criterion.sites,
+                    vcf=self.vcf,
+                    vcf_header=self.parser.header)
+
     def write_header(self):
         lines = self.parser.header.splitlines()
         lines = lines[0:1] + self.new_header_lines + lines[1:]
         self.writer.write_header('\n'.join(lines))
 
     def flag_variants(self):
+        n = 0
         for variant in self.parser:
             for flag, criterion in self.flag_to_criterion.items():
-                variant = flag_variant(
-                    variant=variant,
-                    flag=flag,
-                    criterion=criterion)
+                if isinstance(criterion, KnownSitesCriterion):
+                    variant = flag_known_site(
+                        variant=variant,
+                        flag=flag,
+                        criterion=criterion,
+                        lookup=self.flag_to_lookup[flag])
+                else:
+                    variant = flag_variant(
+                        variant=variant,
+                        flag=flag,
+                        criterion=criterion)
             self.writer.write(variant=variant)
+            n += 1
+        self.count_records(n)
+
+    def flag_variants_by_cache(self):
+        """
+        Criteria are evaluated on the memory-mapped columns,
+        the vcf text is only read to copy out lines, with FILTER rewritten for flagged lines
+
+        The column cache of the output vcf is written along the way,
+        so that RemoveVariants does not need to parse the text either
+        """
+        flags = list(self.flag_to_criterion.keys())
+
+        flag_bits = np.zeros(self.cache.n_variants, dtype=np.int64)
+        for i, flag in enumerate(flags):
+            criterion = self.flag_to_criterion[flag]
+            mask = in_range(val=self.cache.get_values(key=criterion.key), criterion=criterion)
+            flag_bits |= mask.astype(np.int64) << i
+
+        # output FILTER vocabulary of all (input FILTER, flag bits) combinations
+        combinations, filter_codes = np.unique(
+            self.cache.filter_codes.astype(np.int64) << len(flags) | flag_bits,
+            return_inverse=True)
+        filters = []
+        for c in combinations.tolist():
+            filter_ = self.cache.filters[c >> len(flags)]
+            filters.append(append_flags(
+                filter_=filter_,
+                flags=[flag for i, flag in enumerate(flags) if c >> i & 1]))
+
+        self.writer.close()  # header has been written, variant lines are copied as bytes
+        offset = getsize(self.output_vcf)
+        offsets = np.empty(self.cache.n_variants, dtype=np.int64)
+
+        with open_binary(self.vcf) as reader, open(self.output_vcf, 'ab') as writer:
+            if self.cache.n_variants > 0:
+                reader.seek(int(self.cache.offsets[0]))
+            for i, (line, bits, code) in enumerate(zip(reader, flag_bits.tolist(), filter_codes.tolist())):
+                if bits:
+                    fields = line.split(b'\t', 7)
+                    fields[6] = filters[code].encode()
+                    line = b'\t'.join(fields)
+                offsets[i] = offset
+                offset += len(line)
+                writer.write(line)
+        self.count_records(self.cache.n_variants)
+
+        VcfColumnCache(self.output_vcf).save(
+            offsets=offsets,
+            qual=self.cache.qual,
+            filter_codes=filter_codes,
+            filters=filters,
+            key_to_info={key: self.cache.get_values(key) for key in self.cache.info_keys})
 
     def close_files(self):
         self.parser.close()
         self.writer.close()
+        for lookup in self.flag_to_lookup.values():
+            lookup.close()
 
 
 def flag_variant(
@@ -101,11 +219,29 @@ def flag_variant(
 
     variant = variant.copy()
 
-    val = get_info_value(variant=variant, key=criterion.key)
+    if criterion.key == 'QUAL':
+        val = None if variant['QUAL'] == '.' else float(variant['QUAL'])
+    else:
+        val = get_info_value(variant=variant, key=criterion.key)
 
     if val is None:
         return variant
 
+    if in_range(val=val, criterion=criterion):
+        variant['FILTER'] += f';{flag}'
+
+    if variant['FILTER'].startswith('.;'):
+        variant['FILTER'] = variant['FILTER'][2:]
+
+    return variant
+
+
+def in_range(
+        val: Union[float, np.ndarray],
+        criterion: Criterion) -> Union[bool, np.ndarray]:
+    """
+    val can be a number or an array of numbers (NaN is never in range)
+    """
     min_, max_ = criterion.range
 
     if criterion.equal_max:
@@ -118,7 +254,46 @@ def flag_variant(
     else:
         more_than_min = min_ < val
 
-    if less_than_max and more_than_min:
+    return less_than_max & more_than_min
+
+
+def append_flags(filter_: str, flags: List[str]) -> str:
+    for flag in flags:
+        filter_ += f';{flag}'
+        if filter_.startswith('.;'):
+            filter_ = filter_[2:]
+    return filter_
+
+
+def flag_known_site(
+        variant: Dict[str, Any],
+        flag: str,
+        criterion: KnownSitesCriterion,
+        lookup: 'KnownSitesLookup') -> Dict[str, Any]:
+
+    variant = variant.copy()
+
+    sites = lookup.get_sites(chrom=variant['CHROM'], pos=int(variant['POS']))
+
+    flagged = False
+    for alt in variant['ALT'].split(','):
+        for ref, alts, info in sites:
+            if ref != variant['REF'] or alt not in alts:
+                continue
+
+            if criterion.criterion is None:  # presence of the site is enough
+                flagged = True
+                break
+
+            val = get_info_value(
+                variant={'INFO': info},
+                key=criterion.criterion.key,
+                allele_index=alts.index(alt))
+            if val is not None and in_range(val=val, criterion=criterion.criterion):
+                flagged = True
+                break
+
+    if flagged:
         variant['FILTER'] += f';{flag}'
 
     if variant['FILTER'].startswith('.;'):
@@ -127,6 +302,56 @@ def flag_variant(
     return variant
 
 
+def parse_flagging_criteria(s: str) -> Dict[str, Union[Criterion, KnownSitesCriterion]]:
+    """
+    'LOW_DP: DP<20, GNOMAD_COMMON: sites=gnomad.vcf.gz, AF>0.01'
+
+    {'LOW_DP': Criterion(...), 'GNOMAD_COMMON': KnownSitesCriterion(...)}
+    """
+    s = s.replace(' ', '')
+    if s.lower() == 'none':
+        return {}
+
+    flag_to_criterion = {}
+    for flag, criterion in split_flagging_criteria(s=s):
+        if criterion.startswith('sites='):
+            flag_to_criterion[flag] = parse_known_sites_criterion(s=criterion)
+        else:
+            flag_to_criterion[flag] = parse_criterion(s=criterion)
+    return flag_to_criterion
+
+
+def split_flagging_criteria(s: str) -> List[Tuple[str, str]]:
+    """
+    'LOW_DP:DP<20,GNOMAD_COMMON:sites=gnomad.vcf.gz,AF>0.01'
+
+    [('LOW_DP', 'DP<20'), ('GNOMAD_COMMON', 'sites=gnomad.vcf.gz,AF>0.01')]
+    """
+    ret = []
+    for item in s.split(','):
+        if ':' in item:
+            flag, criterion = item.split(':', 1)  # the sites path may contain ':', e.g. a URL
+            ret.append((flag, criterion))
+        else:  # continuation of the previous criterion, e.g. 'AF>0.01' after 'sites=gnomad.vcf.gz'
+            assert len(ret) > 0, f'Invalid flagging criteria: "{s}"'
+            flag, criterion = ret[-1]
+            ret[-1] = (flag, f'{criterion},{item}')
+    return ret
+
+
+def parse_known_sites_criterion(s: str) -> KnownSitesCriterion:
+    """
+    'sites=gnomad.vcf.gz,AF>0.01' or 'sites=panel_of_normals.vcf.gz'
+    """
+    items = s.split(',')
+    assert len(items) in [1, 2], f'Invalid known sites criterion: "{s}"'
+
+    sites = items[0][len('sites='):]
+    criterion = parse_criterion(s=items[1]) if len(items) == 2 else None
+
+    return KnownSitesCriterion(sites=sites, criterion=criterion, description=s)
+
+
 def parse_criterion(s: str) -> Criterion:
 
     inclusive_min, inclusive_max = False, False
@@ -178,43 +403,191 @@ def parse_criterion(s: str) -> Criterion:
         key=k,
         range=(min_, max_),
         equal_max=inclusive_max,
-        equal_min=inclusive_min)
+        equal_min=inclusive_min,
+        description=s)
 
     return ret
 
 
-def get_info_value(variant: Dict[str, Any], key: str) -> Optional[float]:
+def get_info_value(
+        variant: Dict[str, Any],
+        key: str,
+        allele_index: Optional[int] = None) -> Optional[float]:
+    """
+    allele_index: for per-allele (Number=A) values, e.g. AF=0.01,0.2, pick the value of the given ALT allele
+    """
     for item in variant['INFO'].split(';'):
         if '=' in item:
-            k, v = item.split('=')
+            k, v = item.split('=', 1)
             if k == key:
-                return float(v)
+                if allele_index is not None and ',' in v:
+                    v = v.split(',')[allele_index]
+                return None if v == '.' else float(v)
     return None
 
 
+class KnownSitesLookup(Processor):
+    """
+    Joins the input vcf with a coordinate-sorted sites vcf (e.g. gnomAD, panel of normals)
+    without loading the sites file into memory
+
+    When the sites file is tabix-indexed and much larger than the input,
+    only the positions of input variants are looked up by region seeks,
+    otherwise both files are merged in a single streaming pass in coordinate order
+    """
+
+    SEEK_SIZE_RATIO = 100  # seek when the sites file is this many times larger than the input vcf
+
+    sites: str
+    vcf: str
+    vcf_header: str
+
+    seek: bool
+    contig_to_order: Dict[str, int]
+
+    tabix: TabixReader
+    reader: IO
+    next_site: Optional[Tuple[int, int, str, List[str], str]]  # order, pos, ref, alts, info
+    last_key: Tuple[int, int]
+    buffer_key: Optional[Tuple[str, int]]
+    buffer: List[Tuple[str, List[str], str]]  # ref, alts, info
+
+    def main(
+            self,
+            sites: str,
+            vcf: str,
+            vcf_header: str) -> 'KnownSitesLookup':
+
+        self.sites = sites
+        self.vcf = vcf
+        self.vcf_header = vcf_header
+
+        self.set_seek()
+        self.open_sites()
+
+        return self
+
+    def set_seek(self):
+        self.seek = exists(f'{self.sites}.tbi') \
+            and getsize(self.sites) > self.SEEK_SIZE_RATIO * getsize(self.vcf)
+        mode = 'tabix region seeks' if self.seek else 'streaming merge'
+        self.logger.info(f'Look up known sites in "{self.sites}" by {mode}')
+
+    def open_sites(self):
+        self.buffer_key, self.buffer = None, []
+
+        if self.seek:
+            self.tabix = TabixReader(self.sites)
+            return
+
+        self.reader = gzip.open(self.sites, 'rt') if self.sites.endswith('.gz') else open(self.sites)
+
+        header = ''
+        line = ''
+        for line in self.reader:
+            if not line.startswith('#'):
+                break
+            header += line
+
+        self.contig_to_order = get_contig_to_order(vcf_header=header)
+        if len(self.contig_to_order) == 0:
+            self.contig_to_order = get_contig_to_order(vcf_header=self.vcf_header)
+        assert len(self.contig_to_order) > 0, \
+            f'No ##contig lines in "{self.sites}" or "{self.vcf}" to determine contig order for the streaming merge'
+
+        self.last_key = (-1, -1)
+        self.next_site = None
+        self.__set_next_site(line=line)
+
+    def get_sites(self, chrom: str, pos: int) -> List[Tuple[str, List[str], str]]:
+        """
+        Returns (ref, alts, info) of all sites at chrom:pos
+        """
+        if (chrom, pos) == self.buffer_key:  # consecutive input lines at the same position
+            return self.buffer
+
+        self.buffer_key = (chrom, pos)
+        if self.seek:
+            self.buffer = [self.__unpack(line)[2:] for line in self.tabix.fetch(chrom=chrom, start=pos, end=pos)]
+        else:
+            self.buffer = self.__stream_to(chrom=chrom, pos=pos)
+        return self.buffer
+
+    def __stream_to(self, chrom: str, pos: int) -> List[Tuple[str, List[str], str]]:
+        order = self.contig_to_order.get(chrom)
+        if order is None:  # contig not in the sites file
+            return []
+
+        key = (order, pos)
+        if key < self.last_key:
+            raise ValueError(
+                f'"{self.vcf}" is not sorted in the same contig order as "{self.sites}" at {chrom}:{pos}, '
+                f'both vcfs must be sorted by contig and position to be streamed together')
+        self.last_key = key
+
+        while self.next_site is not None and self.next_site[:2] < key:
+            self.__set_next_site(line=self.reader.readline())
+
+        ret = []
+        while self.next_site is not None and self.next_site[:2] == key:
+            ret.append(self.next_site[2:])
+            self.__set_next_site(line=self.reader.readline())
+        return ret
+
+    def __set_next_site(self, line: str):
+        while line != '':
+            chrom, pos, ref, alts, info = self.__unpack(line)
+            order = self.contig_to_order.get(chrom)
+            if order is not None:  # skip contigs that cannot be ordered, they never match
+                self.next_site = (order, pos, ref, alts, info)
+                return
+            line = self.reader.readline()
+        self.next_site = None  # end of file
+
+    def __unpack(self, line: str) -> Tuple[str, int, str, List[str], str]:
+        chrom, pos, _, ref, alt, _, _, info = line.rstrip('\n').split('\t', 8)[:8]
+        return chrom, int(pos), ref, alt.split(','), info
+
+    def close(self):
+        if self.seek:
+            self.tabix.close()
+        else:
+            self.reader.close()
+
+
 class RemoveVariants(Processor):
 
     vcf: str
     flags: List[str]
     only_pass: bool
+    use_cache: bool
 
     output_vcf: str
+    cache: Optional[VcfColumnCache]
     reader: IO
     writer: IO
+    total: int
+    passed: int
 
     def main(
             self,
             vcf: str,
             flags: List[str],
-            only_pass: bool) -> str:
+            only_pass: bool,
+            use_cache: bool) -> str:
 
         self.vcf = vcf
         self.flags = flags
         self.only_pass = only_pass
+        self.use_cache = use_cache
 
         self.set_output_vcf()
+        self.set_cache()
         self.open_files()
-        self.write_to_output_vcf()
+        if self.cache is None:
+            self.write_to_output_vcf()
+        else:
+            self.write_to_output_vcf_by_cache()
         self.close_files()
 
         return self.output_vcf
@@ -226,9 +599,22 @@ class RemoveVariants(Processor):
             new_suffix='-variant-removal.vcf',
             dstdir=self.workdir)
 
+    def set_cache(self):
+        """
+        Only an existing cache is used, building one would cost more than the plain text pass
+        """
+        self.cache = None
+        if self.use_cache and VcfColumnCache(self.vcf).is_valid():
+            self.logger.info(f'Use column cache of "{self.vcf}"')
+            self.cache = VcfColumnCache(self.vcf).load()
+
     def open_files(self):
-        self.reader = open(self.vcf)
-        self.writer = open(self.output_vcf, 'w')
+        if self.cache is None:
+            self.reader = open(self.vcf)
+            self.writer = open(self.output_vcf, 'w')
+        else:
+            self.reader = open_binary(self.vcf)
+            self.writer = open(self.output_vcf, 'wb')
 
     def write_to_output_vcf(self):
         total, passed = 0, 0
@@ -243,13 +629,37 @@ class RemoveVariants(Processor):
                 passed += 1
                 self.writer.write(line)
 
+        self.total, self.passed = total, passed
         self.__log_result(total, passed)
 
+    def write_to_output_vcf_by_cache(self):
+        """
+        FILTER is evaluated once per distinct value in the cache vocabulary, lines are copied as bytes
+        """
+        passed_filters = np.array([self.__passed_filter(f) for f in self.cache.filters], dtype=bool)
+        mask = passed_filters[self.cache.filter_codes] if len(passed_filters) > 0 \
+            else np.zeros(0, dtype=bool)
+
+        if self.cache.n_variants > 0:
+            self.writer.write(self.reader.read(int(self.cache.offsets[0])))  # vcf header
+        else:
+            self.writer.write(self.reader.read())
+
+        for line, passed in zip(self.reader, mask.tolist()):
+            if passed:
+                self.writer.write(line)
+
+        self.total, self.passed = self.cache.n_variants, int(mask.sum())
+        self.__log_result(total=self.total, passed=self.passed)
+
     def __passed(self, line: str) -> bool:
-        variant_flags = line.split('\t')[6].split(';')
+        return self.__passed_filter(line.split('\t')[6])
+
+    def __passed_filter(self, filter_: str) -> bool:
+        variant_flags = filter_.split(';')
 
         if self.only_pass:
-            passed = line.split('\t')[6] == 'PASS'
+            passed = filter_ == 'PASS'
         else:  # look for the presence of red flags
             red_flags = set(variant_flags).intersection(set(self.flags))
             passed = len(red_flags) == 0
@@ -257,6 +667,7 @@ class RemoveVariants(Processor):
         return passed
 
     def __log_result(self, total: int, passed: int):
+        self.count_records(total)
         percentage = passed / total * 100 if total > 0 else 0.
         msg = f'''\
 Remove variants having any one of the following flags: {', '.join(self.flags)}
@@ -1,117 +1,831 @@
-import pandas as pd
-from os.path import basename
-from typing import List, Dict, Tuple
-from .tools import VcfParser
+import gzip
+import heapq
+import numpy as np
+from array import array
+from itertools import groupby, repeat
+from os import makedirs
+from os.path import basename, dirname, exists, getmtime
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Tuple, Iterator, Optional
+from .tools import FaiRecord, IndexedFasta, IntervalIndex, TabixReader, read_fai, build_fai, write_fai
 from .template import Processor
 
 
 class VariantPicking(Processor):
 
-    VARIANT_KEY_COLUMNS = ['CHROM', 'POS', 'REF', 'ALT']
     VCF_COLUMNS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
     INFO_CALL_ID = 'CALL'
     INFO_CALL_DESCRIPTION = 'Variant callers detecting this variant'
+    INFO_MATCH_ID = 'MATCH'
+    INFO_MATCH_DESCRIPTION = 'Calls within the match window grouped into this variant, POS:REF>ALT:callers'
 
     ref_fa: str
-    vcfs: List[str]
+    caller_to_vcf: Dict[str, str]
     min_snv_callers: int
     min_indel_callers: int
-
+    streaming: bool
+    match_window: int
+    carried_keys: List[str]
+    targets: Optional[str]
+    concordance_prefix: Optional[str]
+
+    target_index: Optional[IntervalIndex]
+    caller_fields: List[List['CallerField']]  # fields carried from each caller
     vcf_header: str
-    variant_to_callers: Dict[Tuple, List[str]]
-    variant_df: pd.DataFrame
+    contigs: List[str]
+    alleles: List[Tuple[str, str]]  # (REF, ALT)
+    contig_codes: np.ndarray  # int32, index of self.contigs
+    positions: np.ndarray  # int64
+    allele_codes: np.ndarray  # int32, index of self.alleles
+    caller_masks: np.ndarray  # int64, bit i is set if the i-th caller detects the variant
+    caller_values: List[List[List[str]]]  # [caller][field][row of the caller], columns of carried values
+    caller_rows: np.ndarray  # int32 (n callers, n variants), row in caller_values, -1 if not detected; (0, n variants) if nothing is carried
+    match_codes: np.ndarray  # int32, index of self.matches, -1 if not grouped with nearby calls
+    matches: List[str]
+    snv_mask_counts: np.ndarray  # int64, number of SNVs of each caller mask
+    indel_mask_counts: np.ndarray
     out_vcf: str
 
     def main(
             self,
             ref_fa: str,
-            vcfs: List[str],
+            caller_to_vcf: Dict[str, str],
             min_snv_callers: int,
-            min_indel_callers: int) -> str:
+            min_indel_callers: int,
+            streaming: bool,
+            match_window: int,
+            carried_keys: List[str],
+            targets: Optional[str],
+            concordance_prefix: Optional[str]) -> str:
 
         self.ref_fa = ref_fa
-        self.vcfs = vcfs
+        self.caller_to_vcf = caller_to_vcf
         self.min_snv_callers = min_snv_callers
         self.min_indel_callers = min_indel_callers
-
+        self.streaming = streaming
+        self.match_window = match_window
+        self.carried_keys = carried_keys
+        self.targets = targets
+        self.concordance_prefix = concordance_prefix
+
+        self.set_target_index()
+        self.set_caller_fields()
         self.build_vcf_header()
-        self.collect_variant_dict()
-        self.build_variant_df()
-        self.sort_variant_df()
-        self.write_vcf()
+        if self.streaming:
+            self.stream_variants()
+        else:
+            self.collect_variants()
+            self.sort_variants()
+            self.match_nearby_variants()
+            self.count_caller_combinations()
+            self.pick_variants()
+            self.write_vcf()
+        self.count_records(int(self.snv_mask_counts.sum() + self.indel_mask_counts.sum()))
+
+        if self.concordance_prefix is not None:
+            WriteConcordanceReport(self.settings).main(
+                callers=list(self.caller_to_vcf.keys()),
+                snv_mask_counts=self.snv_mask_counts,
+                indel_mask_counts=self.indel_mask_counts,
+                prefix=self.concordance_prefix)
 
         return self.out_vcf
 
+    def set_target_index(self):
+        self.target_index = None if self.targets is None else IntervalIndex(self.targets)
+
+    def set_caller_fields(self):
+        self.caller_fields = [
+            get_caller_fields(caller=caller, vcf=vcf, keys=self.carried_keys)
+            for caller, vcf in self.caller_to_vcf.items()
+        ]
+
     def build_vcf_header(self):
         contig_lines = BuildHeaderContigLines(self.settings).main(self.ref_fa)
         columns = '\t'.join(self.VCF_COLUMNS)
+        info_lines = f'##INFO=<ID={self.INFO_CALL_ID},Number=.,Type=String,Description="{self.INFO_CALL_DESCRIPTION}">'
+        if self.match_window > 0:
+            info_lines += f'\n##INFO=<ID={self.INFO_MATCH_ID},Number=.,Type=String,Description="{self.INFO_MATCH_DESCRIPTION}">'
+        for fields in self.caller_fields:
+            for field in fields:
+                info_lines += f'\n##INFO=<ID={field.id},Number=.,Type=String,Description="{field.description}">'
         self.vcf_header = f'''\
 ##fileformat=VCFv4.2
 {contig_lines}
-##INFO=<ID={self.INFO_CALL_ID},Number=.,Type=String,Description="{self.INFO_CALL_DESCRIPTION}">
+{info_lines}
 #{columns}'''
 
-    def collect_variant_dict(self):
-        self.variant_to_callers = {}
-        for vcf in self.vcfs:
-            caller = self.__get_filename(path=vcf)
-            with VcfParser(vcf) as parser:
-                for variant in parser:
-                    tup = tuple(variant[k] for k in self.VARIANT_KEY_COLUMNS)
-                    self.variant_to_callers.setdefault(tup, [])
-                    self.variant_to_callers[tup].append(caller)
-
-    def __get_filename(self, path: str) -> str:
-        return basename(path).split('.')[0]
-
-    def build_variant_df(self):
-        data = []
-        for variant, callers in self.variant_to_callers.items():
-            chrom, pos, ref, alt = variant
-
-            first_alt = alt.split(',')[0].split('/')[0]
-            is_snv = len(ref) == len(first_alt)
-            satisfy_snv = len(callers) >= self.min_snv_callers
-
-            is_indel = not is_snv
-            satisfy_indel = len(callers) >= self.min_indel_callers
-
-            if (is_snv and satisfy_snv) or (is_indel and satisfy_indel):
-                v = {c: '.' for c in self.VCF_COLUMNS}  # empty dict
-                v['CHROM'] = chrom
-                v['POS'] = int(pos)
-                v['REF'] = ref
-                v['ALT'] = alt
-                c = ','.join(callers)
-                v['INFO'] = f'CALL={c}'
-                data.append(v)
-
-        self.variant_df = pd.DataFrame(data=data, columns=self.VCF_COLUMNS)
-
-    def sort_variant_df(self):
+    def collect_variants(self):
+        """
+        Caller vcfs are parsed concurrently, each worker returns compact arrays of encoded variant keys,
+        which are remapped into global contig and allele vocabularies and merged into one row per variant,
+        with the supporting callers as a bitmask (bit i = i-th caller)
+
+        Carried INFO/FORMAT values are gathered in the same pass, as one column per caller field
+        """
+        callers = list(self.caller_to_vcf.keys())
+        fai_records = GetFastaIndex(self.settings).main(ref_fa=self.ref_fa)
+        max_workers = max(1, min(self.threads, len(callers)))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                encode_vcf_variants,
+                self.caller_to_vcf.values(),
+                repeat(self.ref_fa),
+                repeat(fai_records),
+                self.caller_fields,
+                repeat(self.target_index)))
+
+        contig_to_index, allele_to_index = {}, {}
+        contig_codes, positions, allele_codes, caller_masks, local_rows = [], [], [], [], []
+        self.caller_values = []
+        for i, (contigs, local_contig_codes, local_positions, alleles, local_allele_codes, values) in enumerate(results):
+
+            # local codes of the worker -> global codes
+            contig_map = np.array([contig_to_index.setdefault(c, len(contig_to_index)) for c in contigs], dtype=np.int32)
+            allele_map = np.array([allele_to_index.setdefault(a, len(allele_to_index)) for a in alleles], dtype=np.int32)
+
+            contig_codes.append(contig_map[local_contig_codes] if len(contigs) > 0 else local_contig_codes)
+            positions.append(local_positions)
+            allele_codes.append(allele_map[local_allele_codes] if len(alleles) > 0 else local_allele_codes)
+            caller_masks.append(np.full(len(local_positions), 1 << i, dtype=np.int64))
+            local_rows.append(np.arange(len(local_positions), dtype=np.int32))
+            self.caller_values.append(values)
+
+        self.contigs = list(contig_to_index.keys())
+        self.alleles = list(allele_to_index.keys())
+
+        self.__merge_variants(  # no caller vcf given -> no variants
+            contig_codes=concatenate(contig_codes, dtype=np.int32),
+            positions=concatenate(positions, dtype=np.int64),
+            allele_codes=concatenate(allele_codes, dtype=np.int32),
+            caller_masks=concatenate(caller_masks, dtype=np.int64),
+            local_rows=concatenate(local_rows, dtype=np.int32))
+
+    def __merge_variants(
+            self,
+            contig_codes: np.ndarray,
+            positions: np.ndarray,
+            allele_codes: np.ndarray,
+            caller_masks: np.ndarray,
+            local_rows: np.ndarray):
+        """
+        Rows with the same (contig, position, allele) are collapsed, OR-ing their caller bits
+        """
+        order = np.lexsort((allele_codes, positions, contig_codes))
+        contig_codes, positions, allele_codes, caller_masks, local_rows = \
+            contig_codes[order], positions[order], allele_codes[order], caller_masks[order], local_rows[order]
+
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = (contig_codes[1:] != contig_codes[:-1]) \
+            | (positions[1:] != positions[:-1]) \
+            | (allele_codes[1:] != allele_codes[:-1])
+        starts = np.flatnonzero(is_first)
+
+        self.contig_codes = contig_codes[starts]
+        self.positions = positions[starts]
+        self.allele_codes = allele_codes[starts]
+        self.caller_masks = np.bitwise_or.reduceat(caller_masks, starts) if len(starts) > 0 else caller_masks
+
+        n_carried = len(self.caller_fields) if any(self.caller_fields) else 0
+        variant_indexes = np.cumsum(is_first) - 1
+        self.caller_rows = np.full((n_carried, len(starts)), -1, dtype=np.int32)
+        for i in range(n_carried):
+            is_caller = caller_masks == 1 << i  # before merging, each row has a single caller bit
+            self.caller_rows[i, variant_indexes[is_caller]] = local_rows[is_caller]
+
+    def count_caller_combinations(self):
+        """
+        All variants before the min callers thresholds, counted by caller mask
+        """
+        snv = self.__get_is_snv()
+        n_masks = 1 << len(self.caller_to_vcf)
+        self.snv_mask_counts = np.bincount(self.caller_masks[snv], minlength=n_masks)
+        self.indel_mask_counts = np.bincount(self.caller_masks[~snv], minlength=n_masks)
+
+    def pick_variants(self):
+        n_callers = np.zeros(len(self.caller_masks), dtype=np.int32)
+        for i in range(len(self.caller_to_vcf)):
+            n_callers += (self.caller_masks >> i & 1).astype(np.int32)
+
+        snv = self.__get_is_snv()
+
+        picked = (snv & (n_callers >= self.min_snv_callers)) | (~snv & (n_callers >= self.min_indel_callers))
+
+        self.contig_codes = self.contig_codes[picked]
+        self.positions = self.positions[picked]
+        self.allele_codes = self.allele_codes[picked]
+        self.caller_masks = self.caller_masks[picked]
+        self.caller_rows = self.caller_rows[:, picked]
+        self.match_codes = self.match_codes[picked]
+
+    def __get_is_snv(self) -> np.ndarray:
+        is_snv_allele = np.array([is_snv(ref=ref, alt=alt) for ref, alt in self.alleles], dtype=bool)
+        return is_snv_allele[self.allele_codes] if len(self.alleles) > 0 else np.zeros(0, dtype=bool)
+
+    def sort_variants(self):
+        """
+        Contigs in the order of the reference, contigs not in the reference go last,
+        then position, then (REF, ALT), same as the streaming mode
+        """
         chrom_to_order = GetChromToOrder(self.settings).main(self.ref_fa)
-
-        self.variant_df['order'] = self.variant_df['CHROM'].map(chrom_to_order)
-
-        self.variant_df = self.variant_df.sort_values(
-            by=['order', 'POS'],
-            ascending=[True, True]
-        ).drop(
-            columns='order'
-        )
+        contig_order = np.array(
+            [chrom_to_order.get(c, len(chrom_to_order) + i) for i, c in enumerate(self.contigs)], dtype=np.int64)
+
+        orders = contig_order[self.contig_codes] if len(self.contigs) > 0 else self.contig_codes
+
+        allele_rank = np.empty(len(self.alleles), dtype=np.int64)  # same position sorted by (REF, ALT)
+        allele_rank[sorted(range(len(self.alleles)), key=self.alleles.__getitem__)] = np.arange(len(self.alleles))
+        ranks = allele_rank[self.allele_codes] if len(self.alleles) > 0 else self.allele_codes
+
+        i = np.lexsort((ranks, self.positions, orders))
+
+        self.contig_codes = self.contig_codes[i]
+        self.positions = self.positions[i]
+        self.allele_codes = self.allele_codes[i]
+        self.caller_masks = self.caller_masks[i]
+        self.caller_rows = self.caller_rows[:, i]
+
+    def match_nearby_variants(self):
+        """
+        Sweeps the sorted variants once, each group of nearby calls becomes a single variant
+        of its representative, detected by the union of the callers in the group
+        """
+        self.matches = []
+        self.match_codes = np.full(len(self.positions), -1, dtype=np.int32)
+        if self.match_window <= 0:
+            return
+
+        variants = zip(
+            self.contig_codes.tolist(),
+            self.positions.tolist(),
+            self.allele_codes.tolist(),
+            range(len(self.positions)),
+            self.caller_masks.tolist())
+
+        rows, starts, masks, match_codes = [], [], [], []
+        for group in group_nearby_variants(variants=variants, window=self.match_window):
+            representative = pick_representative(group)
+            rows.append(representative[3])
+            starts.append(group[0][3])
+            masks.append(get_group_mask(group))
+            if len(group) == 1:
+                match_codes.append(-1)
+            else:
+                match_codes.append(len(self.matches))
+                self.matches.append(self.__to_match(
+                    (pos, *self.alleles[allele_code], mask) for _, pos, allele_code, _, mask in group))
+
+        rows = np.array(rows, dtype=np.int64)
+        self.contig_codes = self.contig_codes[rows]
+        self.positions = self.positions[rows]
+        self.allele_codes = self.allele_codes[rows]
+        self.caller_masks = np.array(masks, dtype=np.int64)
+        self.match_codes = np.array(match_codes, dtype=np.int32)
+        if self.caller_rows.shape[0] > 0 and len(starts) > 0:
+            # groups are contiguous and a caller has at most one call per group, other rows of the caller are -1
+            self.caller_rows = np.maximum.reduceat(self.caller_rows, np.array(starts, dtype=np.int64), axis=1)
+        else:
+            self.caller_rows = self.caller_rows[:, rows]
+
+    def __to_match(self, members: Iterator[Tuple[int, str, str, int]]) -> str:
+        callers = list(self.caller_to_vcf.keys())
+        ret = []
+        for pos, ref, alt, mask in members:
+            c = '|'.join(c for i, c in enumerate(callers) if mask >> i & 1)
+            ret.append(f'{pos}:{ref}>{alt}:{c}')
+        return ','.join(ret)
+
+    def __to_carried_info(self, caller_index_to_values: Dict[int, List[str]]) -> str:
+        ret = ''
+        for i, values in sorted(caller_index_to_values.items()):
+            for field, value in zip(self.caller_fields[i], values):
+                if value not in ('', '.'):
+                    ret += f';{field.id}={value}'
+        return ret
 
     def write_vcf(self):
         self.out_vcf = f'{self.workdir}/picked-variants.vcf'
 
+        callers = list(self.caller_to_vcf.keys())
+        mask_to_call = {}
+        for mask in np.unique(self.caller_masks).tolist():
+            mask_to_call[mask] = ','.join(c for i, c in enumerate(callers) if mask >> i & 1)
+
         with open(self.out_vcf, 'w') as writer:
             writer.write(self.vcf_header + '\n')
+            for contig_code, pos, allele_code, mask, match_code, caller_rows in zip(
+                    self.contig_codes.tolist(),
+                    self.positions.tolist(),
+                    self.allele_codes.tolist(),
+                    self.caller_masks.tolist(),
+                    self.match_codes.tolist(),
+                    self.caller_rows.T.tolist()):
+                ref, alt = self.alleles[allele_code]
+                info = f'{self.INFO_CALL_ID}={mask_to_call[mask]}'
+                if match_code >= 0:
+                    info += f';{self.INFO_MATCH_ID}={self.matches[match_code]}'
+                info += self.__to_carried_info({
+                    i: [column[row] for column in self.caller_values[i]]
+                    for i, row in enumerate(caller_rows) if row >= 0
+                })
+                writer.write(f'{self.contigs[contig_code]}\t{pos}\t.\t{ref}\t{alt}\t.\t.\t{info}\n')
+
+    def __satisfy_min_callers(self, ref: str, alt: str, n_callers: int) -> bool:
+        if is_snv(ref=ref, alt=alt):
+            return n_callers >= self.min_snv_callers
+        else:
+            return n_callers >= self.min_indel_callers
+
+    def stream_variants(self):
+        """
+        For vcfs sorted in the contig order of the reference:
+        a heap-based k-way merge of all callers, each position is written as soon as it is complete,
+        so memory does not grow with the number of variants
+        """
+        fai_records = GetFastaIndex(self.settings).main(ref_fa=self.ref_fa)
+        chrom_to_order = {r.name: i for i, r in enumerate(fai_records)}
+        order_to_chrom = {o: c for c, o in chrom_to_order.items()}
+        callers = list(self.caller_to_vcf.keys())
+
+        fasta = IndexedFasta(fa=self.ref_fa, records=fai_records)
+        streams = [
+            iter_sorted_variants(
+                vcf=vcf,
+                caller_index=i,
+                chrom_to_order=chrom_to_order,
+                fasta=fasta,
+                fields=self.caller_fields[i],
+                targets=self.target_index)
+            for i, vcf in enumerate(self.caller_to_vcf.values())
+        ]
+        merged = heapq.merge(*streams)  # (order, pos, ref, alt, caller_index, values)
+
+        self.out_vcf = f'{self.workdir}/picked-variants.vcf'
+        with open(self.out_vcf, 'w') as writer:
+            writer.write(self.vcf_header + '\n')
+
+            variants = iter_merged_variants(merged)  # (order, pos, ref, alt, caller_index_to_values, mask)
+            if self.match_window > 0:
+                groups = group_nearby_variants(variants=variants, window=self.match_window)
+            else:
+                groups = ([v] for v in variants)
+
+            self.snv_mask_counts = np.zeros(1 << len(callers), dtype=np.int64)
+            self.indel_mask_counts = np.zeros(1 << len(callers), dtype=np.int64)
+            for group in groups:
+                order, pos, ref, alt, _, _ = pick_representative(group)
+                mask = get_group_mask(group)
+                if is_snv(ref=ref, alt=alt):
+                    self.snv_mask_counts[mask] += 1
+                else:
+                    self.indel_mask_counts[mask] += 1
+                if not self.__satisfy_min_callers(ref=ref, alt=alt, n_callers=bin(mask).count('1')):
+                    continue
+                c = ','.join(c for i, c in enumerate(callers) if mask >> i & 1)
+                info = f'{self.INFO_CALL_ID}={c}'
+                if len(group) > 1:
+                    info += f';{self.INFO_MATCH_ID}={self.__to_match((v[1], v[2], v[3], v[-1]) for v in group)}'
+                info += self.__to_carried_info({i: values for v in group for i, values in v[4].items()})
+                writer.write(f'{order_to_chrom[order]}\t{pos}\t.\t{ref}\t{alt}\t.\t.\t{info}\n')
+
+        fasta.close()
+
+
+def iter_merged_variants(
+        merged: Iterator[Tuple[int, int, str, str, int, Tuple[str, ...]]]
+) -> Iterator[Tuple[int, int, str, str, Dict[int, Tuple[str, ...]], int]]:
+    """
+    (order, pos, ref, alt, caller_index, values) sorted by (order, pos)
+        -> (order, pos, ref, alt, caller_index_to_values, caller_mask),
+    each distinct variant once, at the same position sorted by (REF, ALT)
+    """
+    for (order, pos), records in groupby(merged, key=lambda r: r[:2]):
+        variant_to_caller_values = {}
+        for _, _, ref, alt, i, values in records:
+            variant_to_caller_values.setdefault((ref, alt), {})[i] = values
+        for (ref, alt), caller_index_to_values in sorted(variant_to_caller_values.items()):
+            mask = 0
+            for i in caller_index_to_values:
+                mask |= 1 << i
+            yield order, pos, ref, alt, caller_index_to_values, mask
+
+
+def group_nearby_variants(variants: Iterator[tuple], window: int) -> Iterator[List[tuple]]:
+    """
+    Single pass over variants (contig, pos, ..., caller_mask) sorted by (contig, pos)
+
+    A variant joins the current group if it is on the same contig, within window bp of the first variant of the group,
+    and detected by none of the callers already in the group, i.e. each caller contributes at most one call per group
+    """
+    group = []
+    contig, start, group_mask = None, None, 0
+    for v in variants:
+        mask = v[-1]
+        if group and v[0] == contig and v[1] - start <= window and mask & group_mask == 0:
+            group.append(v)
+            group_mask |= mask
+        else:
+            if group:
+                yield group
+            group = [v]
+            contig, start, group_mask = v[0], v[1], mask
+    if group:
+        yield group
+
+
+def pick_representative(group: List[tuple]) -> tuple:
+    """
+    The variant detected by the most callers, the first one in sorted order if tied
+    """
+    i = max(range(len(group)), key=lambda i: (bin(group[i][-1]).count('1'), -i))
+    return group[i]
+
+
+def get_group_mask(group: List[tuple]) -> int:
+    mask = 0
+    for v in group:
+        mask |= v[-1]
+    return mask
+
+
+def is_snv(ref: str, alt: str) -> bool:
+    first_alt = alt.split(',')[0].split('/')[0]
+    return len(ref) == len(first_alt)
+
+
+NORMALIZABLE_BASES = set('ACGTN')
+
+
+def concatenate(arrays: List[np.ndarray], dtype: type) -> np.ndarray:
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays)
+
+
+def normalize_variant(
+        chrom: str,
+        pos: int,
+        ref: str,
+        alt: str,
+        fasta: IndexedFasta) -> List[Tuple[int, str, str]]:
+    """
+    Splits multi-allelic ALT, then left-aligns and trims each allele against the reference,
+    so that callers representing the same variant differently get the same (POS, REF, ALT)
+
+    chr1:1003 A>AA in AAAAAA is left-aligned to the base before the homopolymer, e.g. chr1:1000 G>GA
+    """
+    ret = []
+    for a in alt.split(','):
+        ret.append(normalize_allele(chrom=chrom, pos=pos, ref=ref.upper(), alt=a.upper(), fasta=fasta))
+    return ret
+
+
+def normalize_allele(
+        chrom: str,
+        pos: int,
+        ref: str,
+        alt: str,
+        fasta: IndexedFasta) -> Tuple[int, str, str]:
+
+    if ref == alt \
+            or chrom not in fasta \
+            or not set(ref).issubset(NORMALIZABLE_BASES) \
+            or not set(alt).issubset(NORMALIZABLE_BASES):  # e.g. symbolic <DEL>, spanning deletion *
+        return pos, ref, alt
+
+    original = (pos, ref, alt)
+    while True:
+        changed = False
+
+        if len(ref) > 0 and len(alt) > 0 and ref[-1] == alt[-1]:  # trim the common right base
+            ref, alt = ref[:-1], alt[:-1]
+            changed = True
+
+        if len(ref) == 0 or len(alt) == 0:
+            if pos == 1:  # cannot extend to the left, pad the next base on the right
+                base = fasta.fetch(chrom=chrom, start=len(ref), end=len(ref) + 1)
+                return (pos, ref + base, alt + base) if base != '' else original
+
+            pos -= 1  # extend one reference base to the left
+            base = fasta.fetch(chrom=chrom, start=pos - 1, end=pos)
+            if base == '':
+                return original
+            ref, alt = base + ref, base + alt
+            changed = True
+
+        if not changed:
+            break
+
+    while len(ref) > 1 and len(alt) > 1 and ref[0] == alt[0]:  # trim the common left base
+        ref, alt = ref[1:], alt[1:]
+        pos += 1
+
+    return pos, ref, alt
+
+
+def iter_vcf_lines(vcf: str, targets: Optional[IntervalIndex], chroms: List[str]) -> Iterator[str]:
+    """
+    Variant lines of the vcf, only those with POS in the targets if given,
+    read by seeking to each target region (in the order of chroms) if the vcf is tabix-indexed
+    """
+    if targets is not None and vcf.endswith('.gz') and exists(f'{vcf}.tbi'):
+        with TabixReader(vcf) as reader:
+            for chrom, start, end in targets.iter_regions(chroms):
+                yield from reader.fetch(chrom=chrom, start=start, end=end)
+        return
+
+    fh = gzip.open(vcf, 'rt') if vcf.endswith('.gz') else open(vcf)
+    with fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            if targets is not None:
+                chrom, pos = line.split('\t', 2)[:2]
+                if not targets.contains(chrom=chrom, pos=int(pos)):
+                    continue
+            yield line
+
+
+def encode_vcf_variants(
+        vcf: str,
+        ref_fa: str,
+        fai_records: List[FaiRecord],
+        fields: List['CallerField'],
+        targets: Optional[IntervalIndex]
+) -> Tuple[List[str], np.ndarray, np.ndarray, List[Tuple[str, str]], np.ndarray, List[List[str]]]:
+    """
+    Runs in a worker process of VariantPicking, returns normalized
+        contigs, contig codes (int32), positions (int64), (REF, ALT) alleles, allele codes (int32),
+        and one column of values per carried field
+    """
+    contig_to_code, allele_to_code = {}, {}
+    contig_codes, positions, allele_codes = array('i'), array('q'), array('i')
+    columns = [[] for _ in fields]
+
+    chroms = [r.name for r in fai_records]
+    with IndexedFasta(fa=ref_fa, records=fai_records) as fasta:
+        for line in iter_vcf_lines(vcf=vcf, targets=targets, chroms=chroms):
+            chrom, pos, _, ref, alt = line.split('\t', 5)[:5]
+            contig_code = contig_to_code.setdefault(chrom, len(contig_to_code))
+            field_values = parse_field_values(fields=fields, line=line)
+            for allele_index, (p, r, a) in enumerate(
+                    normalize_variant(chrom=chrom, pos=int(pos), ref=ref, alt=alt, fasta=fasta)):
+                contig_codes.append(contig_code)
+                positions.append(p)
+                allele_codes.append(allele_to_code.setdefault((r, a), len(allele_to_code)))
+                for column, value in zip(columns, get_allele_values(
+                        fields=fields, field_values=field_values, allele_index=allele_index, n_alts=alt.count(',') + 1)):
+                    column.append(value)
+
+    return (
+        list(contig_to_code.keys()),
+        np.frombuffer(contig_codes, dtype=np.int32),
+        np.frombuffer(positions, dtype=np.int64),
+        list(allele_to_code.keys()),
+        np.frombuffer(allele_codes, dtype=np.int32),
+        columns,
+    )
+
+
+def iter_sorted_variants(
+        vcf: str,
+        caller_index: int,
+        chrom_to_order: Dict[str, int],
+        fasta: IndexedFasta,
+        fields: List['CallerField'],
+        targets: Optional[IntervalIndex],
+        max_left_shift: int = 10000) -> Iterator[Tuple[int, int, str, str, int, Tuple[str, ...]]]:
+    """
+    Normalization moves indels to the left, so normalized records are held in a small heap
+    until no later input record can be shifted before them (max_left_shift bp)
+    """
+    buffer = []
+    last_key = (-1, -1)
+    last_yielded = (-1, -1)
+    chroms = sorted(chrom_to_order.keys(), key=chrom_to_order.get)
+    for line in iter_vcf_lines(vcf=vcf, targets=targets, chroms=chroms):
+        chrom, pos, _, ref, alt = line.split('\t', 5)[:5]
+        assert chrom in chrom_to_order, f'Contig "{chrom}" of "{vcf}" is not in the reference'
+
+        key = (chrom_to_order[chrom], int(pos))
+        assert key >= last_key, f'"{vcf}" is not sorted in the contig order of the reference at {chrom}:{pos}'
+        last_key = key
+
+        field_values = parse_field_values(fields=fields, line=line)
+        for allele_index, (p, r, a) in enumerate(
+                normalize_variant(chrom=chrom, pos=key[1], ref=ref, alt=alt, fasta=fasta)):
+            values = get_allele_values(
+                fields=fields, field_values=field_values, allele_index=allele_index, n_alts=alt.count(',') + 1)
+            heapq.heappush(buffer, (key[0], p, r, a, caller_index, values))
+
+        while len(buffer) > 0 and buffer[0][:2] < (key[0], key[1] - max_left_shift):
+            record = heapq.heappop(buffer)
+            assert record[:2] >= last_yielded, f'Variant left-shifted by more than {max_left_shift} bp in "{vcf}" at {chrom}:{pos}'
+            last_yielded = record[:2]
+            yield record
+
+    while len(buffer) > 0:
+        record = heapq.heappop(buffer)
+        assert record[:2] >= last_yielded, f'Variant left-shifted by more than {max_left_shift} bp in "{vcf}"'
+        last_yielded = record[:2]
+        yield record
+
+
+class WriteConcordanceReport(Processor):
+    """
+    {prefix}.upset.tsv    number of SNVs and indels detected by exactly each combination of callers
+    {prefix}.jaccard.tsv  pairwise Jaccard index |A and B| / |A or B| of the variants of two callers
+    """
+
+    callers: List[str]
+    snv_mask_counts: np.ndarray
+    indel_mask_counts: np.ndarray
+    prefix: str
+
+    def main(
+            self,
+            callers: List[str],
+            snv_mask_counts: np.ndarray,
+            indel_mask_counts: np.ndarray,
+            prefix: str):
+
+        self.callers = callers
+        self.snv_mask_counts = snv_mask_counts
+        self.indel_mask_counts = indel_mask_counts
+        self.prefix = prefix
+
+        self.make_prefix_dir()
+        self.write_upset()
+        self.write_jaccard()
+
+    def make_prefix_dir(self):
+        d = dirname(self.prefix)
+        if d != '':
+            makedirs(d, exist_ok=True)
+
+    def write_upset(self):
+        totals = self.snv_mask_counts + self.indel_mask_counts
+        masks = np.flatnonzero(totals)
+        masks = masks[np.lexsort((masks, -totals[masks]))]  # most frequent combinations first
+
+        lines = ['callers\tSNV\tindel\ttotal']
+        for mask in masks.tolist():
+            callers = ','.join(c for i, c in enumerate(self.callers) if mask >> i & 1)
+            lines.append(f'{callers}\t{self.snv_mask_counts[mask]}\t{self.indel_mask_counts[mask]}\t{totals[mask]}')
+
+        with open(f'{self.prefix}.upset.tsv', 'w') as writer:
+            writer.write('\n'.join(lines) + '\n')
+
+    def write_jaccard(self):
+        totals = self.snv_mask_counts + self.indel_mask_counts
+        masks = np.arange(len(totals))
+
+        lines = ['\t'.join([''] + self.callers)]
+        for i, a in enumerate(self.callers):
+            row = [a]
+            for j in range(len(self.callers)):
+                has_a, has_b = (masks >> i & 1) == 1, (masks >> j & 1) == 1
+                union = totals[has_a | has_b].sum()
+                row.append(f'{totals[has_a & has_b].sum() / union:.4f}' if union > 0 else 'NA')
+            lines.append('\t'.join(row))
+
+        with open(f'{self.prefix}.jaccard.tsv', 'w') as writer:
+            writer.write('\n'.join(lines) + '\n')
+
+        self.logger.info(f'Caller concordance written to "{self.prefix}.upset.tsv" and "{self.prefix}.jaccard.tsv"')
+
+
+class CallerField:
+    """
+    An INFO or FORMAT key of a caller vcf, carried into the picked vcf as INFO {caller}_{key}
+    """
+
+    def __init__(
+            self,
+            caller: str,
+            key: str,
+            column: str,
+            number: str):
+
+        self.caller = caller
+        self.key = key
+        self.column = column  # 'INFO' or 'FORMAT'
+        self.number = number  # Number= in the header, e.g. 'A', 'R', '1', '.'
+
+        self.id = f'{caller.replace("-", "_")}_{key}'
+        self.description = f'{key} ({column}) of {caller}'
+        if column == 'FORMAT':
+            self.description += ', samples separated by |'
+
+
+def get_caller_fields(caller: str, vcf: str, keys: List[str]) -> List[CallerField]:
+    """
+    Keys defined in the header of the vcf, INFO taking precedence over FORMAT, keys not defined are not carried
+    """
+    key_to_field = {}
+    fh = gzip.open(vcf, 'rt') if vcf.endswith('.gz') else open(vcf)
+    with fh:
+        for line in fh:
+            if not line.startswith('##'):
+                break
+            for column in ['INFO', 'FORMAT']:
+                prefix = f'##{column}=<ID='
+                if not line.startswith(prefix):
+                    continue
+                key = line[len(prefix):].split(',')[0]
+                number = line.split('Number=')[1].split(',')[0] if 'Number=' in line else '.'
+                if key in keys and (column == 'INFO' or key not in key_to_field):
+                    key_to_field[key] = CallerField(caller=caller, key=key, column=column, number=number)
+    return [key_to_field[k] for k in keys if k in key_to_field]
+
+
+def parse_field_values(fields: List[CallerField], line: str) -> List[List[str]]:
+    """
+    Raw values of each field in a vcf line: [value] for INFO, [value of each sample] for FORMAT
+    """
+    if len(fields) == 0:
+        return []
+
+    columns = line.rstrip('\r\n').split('\t')
+    key_to_value = {}
+    if len(columns) > 7:
+        for item in columns[7].split(';'):
+            if '=' in item:
+                k, v = item.split('=', 1)
+                key_to_value[k] = v
+    format_keys = columns[8].split(':') if len(columns) > 8 else []
+    samples = [s.split(':') for s in columns[9:]]
+
+    ret = []
+    for field in fields:
+        if field.column == 'INFO':
+            ret.append([key_to_value.get(field.key, '.')])
+        elif field.key in format_keys:
+            i = format_keys.index(field.key)
+            ret.append([s[i] if i < len(s) else '.' for s in samples])
+        else:
+            ret.append([])
+    return ret
+
+
+def get_allele_values(
+        fields: List[CallerField],
+        field_values: List[List[str]],
+        allele_index: int,
+        n_alts: int) -> Tuple[str, ...]:
+    """
+    Per-allele values (Number=A or R) of a split multi-allelic record are subset to the allele
+    """
+    return tuple(
+        '|'.join(subset_allele(value=v, number=field.number, allele_index=allele_index, n_alts=n_alts) for v in values)
+        for field, values in zip(fields, field_values)
+    )
+
+
+def subset_allele(value: str, number: str, allele_index: int, n_alts: int) -> str:
+    values = value.split(',')
+    if number == 'A' and len(values) == n_alts:
+        return values[allele_index]
+    if number == 'R' and len(values) == n_alts + 1:
+        return f'{values[0]},{values[allele_index + 1]}'
+    return value
+
+
+class GetFastaIndex(Processor):
+    """
+    Contig names, lengths and order come from the .fai index of the reference,
+    which is built in a single pass and cached next to the fasta (or in the workdir) if missing
+    """
+
+    ref_fa: str
 
-        self.variant_df.to_csv(
-            self.out_vcf,
-            mode='a',
-            sep='\t',
-            header=False,
-            index=False)
+    fai: str
+    records: List[FaiRecord]
+
+    def main(self, ref_fa: str) -> List[FaiRecord]:
+        self.ref_fa = ref_fa
+
+        for fai in [f'{self.ref_fa}.fai', f'{self.workdir}/{basename(self.ref_fa)}.fai']:
+            if exists(fai) and getmtime(fai) >= getmtime(self.ref_fa):
+                return read_fai(fai)
+
+        self.build_index()
+        self.write_index()
+
+        return self.records
+
+    def build_index(self):
+        self.logger.info(f'Build fasta index of "{self.ref_fa}"')
+        self.records = build_fai(self.ref_fa)
+
+    def write_index(self):
+        for fai in [f'{self.ref_fa}.fai', f'{self.workdir}/{basename(self.ref_fa)}.fai']:
+            try:
+                write_fai(records=self.records, fai=fai)
+                self.logger.info(f'Fasta index cached in "{fai}"')
+                return
+            except OSError:  # e.g. read-only reference directory
+                continue
 
 
 class BuildHeaderContigLines(Processor):
@@ -130,14 +844,9 @@ class BuildHeaderContigLines(Processor):
         return self.contig_lines
 
     def set_contig_id_to_length(self):
-        self.contig_id_length = {}
-        with open(self.ref_fa) as fh:
-            for line in fh:
-                if line.startswith('>'):
-                    this_id = line.strip()[1:].split(' ')[0]
-                    self.contig_id_length.setdefault(this_id, 0)
-                else:
-                    self.contig_id_length[this_id] += len(line.strip())
+        self.contig_id_length = {
+            r.name: r.length for r in GetFastaIndex(self.settings).main(ref_fa=self.ref_fa)
+        }
 
     def set_contig_lines(self):
         lines = [
@@ -156,13 +865,8 @@ class GetChromToOrder(Processor):
     def main(self, ref_fa: str) -> Dict[str, int]:
         self.ref_fa = ref_fa
 
-        self.chrom_to_order = {}
-        current = 0
-        with open(self.ref_fa) as fh:
-            for line in fh:
-                if line.startswith('>'):
-                    chrom = line[1:].strip().split(' ')[0]
-                    self.chrom_to_order[chrom] = current
-                    current += 1
+        self.chrom_to_order = {
+            r.name: i for i, r in enumerate(GetFastaIndex(self.settings).main(ref_fa=self.ref_fa))
+        }
 
         return self.chrom_to_order
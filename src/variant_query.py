@@ -0,0 +1,64 @@
+import sqlite3
+from typing import List, Tuple, Optional, Iterator, Any
+from .tools import parse_region
+from .parse_vcf import SqliteWriter, quote
+
+
+class QueryVariants:
+    """
+    Looks up variants of a vcf2sqlite database by region, gene symbol and/or consequence (all given conditions apply),
+    each answered from the indexes built by SqliteWriter
+    """
+
+    db: str
+    columns: List[str]
+
+    def __init__(self, db: str):
+        self.db = db
+        self.__con = sqlite3.connect(f'file:{db}?mode=ro', uri=True)
+        self.columns = [
+            row[1] for row in self.__con.execute(f'PRAGMA table_info({SqliteWriter.TABLE})')
+        ]
+
+    def query(
+            self,
+            region: Optional[str] = None,
+            gene: Optional[str] = None,
+            consequence: Optional[str] = None) -> Iterator[Tuple[Any, ...]]:
+
+        conditions, parameters = [], []
+
+        if region is not None:
+            chrom, start, end = parse_region(region)
+            conditions.append(f'{quote("Chromosome")} = ?')
+            parameters.append(chrom)
+            if start is not None:
+                conditions.append(f'{quote("Position")} BETWEEN ? AND ?')
+                parameters += [start, end]
+
+        if gene is not None:
+            conditions.append(self.__any_column_equals(SqliteWriter.GENE_COLUMNS, 'gene'))
+            parameters += [gene] * self.__n_present(SqliteWriter.GENE_COLUMNS)
+
+        if consequence is not None:
+            conditions.append(self.__any_column_equals(SqliteWriter.CONSEQUENCE_COLUMNS, 'consequence'))
+            parameters += [consequence] * self.__n_present(SqliteWriter.CONSEQUENCE_COLUMNS)
+
+        sql = f'SELECT * FROM {SqliteWriter.TABLE}'
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY rowid'
+
+        return self.__con.execute(sql, parameters)
+
+    def __n_present(self, columns: List[str]) -> int:
+        return sum(c in self.columns for c in columns)
+
+    def __any_column_equals(self, columns: List[str], what: str) -> str:
+        present = [c for c in columns if c in self.columns]
+        assert len(present) > 0, f'"{self.db}" has no {what} column, one of {columns} is required'
+        return '(' + ' OR '.join(f'{quote(c)} = ?' for c in present) + ')'
+
+    def close(self):
+        self.__con.close()
+
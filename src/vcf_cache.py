@@ -0,0 +1,204 @@
+import os
+import json
+import gzip
+import numpy as np
+from array import array
+from typing import List, Dict, Optional, IO
+from .template import Processor
+
+
+class VcfColumnCache:
+    """
+    Sidecar store next to a vcf, holding QUAL, FILTER and numeric INFO columns as memory-mapped numpy arrays
+
+    {vcf}.omic-cache/
+        meta.json       size and mtime of the vcf, FILTER vocabulary, cached INFO keys
+        offsets.npy     byte offset of each variant line in the (uncompressed) vcf text
+        QUAL.npy        float64, NaN for '.'
+        FILTER.npy      int32 codes into the FILTER vocabulary
+        INFO.{ID}.npy   float64, NaN when absent
+
+    The cache is invalid as soon as the size or mtime of the vcf changes
+    """
+
+    SUFFIX = '.omic-cache'
+    VERSION = 1
+
+    vcf: str
+    cachedir: str
+
+    n_variants: int
+    filters: List[str]
+    info_keys: List[str]
+    offsets: np.ndarray
+    qual: np.ndarray
+    filter_codes: np.ndarray
+
+    def __init__(self, vcf: str):
+        self.vcf = vcf
+        self.cachedir = vcf + self.SUFFIX
+
+    def is_valid(self) -> bool:
+        meta = f'{self.cachedir}/meta.json'
+        if not os.path.exists(meta):
+            return False
+        with open(meta) as fh:
+            d = json.load(fh)
+        stat = os.stat(self.vcf)
+        return d['version'] == self.VERSION and d['size'] == stat.st_size and d['mtime_ns'] == stat.st_mtime_ns
+
+    def load(self) -> 'VcfColumnCache':
+        with open(f'{self.cachedir}/meta.json') as fh:
+            d = json.load(fh)
+        self.n_variants = d['n_variants']
+        self.filters = d['filters']
+        self.info_keys = d['info_keys']
+        self.offsets = self.__load('offsets')
+        self.qual = self.__load('QUAL')
+        self.filter_codes = self.__load('FILTER')
+        return self
+
+    def get_values(self, key: str) -> Optional[np.ndarray]:
+        """
+        Returns QUAL or the numeric INFO column of key, None if not cached
+        """
+        if key == 'QUAL':
+            return self.qual
+        if key in self.info_keys:
+            return self.__load(f'INFO.{key}')
+        return None
+
+    def __load(self, name: str) -> np.ndarray:
+        return np.load(f'{self.cachedir}/{name}.npy', mmap_mode='r')
+
+    def save(
+            self,
+            offsets: np.ndarray,
+            qual: np.ndarray,
+            filter_codes: np.ndarray,
+            filters: List[str],
+            key_to_info: Dict[str, np.ndarray]):
+
+        os.makedirs(self.cachedir, exist_ok=True)
+
+        np.save(f'{self.cachedir}/offsets.npy', offsets.astype(np.int64))
+        np.save(f'{self.cachedir}/QUAL.npy', qual.astype(np.float64))
+        np.save(f'{self.cachedir}/FILTER.npy', filter_codes.astype(np.int32))
+        for key, values in key_to_info.items():
+            np.save(f'{self.cachedir}/INFO.{key}.npy', values.astype(np.float64))
+
+        stat = os.stat(self.vcf)
+        meta = {
+            'version': self.VERSION,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'n_variants': len(offsets),
+            'filters': filters,
+            'info_keys': list(key_to_info.keys()),
+        }
+        with open(f'{self.cachedir}/meta.json', 'w') as fh:  # written last, marks the cache as complete
+            json.dump(meta, fh)
+
+
+class GetVcfColumnCache(Processor):
+    """
+    Returns the valid sidecar cache of the vcf, building it by parsing the vcf text if missing or stale
+    """
+
+    vcf: str
+
+    cache: VcfColumnCache
+    numeric_info_keys: List[str]
+    offsets: array
+    qual: array
+    filter_codes: array
+    filter_to_code: Dict[str, int]
+    key_to_info: Dict[str, array]
+    multi_valued_keys: set
+    header_size: int
+
+    def main(self, vcf: str) -> Optional[VcfColumnCache]:
+        self.vcf = vcf
+        self.cache = VcfColumnCache(vcf)
+
+        if self.cache.is_valid():
+            self.logger.info(f'Use column cache "{self.cache.cachedir}"')
+            return self.cache.load()
+
+        try:
+            self.build()
+        except OSError as e:  # e.g. read-only directory of the input vcf
+            self.logger.info(f'Cannot write column cache "{self.cache.cachedir}": {e}')
+            return None
+
+        return self.cache.load()
+
+    def build(self):
+        self.logger.info(f'Build column cache "{self.cache.cachedir}"')
+        with open_binary(self.vcf) as fh:
+            self.parse_header(fh)
+            self.parse_variants(fh)
+        self.save()
+
+    def parse_header(self, fh: IO):
+        self.numeric_info_keys = []
+        self.header_size = 0
+        for line in fh:
+            self.header_size += len(line)
+            if line.startswith(b'##INFO=<ID='):
+                id_ = line.split(b'INFO=<ID=')[1].split(b',')[0].decode()
+                if b'Type=Integer' in line or b'Type=Float' in line:
+                    self.numeric_info_keys.append(id_)
+            elif not line.startswith(b'##'):  # the #CHROM line
+                break
+
+    def parse_variants(self, fh: IO):
+        self.offsets = array('q')
+        self.qual = array('d')
+        self.filter_codes = array('i')
+        self.filter_to_code = {}
+        self.key_to_info = {key: array('d') for key in self.numeric_info_keys}
+        self.multi_valued_keys = set()
+
+        nan = float('nan')
+        offset = self.header_size
+        for line in fh:
+            self.offsets.append(offset)
+            offset += len(line)
+
+            _, _, _, _, _, qual, filter_, info = line.rstrip(b'\r\n').split(b'\t', 8)[:8]
+
+            self.qual.append(nan if qual == b'.' else float(qual))
+            self.filter_codes.append(self.filter_to_code.setdefault(filter_.decode(), len(self.filter_to_code)))
+
+            key_to_val = {}
+            for item in info.split(b';'):
+                if b'=' in item:
+                    k, v = item.split(b'=', 1)
+                    key_to_val[k.decode()] = v
+
+            for key, values in self.key_to_info.items():
+                v = key_to_val.get(key)
+                if v is None or v == b'.':
+                    values.append(nan)
+                elif b',' in v:  # not a single number, cannot be evaluated from the cache
+                    self.multi_valued_keys.add(key)
+                    values.append(nan)
+                else:
+                    values.append(float(v))
+
+    def save(self):
+        self.cache.save(
+            offsets=np.frombuffer(self.offsets, dtype=np.int64),
+            qual=np.frombuffer(self.qual, dtype=np.float64),
+            filter_codes=np.frombuffer(self.filter_codes, dtype=np.int32),
+            filters=list(self.filter_to_code.keys()),
+            key_to_info={
+                key: np.frombuffer(values, dtype=np.float64)
+                for key, values in self.key_to_info.items()
+                if key not in self.multi_valued_keys
+            })
+
+
+def open_binary(vcf: str) -> IO:
+    return gzip.open(vcf, 'rb') if vcf.endswith('.gz') else open(vcf, 'rb')
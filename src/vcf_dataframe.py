@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+from os.path import exists
+from typing import List, Dict, Any, Optional, Iterator, Union, IO
+from .template import Processor
+from .tools import TabixReader, parse_region
+from .parse_vcf import read_vcf_header, open_vcf, iter_chunks, parse_chunk, select_columns, get_unique_column_names, \
+    get_samples, get_format_ids, get_sample_format_columns, GetInfoIDToDescription, GetAllColumns, BuildRowPlan, \
+    GetColumnTypes, RowPlan
+
+
+class ReadVcf(Processor):
+    """
+    Parses a vcf into a pandas DataFrame (or an iterator of DataFrames of chunksize variants) with compact dtypes:
+        Position                                        int32
+        Quality, Float INFO fields                      float64 (NaN if missing)
+        Integer INFO fields                             Int64 (nullable)
+        (and single-valued FORMAT fields '{sample}.{key}' likewise if format_fields)
+        Flag INFO fields                                bool
+        Chromosome, Filter, gene, consequence, impact   category
+        other columns                                   object
+
+    Rows are converted to typed columns one chunk at a time, so the rows of the whole vcf are never held as Python objects
+    """
+
+    CHUNK_SIZE = 100000  # variants, when all variants are returned as one DataFrame
+    POSITION_COLUMN = 'Position'
+    CATEGORY_COLUMNS = ['SYMBOL', 'Gene_Name', 'IMPACT', 'Annotation_Impact', 'BIOTYPE']
+
+    vcf: str
+    columns: Optional[List[str]]
+    region: Optional[str]
+    chunksize: Optional[int]
+    format_fields: bool
+
+    vcf_header: str
+    info_id_to_description: Dict[str, str]
+    all_columns: List[str]
+    row_plan: RowPlan
+    dtypes: List[str]
+
+    def main(
+            self,
+            vcf: str,
+            columns: Optional[List[str]],
+            region: Optional[str],
+            chunksize: Optional[int],
+            format_fields: bool = False) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+
+        self.vcf = vcf
+        self.columns = columns
+        self.region = region
+        self.chunksize = chunksize
+        self.format_fields = format_fields
+
+        self.set_vcf_header()
+        self.set_all_columns()
+        self.set_row_plan()
+        self.set_dtypes()
+
+        if self.chunksize is not None:
+            return self.iter_dataframes()
+        return self.read_dataframe()
+
+    def set_vcf_header(self):
+        self.vcf_header = read_vcf_header(self.vcf)
+
+    def set_all_columns(self):
+        self.info_id_to_description = GetInfoIDToDescription(self.settings).main(vcf_header=self.vcf_header)
+        self.all_columns = GetAllColumns(self.settings).main(info_id_to_description=self.info_id_to_description)
+        if self.format_fields:
+            self.all_columns += get_sample_format_columns(self.vcf_header)
+        if self.columns is not None:
+            self.all_columns = select_columns(all_columns=self.all_columns, patterns=self.columns)
+
+    def set_row_plan(self):
+        self.row_plan = BuildRowPlan(self.settings).main(
+            info_id_to_description=self.info_id_to_description,
+            all_columns=self.all_columns,
+            samples=get_samples(self.vcf_header) if self.format_fields else [],
+            format_ids=get_format_ids(self.vcf_header))
+
+    def set_dtypes(self):
+        column_types = GetColumnTypes(self.settings).main(
+            vcf_header=self.vcf_header,
+            all_columns=self.all_columns)
+
+        self.dtypes = []
+        for column, t in zip(self.all_columns, column_types):
+            if column == self.POSITION_COLUMN:
+                t = 'int32'
+            elif t == 'dictionary' or column in self.CATEGORY_COLUMNS:
+                t = 'category'
+            self.dtypes.append(t)
+
+    def read_dataframe(self) -> pd.DataFrame:
+        builder = DataFrameBuilder(columns=self.all_columns, dtypes=self.dtypes)
+        for lines in self.iter_line_chunks(size=self.CHUNK_SIZE):
+            builder.add(parse_chunk(row_plan=self.row_plan, lines=lines, as_csv=False))
+        return builder.build()
+
+    def iter_dataframes(self) -> Iterator[pd.DataFrame]:
+        """
+        One builder for all chunks, so that category codes are shared and the categories of each chunk
+        extend those of the previous chunk, i.e. every chunk can be cast to the dtypes of the last one
+        """
+        builder = DataFrameBuilder(columns=self.all_columns, dtypes=self.dtypes)
+        for lines in self.iter_line_chunks(size=self.chunksize):
+            builder.add(parse_chunk(row_plan=self.row_plan, lines=lines, as_csv=False))
+            yield builder.build()
+            builder.reset()
+
+    def iter_line_chunks(self, size: int) -> Iterator[List[str]]:
+        if self.region is None:
+            with open_vcf(self.vcf) as fh:
+                yield from iter_chunks(fh=fh, size=size)
+            return
+
+        chrom, start, end = parse_region(self.region)
+        if start is None:
+            start, end = 1, 2 ** 31 - 1
+
+        if self.vcf.endswith('.gz') and exists(f'{self.vcf}.tbi'):
+            with TabixReader(self.vcf) as reader:
+                yield from iter_chunks(fh=reader.fetch(chrom=chrom, start=start, end=end), size=size)
+        else:
+            with open_vcf(self.vcf) as fh:
+                yield from iter_chunks(fh=iter_region_lines(fh=fh, chrom=chrom, start=start, end=end), size=size)
+
+
+def iter_region_lines(fh: IO, chrom: str, start: int, end: int) -> Iterator[str]:
+    for line in fh:
+        if line.startswith('#'):
+            continue
+        c, pos = line.split('\t', 2)[:2]
+        if c == chrom and start <= int(pos) <= end:
+            yield line
+
+
+class DataFrameBuilder:
+    """
+    Accumulates rows as typed numpy columns chunk by chunk, categories are codes into one growing vocabulary per column
+    """
+
+    DTYPE_TO_NUMPY_DTYPE = {
+        'int32': np.int32,
+        'int64': np.int64,
+        'float64': np.float64,
+        'bool': bool,
+        'category': np.int32,  # codes
+        'string': object,
+    }
+
+    columns: List[str]
+    dtypes: List[str]
+
+    values: List[List[np.ndarray]]
+    masks: List[List[np.ndarray]]  # missing values of nullable integer columns
+    vocabularies: List[Dict[str, int]]
+
+    def __init__(self, columns: List[str], dtypes: List[str]):
+        self.columns = get_unique_column_names(columns)
+        self.dtypes = dtypes
+
+        self.vocabularies = [{} for _ in columns]
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the rows added so far, vocabularies are kept
+        """
+        self.values = [[] for _ in self.columns]
+        self.masks = [[] for _ in self.columns]
+
+    def add(self, data: List[List[Any]]):
+        for i, t in enumerate(self.dtypes):
+            values = [row[i] for row in data]
+            if t == 'int32':
+                self.values[i].append(np.array(values, dtype=np.int32))
+            elif t == 'int64':
+                missing = np.array([is_missing(v) for v in values], dtype=bool)
+                self.values[i].append(np.array([0 if m else int(v) for v, m in zip(values, missing)], dtype=np.int64))
+                self.masks[i].append(missing)
+            elif t == 'float64':
+                self.values[i].append(np.array([np.nan if is_missing(v) else float(v) for v in values], dtype=np.float64))
+            elif t == 'bool':
+                self.values[i].append(np.array([v is True for v in values], dtype=bool))
+            elif t == 'category':
+                vocabulary = self.vocabularies[i]
+                self.values[i].append(np.array(
+                    [-1 if v is None else vocabulary.setdefault(v, len(vocabulary)) for v in values], dtype=np.int32))
+            else:
+                self.values[i].append(np.array(values, dtype=object))
+
+    def build(self) -> pd.DataFrame:
+        data = {}
+        for i, (column, t) in enumerate(zip(self.columns, self.dtypes)):
+            values = concatenate(self.values[i], dtype=self.DTYPE_TO_NUMPY_DTYPE[t])
+            if t == 'int64':
+                data[column] = pd.arrays.IntegerArray(values, concatenate(self.masks[i], dtype=bool))
+            elif t == 'category':
+                data[column] = pd.Categorical.from_codes(values, categories=list(self.vocabularies[i].keys()))
+            else:
+                data[column] = values
+        return pd.DataFrame(data)
+
+
+def is_missing(v: Any) -> bool:
+    return v is None or v == '' or v == '.'
+
+
+def concatenate(arrays: List[np.ndarray], dtype: type) -> np.ndarray:
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays)
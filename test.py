@@ -1,6 +1,10 @@
+import json
+import sqlite3
 import unittest
 import subprocess
-from shutil import rmtree
+from os import makedirs
+from shutil import rmtree, copy
+from typing import List
 
 
 class TestCLI(unittest.TestCase):
@@ -18,6 +22,61 @@ class TestCLI(unittest.TestCase):
 --variant-flagging-criteria "LOW_DP: DP<20, HIGH_MQ: MQ>=30" \\
 --variant-removal-flags panel_of_normal,LOW_DP \\
 --only-pass \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_variant_filtering_known_sites(self):
+        cmd = f'''python __main__.py variant-filtering \\
+--input-vcf ./data/tiny.vcf \\
+--output-vcf {self.workdir}/output.vcf \\
+--variant-flagging-criteria "COMMON: sites=./data/mutect2.vcf.gz, AF>0.01, PON: sites=./data/muse.vcf.gz" \\
+--variant-removal-flags COMMON,PON \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_variant_filtering_known_sites_colon_path(self):
+        makedirs(self.workdir, exist_ok=True)
+        copy('./data/lofreq.vcf', f'{self.workdir}/known:sites.vcf')
+        cmd = f'''python __main__.py variant-filtering \\
+--input-vcf ./data/tiny.vcf \\
+--output-vcf {self.workdir}/output.vcf \\
+--variant-flagging-criteria "PON: sites={self.workdir}/known:sites.vcf" \\
+--variant-removal-flags PON \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+        with open('./data/tiny.vcf') as fh:
+            lines = fh.readlines()
+        header = [line for line in lines if line.startswith('#')]
+        variants = [line for line in lines if not line.startswith('#')]
+        with open(f'{self.workdir}/unsorted.vcf', 'w') as fh:
+            fh.writelines(header + variants[::-1])
+        result = subprocess.run(
+            cmd.replace('./data/tiny.vcf', f'{self.workdir}/unsorted.vcf').replace('python', 'python -O', 1),
+            shell=True, capture_output=True, text=True)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('must be sorted', result.stderr)
+
+    def test_variant_filtering_cache(self):
+        makedirs(self.workdir, exist_ok=True)
+        copy('./data/tiny.vcf', f'{self.workdir}/tiny.vcf')
+        cmd = f'''python __main__.py variant-filtering \\
+--input-vcf {self.workdir}/tiny.vcf \\
+--output-vcf {self.workdir}/output.vcf \\
+--variant-flagging-criteria "LOW_DP: DP<20, HIGH_MQ: MQ>=30" \\
+--variant-removal-flags panel_of_normal,LOW_DP \\
+--cache \\
+--workdir {self.workdir}'''
+        for _ in range(2):  # build and then use the cache
+            subprocess.check_call(cmd, shell=True)
+
+    def test_variant_filtering_batch(self):
+        cmd = f'''python __main__.py variant-filtering-batch \\
+--input-vcfs "./data/*.vcf*" \\
+--outdir {self.workdir}/outdir \\
+--variant-flagging-criteria "LOW_DP: DP<20, HIGH_MQ: MQ>=30" \\
+--variant-removal-flags panel_of_normal,LOW_DP \\
+--threads 2 \\
 --workdir {self.workdir}'''
         subprocess.check_call(cmd, shell=True)
 
@@ -33,6 +92,148 @@ class TestCLI(unittest.TestCase):
 --workdir {self.workdir}'''
         subprocess.check_call(cmd, shell=True)
 
+    def test_variant_picking_streaming(self):
+        cmd = f'''python __main__.py variant-picking \\
+--ref-fa ./data/chr9.fa \\
+--mutect2 ./data/mutect2.vcf.gz \\
+--muse ./data/muse.vcf.gz \\
+--lofreq ./data/lofreq.vcf \\
+--output-vcf {self.workdir}/output.vcf \\
+--min-snv-callers 2 \\
+--min-indel-callers 1 \\
+--streaming \\
+--concordance-prefix {self.workdir}/qc/sample \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+        with open(f'{self.workdir}/qc/sample.upset.tsv') as fh:
+            upset = [line.rstrip('\n').split('\t') for line in fh]
+        self.assertEqual(upset[0], ['callers', 'SNV', 'indel', 'total'])
+        self.assertEqual(len(upset), 1 + 7)  # every combination of the 3 callers has variants
+        for callers, snv, indel, total in upset[1:]:
+            self.assertEqual(int(snv) + int(indel), int(total))
+
+        with open(f'{self.workdir}/qc/sample.jaccard.tsv') as fh:
+            jaccard = [line.rstrip('\n').split('\t') for line in fh]
+        self.assertEqual(jaccard[0], ['', 'mutect2', 'muse', 'lofreq'])
+        self.assertEqual([row[0] for row in jaccard[1:]], ['mutect2', 'muse', 'lofreq'])
+        self.assertEqual([row[i + 1] for i, row in enumerate(jaccard[1:])], ['1.0000'] * 3)
+
+    def test_variant_picking_match_window(self):
+        cmd = f'''python __main__.py variant-picking \\
+--ref-fa ./data/chr9.fa \\
+--mutect2 ./data/mutect2.vcf.gz \\
+--muse ./data/muse.vcf.gz \\
+--lofreq ./data/lofreq.vcf \\
+--output-vcf {self.workdir}/output.vcf \\
+--min-snv-callers 2 \\
+--min-indel-callers 1 \\
+--match-window 5 \\
+--carry-fields AF,DP \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_variant_picking_targets(self):
+        makedirs(self.workdir, exist_ok=True)
+        with open(f'{self.workdir}/targets.bed', 'w') as fh:  # 0-based half-open, i.e. chr9:100-200 and chr9:1000
+            fh.write('chr9\t99\t200\nchr9\t999\t1000\n')
+        header = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        with open(f'{self.workdir}/mutect2.vcf', 'w') as fh:
+            fh.write(header + ''.join(f'{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\t.\t.\n' for chrom, pos, ref, alt in [
+                ('chr9', 50, 'T', 'A'),
+                ('chr9', 100, 'C', 'T'),
+                ('chr9', 200, 'C', 'T'),
+                ('chr9', 201, 'G', 'A'),
+                ('chr9', 1000, 'C', 'CA'),
+                ('chr10', 100, 'G', 'A'),
+            ]))
+        for streaming in ['', '--streaming']:
+            cmd = f'''python __main__.py variant-picking \\
+--ref-fa ./data/chr9.fa \\
+--mutect2 {self.workdir}/mutect2.vcf \\
+--output-vcf {self.workdir}/output.vcf \\
+--min-snv-callers 1 \\
+--min-indel-callers 1 \\
+--targets {self.workdir}/targets.bed \\
+{streaming} \\
+--workdir {self.workdir}'''
+            subprocess.check_call(cmd, shell=True)
+            with open(f'{self.workdir}/output.vcf') as fh:
+                variants = [line.split('\t')[:2] for line in fh if not line.startswith('#')]
+            self.assertEqual(variants, [['chr9', '100'], ['chr9', '200'], ['chr9', '1000']])
+
+    def test_variant_picking_no_callers(self):
+        for streaming in ['', '--streaming']:
+            cmd = f'''python __main__.py variant-picking \\
+--ref-fa ./data/chr9.fa \\
+--output-vcf {self.workdir}/output.vcf \\
+{streaming} \\
+--workdir {self.workdir}'''
+            subprocess.check_call(cmd, shell=True)
+            with open(f'{self.workdir}/output.vcf') as fh:
+                lines = fh.read().splitlines()
+            self.assertTrue(lines[-1].startswith('#CHROM'))
+
+    def test_variant_picking_normalization(self):
+        makedirs(self.workdir, exist_ok=True)
+        header = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        with open(f'{self.workdir}/mutect2.vcf', 'w') as fh:  # chr9:1001-1010 is AAAAAAAAAA, 1122-1125 AAAA
+            fh.write(header + 'chr9\t1010\t.\tA\tAA\t.\t.\t.\nchr9\t1125\t.\tAC\tCC,ATC\t.\t.\t.\n')
+        with open(f'{self.workdir}/lofreq.vcf', 'w') as fh:
+            fh.write(header + 'chr9\t1000\t.\tC\tCA\t.\t.\t.\n')
+        for streaming in ['', '--streaming']:
+            cmd = f'''python __main__.py variant-picking \\
+--ref-fa ./data/chr9.fa \\
+--mutect2 {self.workdir}/mutect2.vcf \\
+--lofreq {self.workdir}/lofreq.vcf \\
+--output-vcf {self.workdir}/output.vcf \\
+--min-snv-callers 1 \\
+--min-indel-callers 1 \\
+{streaming} \\
+--workdir {self.workdir}'''
+            subprocess.check_call(cmd, shell=True)
+            with open(f'{self.workdir}/output.vcf') as fh:
+                variants = [line.split('\t')[:8] for line in fh if not line.startswith('#')]
+            self.assertEqual(
+                [(v[1], v[3], v[4], v[7].rstrip()) for v in variants],
+                [('1000', 'C', 'CA', 'CALL=mutect2,lofreq'),
+                 ('1125', 'A', 'AT', 'CALL=mutect2'),
+                 ('1125', 'A', 'C', 'CALL=mutect2')])
+
+    def test_cohort_merge(self):
+        makedirs(self.workdir, exist_ok=True)
+        with open(f'{self.workdir}/manifest.txt', 'w') as fh:
+            fh.write('./data/mutect2.vcf.gz\n./data/muse.vcf.gz\n./data/lofreq.vcf\n')
+        cmd = f'''python __main__.py cohort-merge \\
+--ref-fa ./data/chr9.fa \\
+--input-vcfs {self.workdir}/manifest.txt \\
+--output-vcf {self.workdir}/cohort.vcf \\
+--presence-matrix {self.workdir}/cohort.npz \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_cohort_merge_allele_order(self):
+        makedirs(self.workdir, exist_ok=True)
+        header = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        with open(f'{self.workdir}/a.vcf', 'w') as fh:
+            fh.write(header + 'chr9\t100\t.\tC\tT\t.\t.\t.\nchr9\t100\t.\tC\tA\t.\t.\t.\n')
+        with open(f'{self.workdir}/b.vcf', 'w') as fh:
+            fh.write(header + 'chr9\t100\t.\tC\tA\t.\t.\t.\n')
+        with open(f'{self.workdir}/manifest.txt', 'w') as fh:
+            fh.write(f'{self.workdir}/a.vcf\n{self.workdir}/b.vcf\n')
+        cmd = f'''python __main__.py cohort-merge \\
+--ref-fa ./data/chr9.fa \\
+--input-vcfs {self.workdir}/manifest.txt \\
+--output-vcf {self.workdir}/cohort.vcf \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+        with open(f'{self.workdir}/cohort.vcf') as fh:
+            sites = [line.rstrip('\n').split('\t') for line in fh if not line.startswith('#')]
+        self.assertEqual(
+            [(s[1], s[3], s[4], s[9], s[10]) for s in sites],
+            [('100', 'C', 'A', '1', '1'), ('100', 'C', 'T', '1', '0')])
+
     def test_vcf2csv(self):
         cmd = f'''python __main__.py vcf2csv \\
 --input-vcf ./data/vep.vcf \\
@@ -40,6 +241,131 @@ class TestCLI(unittest.TestCase):
 --workdir {self.workdir}'''
         subprocess.check_call(cmd, shell=True)
 
+    def test_vcf2csv_parquet(self):
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf ./data/vep.vcf \\
+--output-csv {self.workdir}/output.parquet \\
+--format parquet \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_vcf2csv_explode_annotations(self):
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf ./data/vep.vcf \\
+--output-csv {self.workdir}/output.csv \\
+--explode-annotations \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_vcf2csv_pick_most_severe(self):
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf ./data/vep.vcf \\
+--output-csv {self.workdir}/output.csv \\
+--pick most-severe \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_vcf2csv_gz_threads(self):
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf ./data/mutect2.vcf.gz \\
+--output-csv {self.workdir}/output.csv \\
+--threads 2 \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_vcf2csv_columns(self):
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf ./data/vep.vcf \\
+--output-csv {self.workdir}/output.csv \\
+--columns "Chromosome,Position,Ref Allele,Alt Allele,SYMBOL,Consequence,IMP*" \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_vcf2csv_chunk_size(self):
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf ./data/vep.vcf \\
+--output-csv {self.workdir}/output.csv \\
+--chunk-size 2 \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_vcf2csv_format_fields(self):
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf ./data/vep.vcf \\
+--output-csv {self.workdir}/output.csv \\
+--format-fields \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_vcf2csv_metrics_json_profile(self):
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf ./data/vep.vcf \\
+--output-csv {self.workdir}/output.csv \\
+--metrics-json {self.workdir}/metrics.json \\
+--profile \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+    def test_variant_filtering_metrics_json(self):
+        cmd = f'''python __main__.py variant-filtering \\
+--input-vcf ./data/tiny.vcf \\
+--output-vcf {self.workdir}/output.vcf \\
+--variant-flagging-criteria "LOW_DP: DP<20, HIGH_MQ: MQ>=30" \\
+--variant-removal-flags LOW_DP \\
+--metrics-json {self.workdir}/metrics.json \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+        with open(f'{self.workdir}/metrics.json') as fh:
+            name_to_records = {s['name']: s['records'] for s in iter_spans(json.load(fh)['spans'])}
+        self.assertGreater(name_to_records['FlagVariants'], 0)
+        self.assertEqual(name_to_records['FlagVariants'], name_to_records['RemoveVariants'])
+
+        cmd = cmd.replace('./data/tiny.vcf', f'{self.workdir}/missing.vcf')
+        self.assertNotEqual(subprocess.call(cmd, shell=True), 0)
+        with open(f'{self.workdir}/metrics.json') as fh:  # written for the failed run too
+            self.assertIn('FlagVariants', [s['name'] for s in iter_spans(json.load(fh)['spans'])])
+
+    def test_vcf2sqlite_parquet_unparseable_numbers(self):
+        makedirs(f'{self.workdir}/out', exist_ok=True)
+        with open('./data/tiny.vcf') as fh:
+            lines = fh.readlines()
+        header = [line for line in lines if line.startswith('#')]
+        variants = [line for line in lines if not line.startswith('#')][:2]
+        variants[0] = variants[0].replace('DP=65;MQ=27.6', 'DP=NA;MQ=inf')  # Integer DP, Float MQ
+        variants[1] = variants[1].replace('MQ=37.5', 'MQ=NA')
+        with open(f'{self.workdir}/na.vcf', 'w') as fh:
+            fh.writelines(header + variants)
+
+        cmd = f'''python __main__.py vcf2csv \\
+--input-vcf {self.workdir}/na.vcf \\
+--output-csv {self.workdir}/out/na.parquet \\
+--format parquet \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+        cmd = f'''python __main__.py vcf2sqlite \\
+--input-vcf {self.workdir}/na.vcf \\
+--output-db {self.workdir}/out/na.db \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+        con = sqlite3.connect(f'{self.workdir}/out/na.db')
+        rows = con.execute('SELECT "Depth", "Mapping quality" FROM variants ORDER BY rowid').fetchall()
+        con.close()
+        self.assertEqual(rows, [(None, float('inf')), (63, None)])
+
+    def test_vcf2sqlite_query(self):
+        cmd = f'''python __main__.py vcf2sqlite \\
+--input-vcf ./data/vep.vcf \\
+--output-db {self.workdir}/variants.db \\
+--workdir {self.workdir}'''
+        subprocess.check_call(cmd, shell=True)
+
+        cmd = f'''python __main__.py query \\
+--db {self.workdir}/variants.db \\
+--region chr9:1-1000000 \\
+--output-csv {self.workdir}/query.csv'''
+        subprocess.check_call(cmd, shell=True)
+
     def test_remove_umi(self):
         cmd = f'''python __main__.py remove-umi \\
 --input-fq1 ./data/tumor.1.fq.gz \\
@@ -50,3 +376,67 @@ class TestCLI(unittest.TestCase):
 --gzip \\
 --workdir {self.workdir}'''
         subprocess.check_call(cmd, shell=True)
+
+
+class TestReadVcf(unittest.TestCase):
+
+    def test_read_vcf(self):
+        from src import read_vcf
+        df = read_vcf('./data/vep.vcf', columns=['Chromosome', 'Position', 'Consequence'])
+        self.assertEqual(str(df['Chromosome'].dtype), 'category')
+        self.assertEqual(str(df['Position'].dtype), 'int32')
+        n = sum(len(chunk) for chunk in read_vcf('./data/vep.vcf', chunksize=2))
+        self.assertEqual(len(df), n)
+
+    def test_read_vcf_chunks_share_categories(self):
+        import pandas as pd
+        from src import read_vcf
+        df = read_vcf('./data/vep.vcf')
+        chunks = list(read_vcf('./data/vep.vcf', chunksize=2))
+        self.assertGreater(len(chunks), 1)
+
+        last = chunks[-1]
+        for column in df.columns[(df.dtypes == 'category').values]:
+            categories = list(last[column].cat.categories)
+            for chunk in chunks:
+                c = list(chunk[column].cat.categories)
+                self.assertEqual(c, categories[:len(c)])
+
+        concatenated = pd.concat([c.astype(last.dtypes) for c in chunks], ignore_index=True)
+        pd.testing.assert_frame_equal(concatenated, df)
+
+
+def iter_spans(span):
+    yield span
+    for child in span['children']:
+        yield from iter_spans(child)
+
+
+class TestStartup(unittest.TestCase):
+
+    MODULE_BUDGET = 80  # modules imported beyond those of the bare interpreter startup
+
+    def test_remove_umi_help_imports(self):
+        """
+        Counts imported modules rather than timing them, so that the budget does not depend on the machine
+        """
+        baseline = get_imported_modules('python -X importtime -c pass')
+        modules = get_imported_modules('python -X importtime __main__.py remove-umi --help')
+
+        self.assertNotIn('pandas', modules)
+        self.assertNotIn('numpy', modules)
+        self.assertEqual({m for m in modules if m.startswith('src.')}, {'src.template'})
+        self.assertLessEqual(len(set(modules) - set(baseline)), self.MODULE_BUDGET)
+
+
+def get_imported_modules(cmd: str) -> List[str]:
+    """
+    python -X importtime prints 'import time: self [us] | cumulative [us] | module' to stderr
+    """
+    result = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
+    ret = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        ret.append(line.split('|')[-1].strip())
+    return ret